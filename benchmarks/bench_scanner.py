@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Compares the time and memory it takes to parse a photo-heavy address book
+with vobject and with birthdav's vCard scanner.
+
+    $ PYTHONPATH=src python benchmarks/bench_scanner.py --count 500 --photo 64
+"""
+
+import argparse
+import tracemalloc
+import base64
+import time
+import uuid
+import os
+
+import vobject
+
+from birthdav.scan import scan_vcard
+
+
+def make_card(index: int, photo_size: int):
+    photo = base64.b64encode(os.urandom(photo_size)).decode("ascii")
+    card = vobject.vCard()
+    card.add("uid").value = str(uuid.uuid4())
+    card.add("fn").value = "Contact %d" % index
+    card.add("n").value = vobject.vcard.Name(family="Contact",
+                                             given=str(index))
+    card.add("bday").value = "1970-01-%02d" % (index % 28 + 1)
+
+    photo_line = "PHOTO;ENCODING=b;TYPE=JPEG:" + photo
+    chunks = range(0, len(photo_line), 74)
+    folded = "\r\n ".join(photo_line[i:i + 74] for i in chunks)
+    return card.serialize().replace("END:VCARD",
+                                    folded + "\r\nEND:VCARD")
+
+
+def measure(parse, cards):
+    start = time.perf_counter()
+    parsed = [parse(card) for card in cards]
+    elapsed = time.perf_counter() - start
+    assert all(p.bday.value for p in parsed)
+    del parsed
+
+    tracemalloc.start()
+    parsed = [parse(card) for card in cards]
+    assert len(parsed) == len(cards)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / len(cards) * 1e6, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=500,
+                        help="number of vCards in the address book")
+    parser.add_argument("--photo", type=int, default=64,
+                        help="size of each vCard's photo, in KiB")
+    args = parser.parse_args()
+
+    cards = [make_card(i, args.photo * 1024) for i in range(args.count)]
+    print("%d vCards, %.1f MiB" %
+          (len(cards), sum(len(c) for c in cards) / 2 ** 20))
+
+    for label, parse in (("vobject", vobject.readOne),
+                         ("scanner", scan_vcard)):
+        per_card, peak = measure(parse, cards)
+        print("%-8s %10.1f us/vCard, %8.1f MiB peak" %
+              (label, per_card, peak))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Times full, no-op and incremental birthdav syncs against a local CardDAV and
+CalDAV stand-in server, for synthetic address books of several sizes.
+
+    $ PYTHONPATH=src python benchmarks/bench_sync.py --contacts 1000,10000 \
+          --photo 4 --churn 0.01 --state
+
+The first sync creates every event. The second one only differs from a
+no-op sync by having to pick up the events the first one wrote. Contacts are
+then changed before the incremental sync. Each sync runs in a child process,
+so that its peak RSS is its own. The numbers of requests and bytes are
+counted by the server (bodies only, as transferred). Both clients share an
+HTTP session, with a connection per worker; --no-compression turns
+compressed responses down.
+
+With --throttle N, the server turns requests down with a 429 status while
+it is serving N others, each for --latency milliseconds, and the number of
+requests it turned down is printed after each row: raise --retries along
+with it.
+
+With --local, the synthetic address book is written to a vdir directory and
+synced to another one through file:// URLs instead, for a network-free
+baseline: no requests or bytes are counted then.
+"""
+
+import multiprocessing
+import urllib.request
+import pathlib
+import tempfile
+import argparse
+import resource
+import json
+import time
+import sys
+import os
+
+from davserver import Store, serve
+
+from birthdav.dav import get_client, get_session
+from birthdav.sync import sync_birthdays
+
+
+PHASES = ("full", "second", "no-op", "incremental")
+
+
+def start_server(contacts: int, photo_size: int, birthdays: float,
+                 throttle: int = None, latency: float = 0):
+    ready = multiprocessing.Queue()
+    store_args = (contacts, photo_size, birthdays, throttle, latency)
+    process = multiprocessing.Process(target=run_server,
+                                      args=(store_args, ready), daemon=True)
+    process.start()
+    return process, "http://127.0.0.1:%d" % ready.get()
+
+
+def run_server(store_args: tuple, ready):
+    serve(Store(*store_args), ready=ready)
+
+
+def call_server(url: str, path: str, payload: dict = None):
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    with urllib.request.urlopen(url + path, data) as response:
+        return json.loads(response.read())
+
+
+def run_sync(url: str, options: dict, http: dict, results):
+    session = get_session(**http)
+    card_client = get_client({"url": url + "/card/", "user": None,
+                              "pass": None}, session)
+    cal_client = get_client({"url": url + "/cal/", "user": None,
+                             "pass": None}, session)
+    start = time.perf_counter()
+    operations = sync_birthdays(card_client, cal_client, **options)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024
+    results.put((elapsed, peak, len(operations or ())))
+
+
+def write_local(store: Store, directory: str, written: dict):
+    card_directory = os.path.join(directory, "card")
+    os.makedirs(os.path.join(directory, "cal"), exist_ok=True)
+    os.makedirs(card_directory, exist_ok=True)
+    for name, (etag, data) in store.collections["card"].resources.items():
+        if written.get(name) != etag:
+            with open(os.path.join(card_directory, name), "w",
+                      newline="") as card_file:
+                card_file.write(data)
+            written[name] = etag
+
+
+def measure(url: str, options: dict, http: dict):
+    local = url.startswith("file:")
+    if not local:
+        call_server(url, "/_stats")
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_sync,
+                                      args=(url, options, http, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("sync failed with exit code %d" %
+                           process.exitcode)
+    elapsed, peak, operations = results.get()
+    stats = dict.fromkeys(("requests", "bytes_in", "bytes_out",
+                           "throttled"), 0) if \
+        local else call_server(url, "/_stats")
+    stats.update(wall=elapsed, peak_rss=peak, operations=operations)
+    return stats
+
+
+def bench(contacts: int, args, options: dict, http: dict, directory: str):
+    server = store = None
+    written = {}
+    if args.local:
+        store = Store(contacts, args.photo * 1024, args.birthdays)
+        write_local(store, directory, written)
+        url = pathlib.Path(directory).as_uri()
+    else:
+        server, url = start_server(contacts, args.photo * 1024,
+                                   args.birthdays, args.throttle,
+                                   args.latency / 1000 if args.throttle
+                                   else 0)
+    try:
+        rows = []
+        for phase in PHASES:
+            if phase == "incremental" and store is not None:
+                store.churn(args.churn, 0)
+                write_local(store, directory, written)
+            elif phase == "incremental":
+                call_server(url, "/_churn", {"rate": args.churn})
+            row = measure(url, options, http)
+            row.update(contacts=contacts, phase=phase)
+            rows.append(row)
+            print("%8d %-12s %8d %8d %10.2f %10.2f %9.2f %9.1f" %
+                  (contacts, phase, row["operations"], row["requests"],
+                   row["bytes_in"] / 2 ** 20, row["bytes_out"] / 2 ** 20,
+                   row["wall"], row["peak_rss"] / 2 ** 20),
+                  "(%d throttled)" % row["throttled"] if args.throttle
+                  else "", flush=True)
+        return rows
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--contacts", default="1000,10000",
+                        help="comma-separated address book sizes")
+    parser.add_argument("--photo", type=int, default=4,
+                        help="size of each vCard's photo, in KiB")
+    parser.add_argument("--birthdays", type=float, default=0.8,
+                        help="fraction of contacts with a birth date")
+    parser.add_argument("--churn", type=float, default=0.01,
+                        help="fraction of contacts changed before the "
+                        "incremental sync")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="fetch and write workers")
+    parser.add_argument("--retries", type=int, default=0,
+                        help="attempts made again after a temporary write "
+                        "failure")
+    parser.add_argument("--throttle", type=int, metavar="N",
+                        help="have the server turn requests down while it "
+                        "serves N others")
+    parser.add_argument("--latency", type=float, default=10,
+                        help="time the throttled server takes to serve "
+                        "each request, in milliseconds")
+    parser.add_argument("--no-reports", action="store_true",
+                        help="list collections instead of REPORT queries")
+    parser.add_argument("--state", action="store_true",
+                        help="keep a state file between syncs")
+    parser.add_argument("--delta", action="store_true",
+                        help="sync with sync-collection reports (implies "
+                        "--state)")
+    parser.add_argument("--feed", metavar="NAME",
+                        help="write a single feed resource instead of one "
+                        "event per contact")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="turn compressed responses down")
+    parser.add_argument("--local", action="store_true",
+                        help="sync local vdir directories instead of "
+                        "going through the DAV server")
+    parser.add_argument("--json", metavar="PATH",
+                        help="also write the results to a JSON file")
+    args = parser.parse_args()
+
+    print("%8s %-12s %8s %8s %10s %10s %9s %9s" %
+          ("contacts", "phase", "ops", "requests", "MiB sent", "MiB recv",
+           "wall (s)", "RSS (MiB)"))
+    http = {"pool_size": args.workers,
+            "compress": not args.no_compression}
+    rows = []
+    for contacts in (int(c) for c in args.contacts.split(",")):
+        with tempfile.TemporaryDirectory() as directory:
+            state = args.state or args.delta
+            options = {
+                "fetch_workers": args.workers,
+                "write_workers": args.workers,
+                "write_retries": args.retries,
+                "reports": not args.no_reports,
+                "state_path": os.path.join(directory, "state.db") if
+                state else None,
+                "delta": args.delta,
+                "feed": args.feed,
+            }
+            rows.extend(bench(contacts, args, options, http, directory))
+
+    if args.json:
+        with open(args.json, "w") as results:
+            json.dump({"options": vars(args), "results": rows}, results,
+                      indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Measures the per-resource cost of the temporary file transfers birthdav used
+to go through, against the in-memory transfers it now performs.
+
+Network transfers are left out: both paths are fed the same response bodies,
+so the difference is the local overhead of each approach.
+
+    $ PYTHONPATH=src python benchmarks/bench_transfers.py --count 2000
+"""
+
+from tempfile import NamedTemporaryFile
+from datetime import datetime, timedelta
+import argparse
+import time
+import uuid
+import os
+
+import vobject
+
+
+def make_card(index: int):
+    card = vobject.vCard()
+    card.add("uid").value = str(uuid.uuid4())
+    card.add("fn").value = "Contact %d" % index
+    card.add("n").value = vobject.vcard.Name(family="Contact",
+                                             given=str(index))
+    card.add("bday").value = "1970-01-%02d" % (index % 28 + 1)
+    return card.serialize().encode("utf-8")
+
+
+def make_event(index: int):
+    event = vobject.iCalendar()
+    event.add("uid").value = str(uuid.uuid4())
+    event.add("vevent")
+    event.vevent.add("summary").value = "Contact %d" % index
+    event.vevent.add("dtstart").value = datetime(1970, 1, index % 28 + 1, 8)
+    event.vevent.add("rrule").value = "FREQ=YEARLY"
+    for trigger in (0, 7):
+        alarm = event.vevent.add("valarm")
+        alarm.add("action").value = "DISPLAY"
+        alarm.add("trigger").value = timedelta(days=-trigger)
+        alarm.add("description").value = "Contact %d" % index
+    return event
+
+
+def download_tmp_file(body: bytes):
+    tmp_file_w = NamedTemporaryFile("wb", delete=False)
+    tmp_file_w.write(body)
+    tmp_file_w.close()
+    with open(tmp_file_w.name) as tmp_file_r:
+        vobj = vobject.readOne(tmp_file_r)
+    os.unlink(tmp_file_w.name)
+    return vobj
+
+
+def download_memory(body: bytes):
+    return vobject.readOne(body.decode("utf-8"))
+
+
+def upload_tmp_file(vobj):
+    with NamedTemporaryFile("w") as tmp_file:
+        tmp_file.write(vobj.serialize())
+        tmp_file.flush()
+        with open(tmp_file.name, "rb") as upload_file:
+            return upload_file.read()
+
+
+def upload_memory(vobj):
+    return vobj.serialize().encode("utf-8")
+
+
+def measure(function, items):
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    return (time.perf_counter() - start) / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=2000,
+                        help="number of resources to transfer")
+    args = parser.parse_args()
+
+    cards = [make_card(i) for i in range(args.count)]
+    events = [make_event(i) for i in range(args.count)]
+
+    for label, legacy, memory, items in (
+        ("download", download_tmp_file, download_memory, cards),
+        ("upload", upload_tmp_file, upload_memory, events),
+    ):
+        legacy_us = measure(legacy, items)
+        memory_us = measure(memory, items)
+        print("%-8s temporary file: %8.1f us/resource, in memory: %8.1f "
+              "us/resource, overhead removed: %8.1f us/resource" %
+              (label, legacy_us, memory_us, legacy_us - memory_us))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+A small in-memory CardDAV/CalDAV stand-in for birthdav's benchmarks.
+
+It serves an address book at /card/ and a calendar at /cal/ over HTTP/1.1
+with keep-alive, and answers the requests birthdav sends: PROPFIND listings
+with ETags, CTags and sync tokens, GET, conditional PUT and DELETE,
+addressbook-query, calendar-query and multiget REPORTs, and RFC 6578
+sync-collection REPORTs. Response bodies are gzip-compressed for clients
+accepting it. With a throttle, requests sent while that many others are
+being served are turned down with a 429 status, as a rate-limited hosted
+server would, and each request takes `latency` seconds to serve.
+Queries are matched with plain substring searches, which is enough for the
+synthetic collections of the benchmarks but nothing else.
+
+Two extra endpoints drive the benchmarks: GET /_stats returns the number of
+requests and bytes transferred since the last call as JSON, and POST
+/_churn changes the birth date of a fraction of the contacts.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from urllib.parse import unquote, quote
+import threading
+import base64
+import gzip
+import random
+import json
+import time
+import os
+import re
+
+
+CARDDAV = "urn:ietf:params:xml:ns:carddav"
+CALDAV = "urn:ietf:params:xml:ns:caldav"
+CALENDARSERVER = "http://calendarserver.org/ns/"
+
+COLLECTIONS = {"card": ("address-data", CARDDAV, "text/vcard"),
+               "cal": ("calendar-data", CALDAV, "text/calendar")}
+
+BDAY_LINE = re.compile(r"^BDAY:.*$", re.MULTILINE)
+
+# Smallest response body worth compressing, in bytes
+GZIP_MIN_SIZE = 256
+
+
+def make_card(index: int, photo: str, birthday: bool):
+    lines = ["BEGIN:VCARD", "VERSION:3.0", "UID:bench-%d" % index,
+             "FN:Contact %d" % index, "N:Contact;%d;;;" % index]
+    if birthday:
+        lines.append("BDAY:19%02d-%02d-%02d" %
+                     (index % 100, index % 12 + 1, index % 28 + 1))
+    if photo:
+        line = "PHOTO;ENCODING=b;TYPE=JPEG:" + photo
+        lines.append("\r\n ".join(line[i:i + 74] for
+                                  i in range(0, len(line), 74)))
+    lines.append("END:VCARD")
+    return "\r\n".join(lines) + "\r\n"
+
+
+class Collection:
+    """
+    Resources of a collection, with the revision log sync tokens point to
+    """
+    def __init__(self):
+        self.resources = {}
+        self.revision = 0
+        self.log = []
+        self.lock = threading.Lock()
+
+    def put(self, name: str, data: str):
+        with self.lock:
+            self.revision += 1
+            etag = '"%d"' % self.revision
+            self.resources[name] = (etag, data)
+            self.log.append((self.revision, name))
+            return etag
+
+    def delete(self, name: str):
+        with self.lock:
+            if self.resources.pop(name, None) is None:
+                return False
+            self.revision += 1
+            self.log.append((self.revision, name))
+            return True
+
+    def changes(self, since: int):
+        with self.lock:
+            names = {name for revision, name in self.log if
+                     revision > since}
+            return self.revision, names
+
+
+class Store:
+    """
+    The collections served, along with transfer statistics
+    """
+    def __init__(self, contacts: int, photo_size: int, birthdays: float,
+                 throttle: int = None, latency: float = 0):
+        self.collections = {"card": Collection(), "cal": Collection()}
+        self.stats = {"requests": 0, "bytes_in": 0, "bytes_out": 0,
+                      "throttled": 0}
+        self.throttle = throttle
+        self.latency = latency
+        self.serving = 0
+        self.lock = threading.Lock()
+
+        photo = base64.b64encode(os.urandom(photo_size)).decode("ascii")
+        born = random.Random(0)
+        for index in range(contacts):
+            card = make_card(index, photo, born.random() < birthdays)
+            self.collections["card"].put("%d.vcf" % index, card)
+
+    def count(self, bytes_in: int, bytes_out: int):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_in"] += bytes_in
+            self.stats["bytes_out"] += bytes_out
+
+    def enter(self):
+        with self.lock:
+            if self.throttle is not None and self.serving >= self.throttle:
+                self.stats["throttled"] += 1
+                return False
+            self.serving += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.serving -= 1
+
+    def pop_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            self.stats = dict.fromkeys(self.stats, 0)
+            return stats
+
+    def churn(self, rate: float, seed: int):
+        book = self.collections["card"]
+        changed = 0
+        rng = random.Random(seed)
+        for name, (_, card) in list(book.resources.items()):
+            if rng.random() >= rate or not BDAY_LINE.search(card):
+                continue
+            bday = "BDAY:19%02d-%02d-%02d" % (rng.randrange(100),
+                                              rng.randrange(12) + 1,
+                                              rng.randrange(28) + 1)
+            book.put(name, BDAY_LINE.sub(bday, card))
+            changed += 1
+        return changed
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def reply(self, code: int, body: bytes = b"", headers: dict = None,
+              counted: bool = True):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if len(body) >= GZIP_MIN_SIZE and \
+                "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=6)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command == "HEAD":
+            body = b""
+        self.wfile.write(body)
+        if counted:
+            self.server.store.count(self.body_size, len(body))
+
+    def reply_xml(self, root: ElementTree.Element):
+        body = b'<?xml version="1.0" encoding="utf-8"?>\n' + \
+            ElementTree.tostring(root, encoding="utf-8")
+        self.reply(207, body, {"Content-Type":
+                               "application/xml; charset=utf-8"})
+
+    def target(self):
+        parts = unquote(self.path.split("?", 1)[0]).strip("/").split("/")
+        collection = self.server.store.collections.get(parts[0])
+        name = parts[1] if len(parts) > 1 else None
+        return parts[0], collection, name
+
+    def dispatch(self, handler):
+        body = self.read_body()
+        self.body_size = len(body)
+        kind, collection, name = self.target()
+        if collection is None:
+            return self.reply(404)
+        store = self.server.store
+        if not store.enter():
+            return self.reply(429)
+        try:
+            time.sleep(store.latency)
+            handler(body, kind, collection, name)
+        finally:
+            store.leave()
+
+    def do_HEAD(self):
+        self.dispatch(lambda body, kind, collection, name: self.reply(200)
+                      if name is None else self.get(body, kind, collection,
+                                                    name))
+
+    def do_GET(self):
+        if self.path.startswith("/_stats"):
+            self.body_size = 0
+            stats = json.dumps(self.server.store.pop_stats())
+            return self.reply(200, stats.encode("utf-8"), counted=False)
+        self.dispatch(self.get)
+
+    def do_PUT(self):
+        self.dispatch(self.put)
+
+    def do_DELETE(self):
+        self.dispatch(self.delete)
+
+    def do_PROPFIND(self):
+        self.dispatch(self.propfind)
+
+    def do_REPORT(self):
+        self.dispatch(self.report)
+
+    def do_POST(self):
+        body = self.read_body()
+        self.body_size = len(body)
+        if not self.path.startswith("/_churn"):
+            return self.reply(405)
+        options = json.loads(body or b"{}")
+        changed = self.server.store.churn(options.get("rate", 0.01),
+                                          options.get("seed", 0))
+        self.reply(200, json.dumps({"changed": changed}).encode("utf-8"),
+                   counted=False)
+
+    def get(self, body, kind, collection, name):
+        resource = collection.resources.get(name)
+        if resource is None:
+            return self.reply(404)
+        self.reply(200, resource[1].encode("utf-8"),
+                   {"ETag": resource[0],
+                    "Content-Type": COLLECTIONS[kind][2]})
+
+    def precondition_failed(self, collection, name):
+        resource = collection.resources.get(name)
+        if_match = self.headers.get("If-Match")
+        if if_match is not None and \
+                (resource is None or resource[0] != if_match):
+            return True
+        return self.headers.get("If-None-Match") == "*" and \
+            resource is not None
+
+    def put(self, body, kind, collection, name):
+        if self.precondition_failed(collection, name):
+            return self.reply(412)
+        created = name not in collection.resources
+        etag = collection.put(name, body.decode("utf-8"))
+        self.reply(201 if created else 204, headers={"ETag": etag})
+
+    def delete(self, body, kind, collection, name):
+        if self.precondition_failed(collection, name):
+            return self.reply(412)
+        self.reply(204 if collection.delete(name) else 404)
+
+    def href(self, kind, name=None):
+        return "/%s/%s" % (kind, quote(name) if name else "")
+
+    def add_response(self, root, href, props=None, status="200 OK"):
+        response = ElementTree.SubElement(root, "{DAV:}response")
+        ElementTree.SubElement(response, "{DAV:}href").text = href
+        if props is None:
+            ElementTree.SubElement(response, "{DAV:}status").text = \
+                "HTTP/1.1 %s" % status
+            return
+        propstat = ElementTree.SubElement(response, "{DAV:}propstat")
+        prop = ElementTree.SubElement(propstat, "{DAV:}prop")
+        for tag, value in props:
+            element = ElementTree.SubElement(prop, tag)
+            if isinstance(value, ElementTree.Element):
+                element.append(value)
+            elif value is not None:
+                element.text = value
+        ElementTree.SubElement(propstat, "{DAV:}status").text = \
+            "HTTP/1.1 %s" % status
+
+    def propfind(self, body, kind, collection, name):
+        root = ElementTree.Element("{DAV:}multistatus")
+        if name is not None:
+            resource = collection.resources.get(name)
+            if resource is None:
+                return self.reply(404)
+            self.add_response(root, self.href(kind, name),
+                              [("{DAV:}getetag", resource[0])])
+            return self.reply_xml(root)
+
+        token = "http://birthdav.bench/sync/%d" % collection.revision
+        self.add_response(root, self.href(kind), [
+            ("{DAV:}resourcetype",
+             ElementTree.Element("{DAV:}collection")),
+            ("{%s}getctag" % CALENDARSERVER, str(collection.revision)),
+            ("{DAV:}sync-token", token),
+        ])
+        if self.headers.get("Depth", "1") != "0":
+            for member, (etag, data) in list(collection.resources.items()):
+                self.add_response(root, self.href(kind, member), [
+                    ("{DAV:}resourcetype", None),
+                    ("{DAV:}getetag", etag),
+                    ("{DAV:}getcontentlength", str(len(data))),
+                    ("{DAV:}getcontenttype", COLLECTIONS[kind][2]),
+                ])
+        self.reply_xml(root)
+
+    def report(self, body, kind, collection, name):
+        try:
+            query = ElementTree.fromstring(body)
+        except ElementTree.ParseError:
+            return self.reply(400)
+
+        data_name, data_ns, _ = COLLECTIONS[kind]
+        data_tag = "{%s}%s" % (data_ns, data_name)
+        root = ElementTree.Element("{DAV:}multistatus")
+        resources = dict(collection.resources)
+
+        if query.tag == "{DAV:}sync-collection":
+            return self.sync_collection(query, kind, collection, root)
+        if query.tag.endswith("-multiget"):
+            names = [unquote(href.text).rstrip("/").rsplit("/", 1)[-1]
+                     for href in query.iter("{DAV:}href")]
+        elif query.tag.endswith("-query"):
+            names = [n for n, (_, data) in resources.items() if
+                     self.matches(query, data)]
+        else:
+            return self.reply(501)
+
+        send_data = query.find("{DAV:}prop/%s" % data_tag) is not None
+        for member in names:
+            if member not in resources:
+                self.add_response(root, self.href(kind, member),
+                                  status="404 Not Found")
+                continue
+            etag, data = resources[member]
+            props = [("{DAV:}getetag", etag)]
+            if send_data:
+                props.append((data_tag, data))
+            self.add_response(root, self.href(kind, member), props)
+        self.reply_xml(root)
+
+    @staticmethod
+    def matches(query, data: str):
+        for prop_filter in query.iter():
+            if not prop_filter.tag.endswith("}prop-filter"):
+                continue
+            text = prop_filter.findtext("{*}text-match")
+            wanted = text if text is not None else \
+                "\n%s" % prop_filter.get("name")
+            if wanted not in data:
+                return False
+        return True
+
+    def sync_collection(self, query, kind, collection, root):
+        token = query.findtext("{DAV:}sync-token") or ""
+        try:
+            since = int(token.rsplit("/", 1)[-1]) if token else 0
+        except ValueError:
+            error = b'<d:error xmlns:d="DAV:"><d:valid-sync-token/></d:error>'
+            return self.reply(403, error)
+
+        revision, names = collection.changes(since)
+        for member in sorted(names):
+            resource = collection.resources.get(member)
+            if resource is None:
+                self.add_response(root, self.href(kind, member),
+                                  status="404 Not Found")
+            else:
+                self.add_response(root, self.href(kind, member),
+                                  [("{DAV:}getetag", resource[0])])
+        ElementTree.SubElement(root, "{DAV:}sync-token").text = \
+            "http://birthdav.bench/sync/%d" % revision
+        self.reply_xml(root)
+
+
+def serve(store: Store, port: int = 0, ready=None):
+    """
+    Serves a store until the process is terminated, reporting the port on
+    the `ready` queue
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.store = store
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
@@ -17,14 +17,34 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
-from birthdav.dav import get_client
-from birthdav.sync import sync_birthdays
+from birthdav.metrics import export
+from birthdav import __version__
 
-from webdav3.exceptions import ResponseErrorCode
 from urllib.parse import urlparse
 import sys
 import os
 
+try:
+    import tomllib
+except ImportError:  # pragma: no cover
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+
+# Sync options which configuration files may set, with their type and, for
+# integers, their minimum value
+SYNC_OPTIONS = {
+    "fetch_workers": (int, 1),
+    "reports": (bool, None),
+    "state_path": (str, None),
+    "delta": (bool, None),
+    "write_workers": (int, 1),
+    "write_retries": (int, 0),
+    "feed": (str, None),
+}
+
 
 class ConfigurationError(Exception):
     """
@@ -33,10 +53,101 @@ class ConfigurationError(Exception):
     pass
 
 
+def get_int(name: str, default: int, minimum: int = 1):
+    """
+    Reads an integer no lower than `minimum` from the environment
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = minimum - 1
+
+    if number < minimum:
+        msg = "invalid value for %s: %s" % (name, value)
+        raise ConfigurationError(msg)
+    return number
+
+
+def get_bool(name: str, default: bool):
+    """
+    Reads a boolean flag from the environment
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off"):
+        return False
+
+    msg = "invalid value for %s: %s" % (name, value)
+    raise ConfigurationError(msg)
+
+
+def get_sync_config():
+    """
+    Fetches sync options from the environment
+    """
+    sync = {
+        "fetch_workers": get_int("BIRTHDAV_FETCH_WORKERS", 4),
+        "reports": get_bool("BIRTHDAV_REPORTS", True),
+        "state_path": os.environ.get("BIRTHDAV_STATE_PATH"),
+        "delta": get_bool("BIRTHDAV_DELTA_SYNC", False),
+        "write_workers": get_int("BIRTHDAV_WRITE_WORKERS", 4),
+        "write_retries": get_int("BIRTHDAV_WRITE_RETRIES", 1, minimum=0),
+        "feed": os.environ.get("BIRTHDAV_FEED"),
+    }
+    return sync
+
+
+def get_http_config(sync: dict):
+    """
+    Fetches the HTTP session settings from the environment
+
+    Unless set, the connection pool holds as many connections as there are
+    fetch or write workers, whichever are more numerous.
+    """
+    workers = max(sync["fetch_workers"], sync["write_workers"])
+    return {
+        "pool_size": get_int("BIRTHDAV_HTTP_POOL_SIZE", workers),
+        "compress": get_bool("BIRTHDAV_COMPRESSION", True),
+    }
+
+
+def get_metrics_config():
+    """
+    Fetches the metrics export settings from the environment
+    """
+    return {
+        "json_summary": get_bool("BIRTHDAV_METRICS_JSON", False),
+        "prometheus_path": os.environ.get("BIRTHDAV_PROMETHEUS_PATH"),
+    }
+
+
+def export_metrics(config: dict):  # pragma: no cover
+    """
+    Exports the metrics recorded so far, as configured
+    """
+    try:
+        export(**config)
+    except OSError as e:
+        print("could not export metrics: %s" % str(e), file=sys.stderr)
+
+
 def get_config():
     """
     Fetches configuration from the environment
     """
+    sync = get_sync_config()
+    if sync["delta"] and sync["state_path"] is None:
+        msg = "BIRTHDAV_DELTA_SYNC requires BIRTHDAV_STATE_PATH"
+        raise ConfigurationError(msg)
+
     try:
         return {
             "card": {
@@ -48,7 +159,12 @@ def get_config():
                 "url": urlparse(os.environ["BIRTHDAV_CAL_URL"]).geturl(),
                 "user": os.environ.get("BIRTHDAV_CAL_USER"),
                 "pass": os.environ.get("BIRTHDAV_CAL_PASS"),
-            }
+            },
+            "sync": sync,
+            "http": get_http_config(sync),
+            "watch": {
+                "interval": get_int("BIRTHDAV_WATCH_INTERVAL", None),
+            },
         }
     except ValueError as e:
         msg = "URL parsing error: %s" % str(e)
@@ -58,15 +174,208 @@ def get_config():
         raise ConfigurationError(msg)
 
 
+def get_sync_options(table: dict, where: str):
+    """
+    Checks the sync options set by a configuration file table
+    """
+    options = {}
+    for name, value in table.items():
+        if name not in SYNC_OPTIONS:
+            msg = "%s: unknown option: %s" % (where, name)
+            raise ConfigurationError(msg)
+
+        kind, minimum = SYNC_OPTIONS[name]
+        if type(value) is not kind or \
+                (minimum is not None and value < minimum):
+            msg = "%s: invalid value for %s: %r" % (where, name, value)
+            raise ConfigurationError(msg)
+        options[name] = value
+    return options
+
+
+def get_server_config(tenant: dict, key: str, where: str):
+    """
+    Reads the server details of a tenant from a configuration file table
+    """
+    server = tenant.get(key)
+    if not isinstance(server, dict) or "url" not in server:
+        msg = "%s: missing %s.url" % (where, key)
+        raise ConfigurationError(msg)
+
+    try:
+        return {
+            "url": urlparse(server["url"]).geturl(),
+            "user": server.get("user"),
+            "pass": server.get("pass"),
+        }
+    except (ValueError, AttributeError) as e:
+        msg = "%s: URL parsing error: %s" % (where, str(e))
+        raise ConfigurationError(msg)
+
+
+def get_tenants_config(path: str):
+    """
+    Fetches the configuration of many address book and calendar pairs
+
+    The TOML file at `path` lists tenants, each with `card` and `cal` tables
+    holding a url and optional user and pass keys. Sync options are taken
+    from the environment, then from the file's `sync` table, then from the
+    tenant's own table. `workers` is the number of tenants synced at once.
+    """
+    if tomllib is None:
+        msg = "BIRTHDAV_CONFIG requires Python 3.11 or the tomli package"
+        raise ConfigurationError(msg)
+    if os.environ.get("BIRTHDAV_WATCH_INTERVAL") is not None:
+        msg = "BIRTHDAV_WATCH_INTERVAL cannot be used with BIRTHDAV_CONFIG"
+        raise ConfigurationError(msg)
+
+    try:
+        with open(path, "rb") as config_file:
+            document = tomllib.load(config_file)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        msg = "could not read %s: %s" % (path, str(e))
+        raise ConfigurationError(msg)
+
+    defaults = get_sync_config()
+    defaults.update(get_sync_options(document.get("sync", {}), "sync"))
+
+    workers = document.get("workers", 4)
+    if type(workers) is not int or workers < 1:
+        msg = "invalid value for workers: %r" % (workers,)
+        raise ConfigurationError(msg)
+
+    tenants = []
+    state_paths = set()
+    for index, table in enumerate(document.get("tenants", [])):
+        if not isinstance(table, dict):
+            msg = "invalid tenant: %r" % (table,)
+            raise ConfigurationError(msg)
+        name = str(table.get("name", index + 1))
+        where = "tenant %s" % name
+        sync = dict(defaults)
+        sync.update(get_sync_options(
+            {k: v for k, v in table.items() if
+             k not in ("name", "card", "cal")}, where
+        ))
+
+        if sync["delta"] and sync["state_path"] is None:
+            msg = "%s: delta requires state_path" % where
+            raise ConfigurationError(msg)
+        if sync["state_path"] is not None:
+            if sync["state_path"] in state_paths:
+                msg = "%s: state_path shared with another tenant" % where
+                raise ConfigurationError(msg)
+            state_paths.add(sync["state_path"])
+
+        tenants.append({
+            "name": name,
+            "card": get_server_config(table, "card", where),
+            "cal": get_server_config(table, "cal", where),
+            "sync": sync,
+            "http": get_http_config(sync),
+        })
+
+    if not tenants:
+        msg = "no tenants in %s" % path
+        raise ConfigurationError(msg)
+    return {"workers": workers, "tenants": tenants}
+
+
+def get_command(args: list):
+    """
+    Determines what to do from the command-line arguments
+    """
+    if not args:
+        return "sync"
+    if len(args) == 1 and args[0] in ("--version", "--check-config"):
+        return args[0][2:]
+
+    msg = "usage: birthdav [--version | --check-config]"
+    raise ConfigurationError(msg)
+
+
+def check_config():  # pragma: no cover
+    """
+    Validates the configuration, without connecting to any server
+    """
+    get_metrics_config()
+    path = os.environ.get("BIRTHDAV_CONFIG")
+    if path is not None:
+        config = get_tenants_config(path)
+        print("configuration ok: %d tenant(s)" % len(config["tenants"]))
+    else:
+        get_config()
+        print("configuration ok")
+
+
+def main_tenants(path: str):  # pragma: no cover
+    """
+    Syncs every tenant of a configuration file and prints a summary
+    """
+    from birthdav.tenants import sync_tenants
+
+    config = get_tenants_config(path)
+    summary = sync_tenants(config["tenants"], config["workers"])
+    for result in summary:
+        if result["status"] == "ok":
+            print("%s: ok, %d operation(s) in %.1fs" %
+                  (result["name"], result["operations"], result["duration"]))
+        else:
+            print("%s: failed in %.1fs: %s" %
+                  (result["name"], result["duration"], str(result["error"])),
+                  file=sys.stderr)
+    if any(result["status"] != "ok" for result in summary):
+        exit(1)
+
+
+def main_single(config: dict, metrics: dict):  # pragma: no cover
+    """
+    Syncs an address book and a calendar once, or keeps watching them
+    """
+    # The clients and their dependencies are only imported here, so that
+    # configuration errors, --version and --check-config never load them
+    from birthdav.dav import get_client, get_session, FetchError
+    from birthdav.sync import sync_birthdays, ApplyError
+    from birthdav.watch import watch_birthdays
+    from webdav3.exceptions import ResponseErrorCode
+
+    try:
+        session = get_session(**config["http"])
+        card_client = get_client(config["card"], session)
+        cal_client = get_client(config["cal"], session)
+        interval = config["watch"]["interval"]
+        if interval is None:
+            sync_birthdays(card_client, cal_client, **config["sync"])
+        else:
+            watch_birthdays(card_client, cal_client, interval,
+                            on_sync=lambda: export_metrics(metrics),
+                            **config["sync"])
+    except (ResponseErrorCode, FetchError, ApplyError) as e:
+        print(str(e), file=sys.stderr)
+        exit(1)
+
+
 def main():  # pragma: no cover
+    metrics = {}
     try:
-        config = get_config()
-        card_client = get_client(config["card"])
-        cal_client = get_client(config["cal"])
-        sync_birthdays(card_client, cal_client)
-    except (ConfigurationError, ResponseErrorCode) as e:
+        command = get_command(sys.argv[1:])
+        if command == "version":
+            return print("birthdav %s" % __version__)
+        if command == "check-config":
+            return check_config()
+
+        metrics = get_metrics_config()
+        path = os.environ.get("BIRTHDAV_CONFIG")
+        if path is not None:
+            return main_tenants(path)
+        main_single(get_config(), metrics)
+    except ConfigurationError as e:
         print(str(e), file=sys.stderr)
         exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        export_metrics(metrics)
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from birthdav.metrics import METRICS
+from birthdav.state import StateStore
+from birthdav.dav import list_resources, fetch_vobject, is_transient, \
+    FetchError, FETCH_RETRIES
+from birthdav import sync
+from birthdav.sync import iter_triage, try_operation, finish_operation, \
+    load_operation, ApplyError
+from birthdav.throttle import ConcurrencyLimiter, get_retry_delay
+from birthdav.journal import OperationJournal, get_journal_path
+
+from concurrent.futures import ThreadPoolExecutor
+from webdav3.client import Client
+import functools
+import asyncio
+import time
+
+
+# Threads running blocking calls, apart from the default executor of the
+# event loop, which the application may need for its own jobs
+BLOCKING_WORKERS = 32
+EXECUTOR = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS,
+                              thread_name_prefix="birthdav")
+
+
+async def run_blocking(func, *args):
+    """
+    Runs a blocking function in birthdav's own executor
+
+    webdavclient3 only offers blocking requests: they are run in threads, and
+    the event loop remains free to schedule other requests or other jobs.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(EXECUTOR, functools.partial(func, *args))
+
+
+async def run_request(func, *args):
+    """
+    Runs a blocking request in a thread, attempting it again on transient
+    errors
+
+    `func` must make a single attempt: the event loop waits between attempts
+    without holding a thread, as told by get_retry_delay, and the last error
+    is raised once FETCH_RETRIES attempts were made again.
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            return await run_blocking(func, *args)
+        except Exception as e:
+            if attempts > FETCH_RETRIES or not is_transient(e):
+                raise
+            delay = get_retry_delay(e, attempts)
+        await asyncio.sleep(delay)
+
+
+async def attempt_operation(cal_client: Client, card_client: Client,
+                            operation: str, item, retries: int = 0,
+                            limiter: ConcurrencyLimiter = None,
+                            journal: OperationJournal = None):
+    """
+    Applies an operation, attempting it again on transient errors
+
+    See birthdav.sync.attempt_operation: each attempt is run in a thread,
+    and the event loop waits between attempts without holding one.
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        error = await run_blocking(try_operation, cal_client, card_client,
+                                   operation, item, limiter)
+        if error is not None and attempts <= retries and is_transient(error):
+            await asyncio.sleep(get_retry_delay(error, attempts))
+            continue
+        return await run_blocking(finish_operation, operation, item,
+                                  attempts, error, journal)
+
+
+async def get_vobjects(client: Client, workers: int = 1, names: list = None):
+    """
+    Fetches all .ics and .vcf files from a WebDAV server
+
+    At most `workers` downloads are in flight at once, and fewer while the
+    server asks to slow down. Transient failures are retried, and the event
+    loop waits between attempts without holding a thread. Objects are
+    returned in listing order, or in the order of `names`. Failures are
+    reported together, per resource, in a FetchError once all files went
+    through.
+    """
+    if names is None:
+        names = list(await run_request(list_resources, client, 0))
+
+    semaphore = asyncio.Semaphore(max(workers, 1))
+    limiter = ConcurrencyLimiter(workers, "fetch_concurrency")
+
+    async def fetch(name):
+        async with semaphore:
+            try:
+                return await run_request(fetch_vobject, client, name, None,
+                                         limiter, 0), None
+            except Exception as e:
+                return None, e
+
+    results = await asyncio.gather(*(fetch(name) for name in names))
+    errors = {name: e for name, (_, e) in zip(names, results) if
+              e is not None}
+    if errors:
+        raise FetchError(errors)
+    return [vobj for vobj, _ in results]
+
+
+async def get_born_contacts(card_client: Client, workers: int = 1,
+                            reports: bool = True, state: StateStore = None,
+                            delta: bool = False):
+    """
+    Fetches objects from a CardDAV client and returns contacts with birthdays
+
+    See birthdav.sync.get_born_contacts, which is run in a thread.
+    """
+    return await run_blocking(sync.get_born_contacts, card_client, workers,
+                              reports, state, delta)
+
+
+async def get_events(cal_client: Client, card_client: Client,
+                     workers: int = 1, reports: bool = True,
+                     state: StateStore = None, delta: bool = False):
+    """
+    Fetches birthdav birthdays from a CalDAV client
+
+    See birthdav.sync.get_events, which is run in a thread.
+    """
+    return await run_blocking(sync.get_events, cal_client, card_client,
+                              workers, reports, state, delta)
+
+
+async def apply_operations(cal_client: Client, card_client: Client,
+                           operations, workers: int = 1, retries: int = 0,
+                           journal: OperationJournal = None):
+    """
+    Applies operations, as yielded by iter_triage, with at most `workers`
+    writes in flight
+
+    See birthdav.sync.apply_operations: results are returned in the order of
+    the operations, failed operations do not interrupt the others, fewer
+    writes are sent at once while the server asks to slow down and the
+    operations held by `journal`, if any, are removed from it as they
+    succeed.
+    """
+    semaphore = asyncio.Semaphore(max(workers, 1))
+    limiter = ConcurrencyLimiter(workers)
+    tasks = []
+    for operation, item in operations:
+        await semaphore.acquire()
+        task = asyncio.ensure_future(attempt_operation(
+            cal_client, card_client, operation, item, retries, limiter,
+            journal
+        ))
+        task.add_done_callback(lambda _: semaphore.release())
+        tasks.append(task)
+    return list(await asyncio.gather(*tasks))
+
+
+async def apply_diffs(cal_client: Client, card_client: Client,
+                      new: dict, lost: dict, updated: dict,
+                      workers: int = 1, retries: int = 0):
+    """
+    Applies contact changes to the associated CalDAV birthday events
+    """
+    operations = [("new", item) for item in new] + \
+        [("lost", item) for item in lost] + \
+        [("updated", item) for item in updated]
+    return await apply_operations(cal_client, card_client, operations,
+                                  workers, retries)
+
+
+async def resume_operations(cal_client: Client, card_client: Client,
+                            journal: OperationJournal, workers: int = 1,
+                            retries: int = 0):
+    """
+    Applies the operations left in the journal, and finishes its plan
+
+    See birthdav.sync.resume_operations.
+    """
+    operations = [load_operation(operation, payload) for operation, payload
+                  in await run_blocking(journal.get_operations)]
+    results = await apply_operations(cal_client, card_client, operations,
+                                     workers, retries, journal)
+    await run_blocking(journal.finish_plan)
+    return results
+
+
+async def sync_birthdays(card_client: Client, cal_client: Client,
+                         fetch_workers: int = 1, reports: bool = True,
+                         state_path: str = None, delta: bool = False,
+                         write_workers: int = 1, write_retries: int = 0,
+                         feed: str = None):
+    """
+    Fetches contacts and events and syncs them
+
+    This is the asyncio counterpart of birthdav.sync.sync_birthdays, taking
+    the same parameters: the address book and the calendar are fetched at
+    the same time, then changes are applied. The event loop is never blocked
+    by requests or by the state store. With a state store, operations are
+    applied from a journal, and what is left of an interrupted run's plan is
+    applied without fetching anything. With a `feed` name, all birthdays are
+    written to that single calendar resource instead.
+    """
+    if delta and state_path is None:
+        raise ValueError("delta sync requires a state_path")
+
+    state = journal = None
+    if state_path is not None:
+        state = await run_blocking(StateStore, state_path)
+        journal = await run_blocking(OperationJournal,
+                                     get_journal_path(state_path),
+                                     cal_client.webdav.hostname)
+
+    with METRICS.timed("sync"):
+        try:
+            if delta:
+                state.track_changed_uids()
+            if journal is not None and \
+                    await run_blocking(journal.is_planned):
+                results = await resume_operations(cal_client, card_client,
+                                                  journal, write_workers,
+                                                  write_retries)
+            elif feed is not None:
+                contacts = await get_born_contacts(card_client, fetch_workers,
+                                                   reports, state, delta)
+                operations = await run_blocking(sync.triage_feed, cal_client,
+                                                card_client, feed, contacts,
+                                                state)
+                results = await apply_operations(cal_client, card_client,
+                                                 operations, write_workers,
+                                                 write_retries)
+            else:
+                if journal is not None:
+                    state.add_changed_uids(await run_blocking(
+                        sync.get_leftover_uids, journal
+                    ))
+                # Both fetches run to completion before any error is raised,
+                # so that the state store is not closed while one of them
+                # uses it
+                fetched = await asyncio.gather(
+                    get_born_contacts(card_client, fetch_workers, reports,
+                                      state, delta),
+                    get_events(cal_client, card_client, fetch_workers,
+                               reports, state, delta),
+                    return_exceptions=True
+                )
+                for result in fetched:
+                    if isinstance(result, Exception):
+                        raise result
+                contacts, events = fetched
+
+                relevant = state.may_have_changed if delta else None
+                operations = iter_triage(contacts.items(), events, relevant)
+                if journal is None:
+                    results = await apply_operations(
+                        cal_client, card_client, operations, write_workers,
+                        write_retries
+                    )
+                else:
+                    await run_blocking(sync.plan_operations, journal,
+                                       operations)
+                    await run_blocking(state.commit)
+                    results = await resume_operations(
+                        cal_client, card_client, journal, write_workers,
+                        write_retries
+                    )
+            if any(result["status"] == "failed" for result in results):
+                raise ApplyError(results)
+            if state is not None:
+                await run_blocking(state.commit)
+            METRICS.set("last_success_timestamp_seconds", time.time())
+            return results
+        finally:
+            if state is not None:
+                await run_blocking(state.close)
+                await run_blocking(journal.close)
@@ -17,14 +17,155 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
-from tempfile import NamedTemporaryFile
+from birthdav.metrics import METRICS
+from birthdav.local import LocalClient
+from birthdav.throttle import ThrottledError, ConcurrencyLimiter, \
+    get_retry_delay
+
+from webdav3.exceptions import MethodNotSupported, ResponseErrorCode, \
+    ConnectionException, NoConnection, RemoteResourceNotFound
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from collections import deque
+from urllib.parse import unquote, urlsplit
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from xml.etree import ElementTree
 from webdav3.client import Client
+from webdav3.urn import Urn
+from requests.adapters import HTTPAdapter
 import platform
+import requests
 import vobject
+import time
 import ssl
 import os
 
 
+CARDDAV = "urn:ietf:params:xml:ns:carddav"
+CALDAV = "urn:ietf:params:xml:ns:caldav"
+CALENDARSERVER = "http://calendarserver.org/ns/"
+
+# Extensions of the files birthdav handles in collections
+VOBJECT_EXTENSIONS = (".vcf", ".ics")
+
+# Number of resources requested at once in multiget REPORT requests
+MULTIGET_BATCH_SIZE = 100
+
+# Status codes with which servers turn down REPORT requests they do not support
+REPORT_UNSUPPORTED_CODES = (400, 403, 415, 422, 501)
+
+# Status codes signalling a temporary failure, worth attempting again
+TRANSIENT_CODES = (408, 429, 500, 502, 503, 504)
+
+# Status codes with which servers ask clients to slow down
+THROTTLE_CODES = (429, 503)
+
+# Connections kept open per server, as with requests' own default adapter
+HTTP_POOL_SIZE = 10
+
+# Attempts made again after a temporary failure to fetch resources
+FETCH_RETRIES = 2
+
+
+class ReportError(Exception):
+    """
+    Raised when a server does not support or mishandles a DAV REPORT request
+    """
+    pass
+
+
+class SyncTokenError(Exception):
+    """
+    Raised when a server no longer accepts a collection's sync token
+    """
+    pass
+
+
+class FetchError(Exception):
+    """
+    Raised when one or more resources could not be fetched from a server
+    """
+    def __init__(self, errors: dict):
+        self.errors = errors
+        details = "; ".join("%s: %s" % (path, str(e))
+                            for path, e in errors.items())
+        super().__init__("failed to fetch %d resource(s): %s" %
+                         (len(errors), details))
+
+
+def is_transient(error: Exception):
+    """
+    Determines whether a failed request may succeed if attempted again
+    """
+    if isinstance(error, ResponseErrorCode):
+        return error.code in TRANSIENT_CODES
+    return isinstance(error, (ConnectionException, NoConnection,
+                              requests.ConnectionError, requests.Timeout))
+
+
+def send_request(func, *args, retries: int = FETCH_RETRIES,
+                 limiter: ConcurrencyLimiter = None, **kwargs):
+    """
+    Sends a request with the given function, attempting it again on transient
+    errors
+
+    Attempts are spaced out as told by get_retry_delay, and made from a slot
+    of `limiter`, if any. The last error is raised once `retries` attempts
+    were made again.
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            if limiter is None:
+                return func(*args, **kwargs)
+            with limiter.slot():
+                return func(*args, **kwargs)
+        except Exception as e:
+            if attempts > retries or not is_transient(e):
+                raise
+            time.sleep(get_retry_delay(e, attempts))
+
+
+def parse_retry_after(value: str):
+    """
+    Reads the delay, in seconds, of a Retry-After header
+
+    The header holds either a number of seconds or an HTTP date. None is
+    returned when it is missing or invalid.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def raise_throttled(response, *args, **kwargs):
+    """
+    Raises a ThrottledError for responses asking to slow down
+
+    This is a requests response hook, run before webdavclient3 turns the
+    response into a plain ResponseErrorCode, which would not hold the
+    Retry-After delay.
+    """
+    if response.status_code in THROTTLE_CODES:
+        METRICS.add("throttled_total")
+        raise ThrottledError(
+            response.url, response.status_code, response.content,
+            parse_retry_after(response.headers.get("Retry-After"))
+        )
+
+
 def get_requests_verify():
     """
     Identifies the path to the system's certificate authority bundle
@@ -62,10 +203,40 @@ def get_requests_verify():
         return True
 
 
-def get_client(config: dict):
+def get_session(pool_size: int = HTTP_POOL_SIZE, compress: bool = True):
+    """
+    Builds an HTTP session, meant to be shared by the clients of a sync
+
+    Connections are kept alive, and up to `pool_size` of them are kept open
+    per server: when the pool is smaller than the number of workers, the
+    connections opened on top of it are closed after a single request, and
+    each of their replacements costs a new TCP and TLS handshake. Clients
+    sharing a session also share the connections to a server hosting both
+    collections. Compressed responses are accepted unless `compress` is
+    false. Responses asking to slow down raise a ThrottledError.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not compress:
+        session.headers["Accept-Encoding"] = "identity"
+    session.hooks["response"].append(METRICS.record_response)
+    session.hooks["response"].append(raise_throttled)
+    return session
+
+
+def get_client(config: dict, session: requests.Session = None):
     """
     Builds and returns a WebDAV client
+
+    The client sends its requests through `session`, or through a session of
+    its own built by get_session. file:// URLs point to local vdir
+    collections, for which a LocalClient is returned instead.
     """
+    if urlsplit(config["url"]).scheme == "file":
+        return LocalClient(config["url"])
+
     client = Client({
         "webdav_hostname": config["url"],
         "webdav_login": config["user"],
@@ -73,20 +244,488 @@ def get_client(config: dict):
     })
 
     client.verify = get_requests_verify()
+    client.session = session or get_session()
+    client.requests["report"] = "REPORT"
+    client.http_header["report"] = [
+        "Accept: */*",
+        "Depth: 1",
+        "Content-Type: application/xml; charset=utf-8",
+    ]
     return client
 
 
-def get_vobjects(client: Client):
+def fetch_vobject(client: Client, path: str, parse=None,
+                  limiter: ConcurrencyLimiter = None,
+                  retries: int = FETCH_RETRIES):
+    """
+    Downloads and parses a single .ics or .vcf file from a WebDAV server
+
+    The file is read straight from the response body: there is no temporary
+    file, nor any of the PROPFIND and HEAD checks Client.download would send
+    before the actual GET request. Transient failures are retried, see
+    send_request. Files are parsed by vobject, unless another `parse`
+    function is given.
+    """
+    with METRICS.timed("download"):
+        response = send_request(client.execute_request, "download",
+                                Urn(path).quote(), retries=retries,
+                                limiter=limiter)
+        content = response.content.decode("utf-8")
+    with METRICS.timed("parse"):
+        return (parse or vobject.readOne)(content)
+
+
+def get_conditions(if_match: str = None, if_none_match: str = None):
+    """
+    Builds the precondition headers of a conditional request
+    """
+    headers = []
+    if if_match is not None:
+        headers.append("If-Match: %s" % if_match)
+    if if_none_match is not None:
+        headers.append("If-None-Match: %s" % if_none_match)
+    return headers
+
+
+def is_precondition_failure(error: Exception):
+    """
+    Determines whether a request failed because one of its conditions did
+    """
+    return isinstance(error, ResponseErrorCode) and error.code == 412
+
+
+def refetch_vobject(client: Client, path: str, parse=None):
+    """
+    Downloads and parses a single file along with its current ETag
+
+    Returns None and no ETag when the file no longer exists.
+    """
+    try:
+        with METRICS.timed("download"):
+            response = client.execute_request("download", Urn(path).quote())
+            content = response.content.decode("utf-8")
+    except RemoteResourceNotFound:
+        return None, None
+    with METRICS.timed("parse"):
+        return (parse or vobject.readOne)(content), \
+            response.headers.get("ETag")
+
+
+def fetch_etag(client: Client, path: str):
+    """
+    Fetches the current ETag of a single file, without downloading it
+
+    A HEAD request is sent. Returns None when the file does not exist, or
+    when the server does not tell its ETag.
+    """
+    try:
+        with METRICS.timed("check"):
+            response = send_request(client.execute_request, "check",
+                                    Urn(path).quote())
+    except RemoteResourceNotFound:
+        return None
+    return response.headers.get("ETag")
+
+
+def upload_vobject(client: Client, path: str, vobj, if_match: str = None,
+                   if_none_match: str = None):
+    """
+    Serializes and uploads a single .ics or .vcf file to a WebDAV server
+
+    The upload is conditional when `if_match` (an ETag) or `if_none_match`
+    ("*" to only create the file) is given: the server answers with a 412
+    status code if the condition does not hold. Returns the new ETag of the
+    file, if the server sent it.
+    """
+    data = vobj.serialize().encode("utf-8")
+    with METRICS.timed("upload"):
+        response = client.execute_request(
+            "upload", Urn(path).quote(), data=data,
+            headers_ext=get_conditions(if_match, if_none_match)
+        )
+    return response.headers.get("ETag")
+
+
+def delete_vobject(client: Client, path: str, if_match: str = None):
+    """
+    Deletes a single .ics or .vcf file from a WebDAV server
+
+    The deletion only happens if the file still has the `if_match` ETag,
+    when given. Files which no longer exist are considered deleted.
+    """
+    try:
+        with METRICS.timed("delete"):
+            client.execute_request("clean", Urn(path).quote(),
+                                   headers_ext=get_conditions(if_match))
+    except RemoteResourceNotFound:
+        pass
+
+
+def list_resources(client: Client, retries: int = FETCH_RETRIES):
+    """
+    Lists the .ics and .vcf files of a collection along with their ETags
+
+    Transient failures are retried, see send_request.
+    """
+    with METRICS.timed("list"):
+        infos = send_request(client.list, get_info=True, retries=retries)
+    return {get_resource_name(info["path"]): info.get("etag") for
+            info in infos if
+            not info.get("isdir") and
+            info["path"][-4:] in VOBJECT_EXTENSIONS}
+
+
+def iter_vobjects(client: Client, workers: int = 1, names: list = None,
+                  parse=None):
+    """
+    Fetches .ics and .vcf files from a WebDAV server as (name, object) pairs
+
+    Downloads are spread over a pool of at most `workers` threads, which never
+    gets more than twice as many files ahead of the consumer, and fewer of
+    them are sent at once while the server asks to slow down. Objects are
+    yielded in listing order, or in the order of `names` when only some files
+    should be fetched. Failures do not interrupt the other downloads: once all
+    files went through, they are reported together, per resource, in a
+    FetchError.
+    """
+    if names is None:
+        with METRICS.timed("list"):
+            names = [vcf for vcf in send_request(client.list) if
+                     vcf[-4:] in VOBJECT_EXTENSIONS]
+
+    workers = max(workers, 1)
+    names = iter(names)
+    errors = {}
+    limiter = ConcurrencyLimiter(workers, "fetch_concurrency")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque((n, pool.submit(fetch_vobject, client, n, parse,
+                                        limiter))
+                        for n in islice(names, 2 * workers))
+        while pending:
+            name, future = pending.popleft()
+            pending.extend((n, pool.submit(fetch_vobject, client, n, parse,
+                                           limiter))
+                           for n in islice(names, 1))
+            try:
+                vobj = future.result()
+            except Exception as e:
+                errors[name] = e
+                continue
+            yield name, vobj
+
+    if errors:
+        raise FetchError(errors)
+
+
+def get_vobjects(client: Client, workers: int = 1, names: list = None):
     """
     Fetches all .ics and .vcf files from a WebDAV server
+
+    See iter_vobjects, this returns the objects alone in a list.
+    """
+    return [vobj for _, vobj in iter_vobjects(client, workers, names)]
+
+
+def get_resource_name(href: str):
+    """
+    Extracts a resource's file name from the href returned by the server
+    """
+    return unquote(urlsplit(href).path.rstrip("/").rsplit("/", 1)[-1])
+
+
+def send_report(client: Client, body: bytes, depth: str = "1"):
+    """
+    Sends a REPORT request to a collection and parses its XML response
+
+    A ReportError is raised when the server does not seem to support the
+    request, so that callers may fall back on listing the collection instead.
+    Transient failures are retried, see send_request.
+    """
+    root = Urn(Urn.separate, directory=True).quote()
+    try:
+        with METRICS.timed("report"):
+            response = send_request(client.execute_request, "report", root,
+                                    data=body,
+                                    headers_ext=["Depth: %s" % depth])
+            return ElementTree.fromstring(response.content)
+    except MethodNotSupported as e:
+        raise ReportError(str(e))
+    except ResponseErrorCode as e:
+        if e.code not in REPORT_UNSUPPORTED_CODES:
+            raise
+        raise ReportError(str(e))
+    except ElementTree.ParseError as e:
+        raise ReportError("invalid REPORT response: %s" % str(e))
+
+
+def get_status_code(status: str):
+    """
+    Extracts the code from a multistatus status line
+    """
+    status = (status or "").split()
+    return status[1] if len(status) > 1 else None
+
+
+def report(client: Client, body: bytes, data_tag: str):
+    """
+    Sends a REPORT request to a collection and parses the multistatus response
+
+    Returns a list of (name, etag, data) tuples, one per resource for which the
+    server returned its data. A ReportError is raised when the server
+    truncated the results, marking the collection with a 507 status, since
+    the missing resources would otherwise be taken for deleted ones.
+    """
+    tree = send_report(client, body)
+    resources = []
+    for resource in tree.iter("{DAV:}response"):
+        href = resource.findtext("{DAV:}href")
+        if get_status_code(resource.findtext("{DAV:}status")) == "507":
+            raise ReportError("truncated REPORT response")
+        for propstat in resource.findall("{DAV:}propstat"):
+            status = get_status_code(propstat.findtext("{DAV:}status"))
+            data = propstat.findtext("{DAV:}prop/%s" % data_tag)
+            if status == "200" and data:
+                etag = propstat.findtext("{DAV:}prop/{DAV:}getetag")
+                resources.append((get_resource_name(href), etag, data))
+    return resources
+
+
+def parse_vobjects(resources: list, parse=None):
+    """
+    Parses the resources returned by a REPORT request as (name, object) pairs
+
+    Resources are parsed one at a time, as the pairs are consumed. Parsing
+    errors are reported together, per resource, in a FetchError once every
+    resource went through.
+    """
+    errors = {}
+    for name, _, data in resources:
+        try:
+            with METRICS.timed("parse"):
+                vobj = (parse or vobject.readOne)(data)
+        except Exception as e:
+            errors[name] = e
+            continue
+        yield name, vobj
+
+    if errors:
+        raise FetchError(errors)
+
+
+def report_vobjects(client: Client, body: bytes, data_tag: str,
+                    parse=None, etags: dict = None):
+    """
+    Sends a REPORT request and returns its objects as (name, object) pairs
+
+    The request is sent right away, so that a ReportError is raised by this
+    function rather than while iterating over its results. When given,
+    `etags` is filled with the ETags of the objects, by name.
+    """
+    resources = report(client, body, data_tag)
+    if etags is not None:
+        etags.update((name, etag) for name, etag, _ in resources)
+    return parse_vobjects(resources, parse)
+
+
+def serialize_xml(root: ElementTree.Element):
+    """
+    Serializes an XML request body
+    """
+    return b'<?xml version="1.0" encoding="utf-8"?>\n' + \
+        ElementTree.tostring(root, encoding="utf-8")
+
+
+def query_cards(client: Client, prop_name: str, parse=None):
+    """
+    Fetches the vCards which define a property using an addressbook-query
+
+    Filtering is done server-side: vCards lacking the property are never
+    transferred, and the whole address book comes back in a single response.
+    The vCards are returned as (name, object) pairs, parsed as they are
+    consumed.
     """
-    vfiles = [vcf for vcf in client.list() if vcf[-4:] in (".vcf", ".ics")]
-    vobjects = []
-    for vcf_file in vfiles:
-        tmp_file_w = NamedTemporaryFile("w", delete=False)
-        client.download(vcf_file, tmp_file_w.name)
-        tmp_file_w.close()
-        with open(tmp_file_w.name) as tmp_file_r:
-            vobjects.append(vobject.readOne(tmp_file_r))
-        os.unlink(tmp_file_w.name)
-    return vobjects
+    query = ElementTree.Element("{%s}addressbook-query" % CARDDAV)
+    props = ElementTree.SubElement(query, "{DAV:}prop")
+    ElementTree.SubElement(props, "{DAV:}getetag")
+    ElementTree.SubElement(props, "{%s}address-data" % CARDDAV)
+    card_filter = ElementTree.SubElement(query, "{%s}filter" % CARDDAV)
+    ElementTree.SubElement(card_filter, "{%s}prop-filter" % CARDDAV,
+                           name=prop_name)
+
+    return report_vobjects(client, serialize_xml(query),
+                           "{%s}address-data" % CARDDAV, parse)
+
+
+def build_event_query(prop_filters: dict, data: bool = True):
+    """
+    Builds a calendar-query matching calendar level property filters
+
+    See query_events for the filters. Without `data`, the query only asks for
+    the ETags of the matching calendars.
+    """
+    query = ElementTree.Element("{%s}calendar-query" % CALDAV)
+    props = ElementTree.SubElement(query, "{DAV:}prop")
+    ElementTree.SubElement(props, "{DAV:}getetag")
+    if data:
+        ElementTree.SubElement(props, "{%s}calendar-data" % CALDAV)
+    cal_filter = ElementTree.SubElement(query, "{%s}filter" % CALDAV)
+    comp_filter = ElementTree.SubElement(cal_filter,
+                                         "{%s}comp-filter" % CALDAV,
+                                         name="VCALENDAR")
+    for prop_name, text in prop_filters.items():
+        prop_filter = ElementTree.SubElement(comp_filter,
+                                             "{%s}prop-filter" % CALDAV,
+                                             name=prop_name)
+        if text is not None:
+            ElementTree.SubElement(prop_filter, "{%s}text-match" % CALDAV,
+                                   collation="i;octet").text = text
+    return query
+
+
+def query_events(client: Client, prop_filters: dict, etags: dict = None):
+    """
+    Fetches the calendars matching property filters using a calendar-query
+
+    Filters are given as a dictionary of property names to the text they must
+    contain, or None if they only have to be defined. They apply to calendar
+    level properties, and the server only returns matching calendars. These
+    are returned as (name, object) pairs, parsed as they are consumed, and
+    their ETags are added to `etags`, when given.
+    """
+    query = build_event_query(prop_filters)
+    return report_vobjects(client, serialize_xml(query),
+                           "{%s}calendar-data" % CALDAV, etags=etags)
+
+
+def list_events(client: Client, prop_filters: dict):
+    """
+    Lists the calendars matching property filters along with their ETags
+
+    This is query_events without the calendar data, see list_resources for the
+    result. A ReportError is raised when the server does not support it.
+    """
+    query = build_event_query(prop_filters, data=False)
+    with METRICS.timed("list"):
+        resources = report(client, serialize_xml(query), "{DAV:}getetag")
+    return {name: etag for name, etag, _ in resources if
+            name[-4:] in VOBJECT_EXTENSIONS}
+
+
+def multiget(client: Client, names: list, query_tag: str, data_tag: str,
+             parse=None, batch_size: int = MULTIGET_BATCH_SIZE):
+    """
+    Fetches resources by batches of multiget REPORT requests, by file name
+
+    Resources are yielded as (name, object) pairs, one batch at a time, and
+    those the server could not find are left out of the results.
+    """
+    for start in range(0, len(names), batch_size):
+        query = ElementTree.Element(query_tag)
+        props = ElementTree.SubElement(query, "{DAV:}prop")
+        ElementTree.SubElement(props, "{DAV:}getetag")
+        ElementTree.SubElement(props, data_tag)
+        for name in names[start:start + batch_size]:
+            href = urlsplit(client.get_url(Urn(name).quote())).path
+            ElementTree.SubElement(query, "{DAV:}href").text = href
+        yield from report_vobjects(client, serialize_xml(query), data_tag,
+                                   parse)
+
+
+def multiget_cards(client: Client, names: list, parse=None):
+    """
+    Fetches vCards using addressbook-multiget REPORT requests, by file name
+    """
+    return multiget(client, names, "{%s}addressbook-multiget" % CARDDAV,
+                    "{%s}address-data" % CARDDAV, parse)
+
+
+def multiget_events(client: Client, names: list, parse=None):
+    """
+    Fetches calendars using calendar-multiget REPORT requests, by file name
+    """
+    return multiget(client, names, "{%s}calendar-multiget" % CALDAV,
+                    "{%s}calendar-data" % CALDAV, parse)
+
+
+def sync_collection(client: Client, token: str = None):
+    """
+    Lists the changes made to a collection since a sync token (RFC 6578)
+
+    Returns the new sync token, the changed .ics and .vcf files along with
+    their ETags, and the deleted ones. Without a token, every file is listed
+    as changed. A SyncTokenError is raised when the server no longer accepts
+    the token, in which case the whole collection has to be synced again.
+    """
+    changed, deleted = {}, set()
+    truncated = True
+    while truncated:
+        query = ElementTree.Element("{DAV:}sync-collection")
+        ElementTree.SubElement(query, "{DAV:}sync-token").text = token
+        ElementTree.SubElement(query, "{DAV:}sync-level").text = "1"
+        props = ElementTree.SubElement(query, "{DAV:}prop")
+        ElementTree.SubElement(props, "{DAV:}getetag")
+
+        try:
+            tree = send_report(client, serialize_xml(query), depth="0")
+        except (ReportError, ResponseErrorCode) as e:
+            if token is not None and "valid-sync-token" in str(e):
+                raise SyncTokenError(str(e))
+            raise
+
+        truncated = False
+        for resource in tree.iter("{DAV:}response"):
+            name = get_resource_name(resource.findtext("{DAV:}href", ""))
+            status = get_status_code(resource.findtext("{DAV:}status"))
+            if status == "507":
+                truncated = True
+            elif name[-4:] not in VOBJECT_EXTENSIONS:
+                continue
+            elif status == "404":
+                changed.pop(name, None)
+                deleted.add(name)
+            else:
+                deleted.discard(name)
+                changed[name] = resource.findtext(
+                    "{DAV:}propstat/{DAV:}prop/{DAV:}getetag"
+                )
+
+        token = tree.findtext("{DAV:}sync-token")
+    return token, changed, deleted
+
+
+def get_collection_tag(client: Client):
+    """
+    Fetches a tag which changes whenever the contents of a collection do
+
+    A single PROPFIND request asks for both the collection's CTag and its
+    RFC 6578 sync token, the former being preferred. None is returned when the
+    server exposes neither, in which case changes cannot be detected cheaply.
+    """
+    query = ElementTree.Element("{DAV:}propfind")
+    props = ElementTree.SubElement(query, "{DAV:}prop")
+    ElementTree.SubElement(props, "{%s}getctag" % CALENDARSERVER)
+    ElementTree.SubElement(props, "{DAV:}sync-token")
+
+    root = Urn(Urn.separate, directory=True).quote()
+    response = send_request(client.execute_request, "info", root,
+                            data=serialize_xml(query),
+                            headers_ext=[
+                                "Depth: 0",
+                                "Content-Type: application/xml; "
+                                "charset=utf-8",
+                            ])
+    try:
+        tree = ElementTree.fromstring(response.content)
+    except ElementTree.ParseError:
+        return None
+
+    tags = {}
+    for propstat in tree.iter("{DAV:}propstat"):
+        if get_status_code(propstat.findtext("{DAV:}status")) != "200":
+            continue
+        for tag in ("{%s}getctag" % CALENDARSERVER, "{DAV:}sync-token"):
+            value = propstat.findtext("{DAV:}prop/%s" % tag)
+            if value:
+                tags.setdefault(tag, value)
+    return tags.get("{%s}getctag" % CALENDARSERVER) or \
+        tags.get("{DAV:}sync-token")
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+import sqlite3
+
+
+def get_journal_path(state_path: str):
+    """
+    Derives the path of the operation journal kept next to a state store
+    """
+    if state_path == ":memory:":
+        return state_path
+    return "%s.operations" % state_path
+
+
+class OperationJournal:
+    """
+    SQLite write-ahead record of the calendar operations of a sync
+
+    Once a run triaged its contacts and events, the whole plan is recorded
+    at once, each operation under the name of the contact or event it is
+    about, and operations are removed as they succeed. A journal still
+    holding a plan for a calendar was thus left by an interrupted run, and
+    the next one may apply what is left of it without fetching or triaging
+    anything. Failed operations are kept after the plan is finished, so
+    that the next run triages their contacts again, and replaced by the
+    next plan.
+
+    The journal is kept apart from the state store, and each change is
+    committed right away. Write-ahead logging spares most disk syncs, and a
+    commit only has to survive the process, not the machine. The journal
+    may be shared by the threads applying the operations.
+    """
+    def __init__(self, path: str, collection: str):
+        self.collection = collection
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS operations ("
+            "position INTEGER PRIMARY KEY, collection TEXT NOT NULL, "
+            "operation TEXT NOT NULL, key TEXT NOT NULL, payload TEXT, "
+            "UNIQUE (collection, operation, key))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS plans ("
+            "collection TEXT NOT NULL PRIMARY KEY)"
+        )
+        self.db.commit()
+
+    def is_planned(self):
+        """
+        Determines whether a plan was recorded and not finished yet
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM plans WHERE collection = ?",
+                (self.collection,)
+            ).fetchone() is not None
+
+    def get_operations(self):
+        """
+        Returns the operations left over for the calendar, in the order they
+        were recorded, as (operation, payload) pairs
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT operation, payload FROM operations "
+                "WHERE collection = ? ORDER BY position", (self.collection,)
+            ).fetchall()
+
+    def record_plan(self, operations):
+        """
+        Records a whole plan of (operation, key, payload) tuples at once
+
+        Operations left over by an earlier plan are dropped: the triage of
+        the new plan decides whether they are still needed.
+        """
+        operations = list(operations)
+        with self.lock:
+            self.db.execute("DELETE FROM operations WHERE collection = ?",
+                            (self.collection,))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO operations "
+                "(collection, operation, key, payload) VALUES (?, ?, ?, ?)",
+                ((self.collection,) + tuple(o) for o in operations)
+            )
+            self.db.execute("INSERT OR REPLACE INTO plans VALUES (?)",
+                            (self.collection,))
+            self.db.commit()
+
+    def finish_plan(self):
+        """
+        Marks the plan as finished, once all its operations were attempted
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM plans WHERE collection = ?",
+                            (self.collection,))
+            self.db.commit()
+
+    def complete(self, operation: str, key: str):
+        """
+        Removes an operation once it succeeded
+        """
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM operations "
+                "WHERE collection = ? AND operation = ? AND key = ?",
+                (self.collection, operation, key)
+            )
+            self.db.commit()
+
+    def close(self):
+        """
+        Closes the journal
+        """
+        with self.lock:
+            self.db.close()
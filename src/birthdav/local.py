@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from webdav3.exceptions import MethodNotSupported, ResponseErrorCode, \
+    RemoteResourceNotFound
+from urllib.parse import unquote, urlsplit
+from urllib.request import url2pathname
+from webdav3.client import WebDAVSettings
+from xml.etree import ElementTree
+import threading
+import tempfile
+import hashlib
+import os
+
+
+CALENDARSERVER = "http://calendarserver.org/ns/"
+
+
+class LocalResponse:
+    """
+    The response to a request sent to a local collection
+    """
+    def __init__(self, content: bytes = b"", headers: dict = None):
+        self.status_code = 200
+        self.content = content
+        self.headers = headers or {}
+
+
+def get_local_etag(stat: os.stat_result):
+    """
+    Derives an ETag from the modification time and size of a file
+    """
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+def get_preconditions(headers: list):
+    """
+    Extracts the If-Match and If-None-Match values from request headers
+    """
+    conditions = {}
+    for header in headers or ():
+        name, _, value = header.partition(":")
+        conditions[name.strip().lower()] = value.strip()
+    return conditions.get("if-match"), conditions.get("if-none-match")
+
+
+class LocalClient:
+    """
+    A client for a local vdir collection: a directory with one file per item
+
+    It stands in for webdav3 clients wherever birthdav.dav expects one, and
+    answers the download, upload, clean and info requests birthdav sends,
+    with ETags derived from the files' modification times and sizes. REPORT
+    requests are not supported, so that collections are always listed.
+    Nothing is cached: with a state store, unchanged files are not
+    requested again in the first place.
+    """
+    def __init__(self, url: str):
+        self.webdav = WebDAVSettings({"hostname": url})
+        self.root = url2pathname(urlsplit(url).path)
+        self.lock = threading.Lock()
+
+    def get_url(self, path: str):
+        """
+        Builds the URL of a file of the collection
+        """
+        return self.webdav.hostname.rstrip("/") + path
+
+    def get_path(self, path: str):
+        """
+        Maps a quoted request path to a file of the collection
+        """
+        name = unquote(path).strip("/")
+        if not name or "/" in name or name in (".", ".."):
+            raise RemoteResourceNotFound(path)
+        return os.path.join(self.root, name)
+
+    def scan(self):
+        """
+        Lists the files of the collection along with their stat results
+        """
+        with os.scandir(self.root) as entries:
+            return {entry.name: entry.stat() for entry in entries if
+                    entry.is_file() and not entry.name.startswith(".")}
+
+    def list(self, get_info: bool = False):
+        """
+        Lists the files of the collection, like webdav3's Client.list
+        """
+        files = self.scan()
+        if not get_info:
+            return list(files)
+        return [{"path": name, "etag": get_local_etag(stat), "isdir": False,
+                 "size": stat.st_size} for name, stat in files.items()]
+
+    def read(self, path: str):
+        """
+        Reads a file of the collection, along with its stat result
+        """
+        try:
+            with open(path, "rb") as local_file:
+                return local_file.read(), os.fstat(local_file.fileno())
+        except FileNotFoundError:
+            raise RemoteResourceNotFound(path)
+
+    def check_preconditions(self, path: str, headers: list):
+        """
+        Fails with a 412 status code if the file does not match the request
+        """
+        if_match, if_none_match = get_preconditions(headers)
+        try:
+            etag = get_local_etag(os.stat(path))
+        except FileNotFoundError:
+            etag = None
+        if (if_match is not None and if_match != etag) or \
+                (if_none_match == "*" and etag is not None):
+            raise ResponseErrorCode(path, 412, "Precondition Failed")
+
+    def write(self, path: str, data: bytes, headers: list):
+        """
+        Replaces a file atomically, through a temporary file
+        """
+        with self.lock:
+            self.check_preconditions(path, headers)
+            descriptor, tmp_path = tempfile.mkstemp(dir=self.root,
+                                                    prefix=".birthdav-")
+            try:
+                with os.fdopen(descriptor, "wb") as local_file:
+                    local_file.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            return os.stat(path)
+
+    def delete(self, path: str, headers: list):
+        """
+        Removes a file
+        """
+        with self.lock:
+            self.check_preconditions(path, headers)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                raise RemoteResourceNotFound(path)
+
+    def get_tag(self):
+        """
+        Builds a CTag out of the names, modification times and sizes of files
+        """
+        digest = hashlib.sha256()
+        for name, stat in sorted(self.scan().items()):
+            digest.update(("%s/%s\n" % (name, get_local_etag(stat)))
+                          .encode("utf-8"))
+
+        multistatus = ElementTree.Element("{DAV:}multistatus")
+        response = ElementTree.SubElement(multistatus, "{DAV:}response")
+        ElementTree.SubElement(response, "{DAV:}href").text = "/"
+        propstat = ElementTree.SubElement(response, "{DAV:}propstat")
+        prop = ElementTree.SubElement(propstat, "{DAV:}prop")
+        ElementTree.SubElement(prop, "{%s}getctag" % CALENDARSERVER).text = \
+            digest.hexdigest()
+        ElementTree.SubElement(propstat, "{DAV:}status").text = \
+            "HTTP/1.1 200 OK"
+        return ElementTree.tostring(multistatus, encoding="utf-8")
+
+    def execute_request(self, action: str, path: str, data: bytes = None,
+                        headers_ext: list = None):
+        """
+        Answers a request, like webdav3's Client.execute_request
+        """
+        if action == "info":
+            return LocalResponse(self.get_tag())
+        if action == "download":
+            content, stat = self.read(self.get_path(path))
+            return LocalResponse(content, {"ETag": get_local_etag(stat)})
+        if action == "check":
+            try:
+                stat = os.stat(self.get_path(path))
+            except FileNotFoundError:
+                raise RemoteResourceNotFound(path)
+            return LocalResponse(headers={"ETag": get_local_etag(stat)})
+        if action == "upload":
+            stat = self.write(self.get_path(path), data, headers_ext)
+            return LocalResponse(headers={"ETag": get_local_etag(stat)})
+        if action == "clean":
+            self.delete(self.get_path(path), headers_ext)
+            return LocalResponse()
+        raise MethodNotSupported(name=action, server=self.webdav.hostname)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from contextlib import contextmanager
+import threading
+import json
+import time
+import os
+
+
+# Prefix of the metric names exported in the Prometheus text format
+PROMETHEUS_PREFIX = "birthdav_"
+
+# Help lines of the exported metrics
+DESCRIPTIONS = {
+    "phase_seconds_total": "Time spent in each phase, summed over threads",
+    "phase_calls_total": "Number of times each phase ran",
+    "http_requests_total": "HTTP requests sent, by method and status code",
+    "http_request_seconds_total": "Time spent waiting for HTTP responses",
+    "http_sent_bytes_total": "Bytes sent in HTTP request bodies",
+    "http_received_bytes_total": "Bytes received in HTTP response bodies",
+    "operations_total": "Calendar operations applied, by outcome",
+    "conflicts_total": "Writes turned down because an event had changed",
+    "throttled_total": "Requests turned down by a server asking to slow down",
+    "write_concurrency": "Calendar writes currently allowed in flight",
+    "fetch_concurrency": "Downloads currently allowed in flight",
+    "last_success_timestamp_seconds": "Time at which the last successful "
+                                      "sync ended",
+}
+
+
+class Metrics:
+    """
+    Thread-safe counters telling where syncs spend their time and bytes
+
+    Counters are identified by a name and labels. Phases are timed with the
+    timed context manager: their durations are summed over the threads they
+    ran in, so that concurrent downloads may well add up to more than the
+    wall time of the sync. HTTP requests are counted by record_response, a
+    requests response hook.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def add(self, name: str, value: float = 1, **labels):
+        """
+        Adds a value to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """
+        Sets the value of a gauge
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = value
+
+    @contextmanager
+    def timed(self, phase: str):
+        """
+        Records the time spent in a phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add("phase_seconds_total", time.perf_counter() - start,
+                     phase=phase)
+            self.add("phase_calls_total", phase=phase)
+
+    def record_response(self, response, *args, **kwargs):
+        """
+        Counts an HTTP request and the bytes it transferred
+
+        Compressed response bodies are counted as they were received rather
+        than once decoded, from the number of bytes read off the connection.
+        """
+        request = response.request
+        self.add("http_requests_total", method=request.method,
+                 status=str(response.status_code))
+        self.add("http_request_seconds_total",
+                 response.elapsed.total_seconds(), method=request.method)
+        self.add("http_sent_bytes_total", len(request.body or b""))
+        content = response.content
+        try:
+            received = int(response.raw.tell())
+        except (AttributeError, TypeError, ValueError):
+            received = len(content)
+        self.add("http_received_bytes_total", received)
+
+    def reset(self):
+        """
+        Drops every counter
+        """
+        with self.lock:
+            self.counters = {}
+
+    def to_dict(self):
+        """
+        Returns the counters by name, each as a list of labels and values
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+        summary = {}
+        for (name, labels), value in counters:
+            summary.setdefault(name, []).append({"labels": dict(labels),
+                                                 "value": value})
+        return summary
+
+    def to_prometheus(self):
+        """
+        Formats the counters in the Prometheus text exposition format
+        """
+        lines = []
+        for name, samples in self.to_dict().items():
+            metric = PROMETHEUS_PREFIX + name
+            if name in DESCRIPTIONS:
+                lines.append("# HELP %s %s" % (metric, DESCRIPTIONS[name]))
+            lines.append("# TYPE %s %s" % (
+                metric, "counter" if name.endswith("_total") else "gauge"
+            ))
+            for sample in samples:
+                labels = ",".join('%s="%s"' % (key, escape_label(value)) for
+                                  key, value in sample["labels"].items())
+                lines.append("%s%s %s" % (metric,
+                                          "{%s}" % labels if labels else "",
+                                          repr(float(sample["value"]))))
+        return "".join(line + "\n" for line in lines)
+
+
+def escape_label(value: str):
+    """
+    Escapes a label value for the Prometheus text format
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def export(json_summary: bool = False, prometheus_path: str = None):
+    """
+    Prints the metrics as JSON and/or writes them to a Prometheus textfile
+
+    The textfile is replaced atomically, so that the node exporter's textfile
+    collector never reads a partial file.
+    """
+    if json_summary:
+        print(json.dumps(METRICS.to_dict(), sort_keys=True))
+    if prometheus_path is not None:
+        temporary_path = "%s.%d.tmp" % (prometheus_path, os.getpid())
+        with open(temporary_path, "w") as textfile:
+            textfile.write(METRICS.to_prometheus())
+        os.replace(temporary_path, prometheus_path)
+
+
+# Metrics of every sync run by this process
+METRICS = Metrics()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+import vobject
+import re
+
+
+# Properties birthdav reads from vCards, all others are skipped undecoded
+SCANNED_PROPERTIES = ("UID", "BDAY", "N", "FN")
+
+# Matches the first line of a vCard
+VCARD_START = re.compile(r"\s*BEGIN:VCARD\r?\n", re.IGNORECASE)
+
+# Matches the start of the scanned properties, at the beginning of a line
+# (the first line of a vCard is always BEGIN:VCARD)
+PROPERTY_START = re.compile(
+    r"\n(?:[\w-]+\.)?(%s)(?=[;:])" % "|".join(SCANNED_PROPERTIES),
+    re.IGNORECASE
+)
+
+# Matches the end of a content line, unless the next one continues it
+LINE_END = re.compile(r"\r?\n(?![ \t])")
+LINE_FOLD = re.compile(r"\r?\n[ \t]")
+
+# Matches the separators and escape sequences of text values
+TEXT_TOKEN = re.compile(r"\\(.)|(;)", re.DOTALL)
+TEXT_ESCAPES = {"n": "\n", "N": "\n"}
+
+Name = namedtuple("Name", ("family", "given", "additional",
+                           "prefix", "suffix"))
+
+
+class ScannedProperty:
+    """
+    Scanned vCard property, exposing its value like vobject does
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class ScannedCard:
+    """
+    Scanned vCard, exposing the few properties birthdav reads like vobject
+
+    Properties missing from the vCard are missing from the object as well,
+    so that hasattr checks behave as they would on a vobject component.
+    """
+    __slots__ = tuple(p.lower() for p in SCANNED_PROPERTIES)
+
+    def __init__(self, properties: dict):
+        for name, value in properties.items():
+            setattr(self, name.lower(), ScannedProperty(value))
+
+
+def split_text(value: str):
+    """
+    Splits a structured text value on its separators and unescapes its parts
+    """
+    parts, current, position = [], [], 0
+    for match in TEXT_TOKEN.finditer(value):
+        current.append(value[position:match.start()])
+        if match.group(2) is not None:
+            parts.append("".join(current))
+            current = []
+        else:
+            escaped = match.group(1)
+            current.append(TEXT_ESCAPES.get(escaped, escaped))
+        position = match.end()
+
+    current.append(value[position:])
+    parts.append("".join(current))
+    return parts
+
+
+def split_content_line(line: str):
+    """
+    Splits an unfolded content line into its parameters and value
+    """
+    quoted = False
+    for index, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ":" and not quoted:
+            return line[:index], line[index + 1:]
+    raise ValueError("invalid content line: %s" % line[:32])
+
+
+def scan_vcard(data: str):
+    """
+    Extracts the properties birthdav needs from a vCard, skipping all others
+
+    Instead of fully parsing and decoding the vCard, the scanner jumps from
+    one scanned property to the next: large properties such as PHOTO or LOGO
+    are never unfolded nor decoded. The first occurrence of each property is
+    kept. vCards which use encodings or character sets the scanner does not
+    handle are parsed by vobject instead.
+    """
+    if VCARD_START.match(data) is None:
+        raise ValueError("not a vCard")
+
+    properties = {}
+    position = 0
+    while True:
+        match = PROPERTY_START.search(data, position)
+        if match is None:
+            break
+
+        end = LINE_END.search(data, match.end())
+        end = len(data) if end is None else end.start()
+        position = end
+
+        name = match.group(1).upper()
+        if name in properties:
+            continue
+
+        line = LINE_FOLD.sub("", data[match.end():end])
+        params, value = split_content_line(line)
+        if "ENCODING" in params.upper() or "CHARSET" in params.upper():
+            return vobject.readOne(data)
+
+        if name == "N":
+            value = Name(*(split_text(value) + [""] * 5)[:5])
+        elif name != "BDAY":
+            value = ";".join(split_text(value))
+        properties[name] = value
+
+    return ScannedCard(properties)
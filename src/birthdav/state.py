@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import sqlite3
+
+
+# Details kept for each resource, besides its collection and file name
+RESOURCE_COLUMNS = (
+    "etag", "uid", "card_url", "card_uid", "bday", "display_name",
+    "fingerprint"
+)
+
+
+class StateStore:
+    """
+    SQLite record of the resources seen during previous runs
+
+    Resources are identified by the URL of their collection and their file
+    name. Along with their ETag, the store keeps the few details birthdav needs
+    from them, so that unchanged resources do not have to be downloaded again.
+    The sync tokens of collections are kept as well.
+
+    Changes are only written once committed, at the end of a successful run.
+    An interrupted run leaves the store as it was, so that the next one fetches
+    the same changes again. The store may be shared by threads fetching both
+    collections at once.
+    """
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS resources ("
+            "collection TEXT NOT NULL, name TEXT NOT NULL, %s, "
+            "PRIMARY KEY (collection, name))" %
+            ", ".join("%s TEXT" % c for c in RESOURCE_COLUMNS)
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sync_tokens ("
+            "collection TEXT NOT NULL PRIMARY KEY, token TEXT)"
+        )
+        self.upgrade()
+        self.db.commit()
+
+        # UIDs concerned by the changes fetched during this run, when only the
+        # changes since the last sync tokens are being synced
+        self.changed_uids = None
+
+    def upgrade(self):
+        """
+        Adds the columns missing from a store written by an older version
+
+        The resources recorded then lack the new details, so they are dropped
+        along with the sync tokens: the next run fetches everything again.
+        """
+        columns = {row[1] for row in
+                   self.db.execute("PRAGMA table_info(resources)")}
+        missing = [c for c in RESOURCE_COLUMNS if c not in columns]
+        for column in missing:
+            self.db.execute("ALTER TABLE resources ADD COLUMN %s TEXT" %
+                            column)
+        if missing:
+            self.db.execute("DELETE FROM resources")
+            self.db.execute("DELETE FROM sync_tokens")
+
+    def get_resources(self, collection: str):
+        """
+        Returns the resources recorded for a collection, by file name
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, %s FROM resources WHERE collection = ?" %
+                ", ".join(RESOURCE_COLUMNS), (collection,)
+            )
+            return {row[0]: dict(zip(RESOURCE_COLUMNS, row[1:]))
+                    for row in rows}
+
+    def save_resources(self, collection: str, resources: dict):
+        """
+        Replaces the resources recorded for a collection
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM resources WHERE collection = ?",
+                            (collection,))
+            self.db.executemany(
+                "INSERT INTO resources VALUES (?, ?, %s)" %
+                ", ".join("?" for _ in RESOURCE_COLUMNS),
+                ((collection, name) +
+                 tuple(r.get(c) for c in RESOURCE_COLUMNS)
+                 for name, r in resources.items())
+            )
+
+    def get_sync_token(self, collection: str):
+        """
+        Returns the sync token recorded for a collection, if any
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT token FROM sync_tokens WHERE collection = ?",
+                (collection,)
+            ).fetchone()
+            return None if row is None else row[0]
+
+    def save_sync_token(self, collection: str, token: str):
+        """
+        Records the sync token of a collection
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sync_tokens VALUES (?, ?)",
+                (collection, token)
+            )
+
+    def track_changed_uids(self):
+        """
+        Starts recording the UIDs concerned by the changes of this run
+        """
+        with self.lock:
+            self.changed_uids = set()
+
+    def add_changed_uids(self, uids):
+        """
+        Records UIDs concerned by the changes fetched during this run
+
+        Nothing is recorded once the changed UIDs were reset, as everything
+        then has to be compared again.
+        """
+        with self.lock:
+            if self.changed_uids is not None:
+                self.changed_uids.update(uids)
+
+    def reset_changed_uids(self):
+        """
+        Forgets the changed UIDs, so that every contact is compared again
+        """
+        with self.lock:
+            self.changed_uids = None
+
+    def may_have_changed(self, uid: str):
+        """
+        Determines whether a UID may be concerned by the changes of this run
+        """
+        with self.lock:
+            return self.changed_uids is None or uid in self.changed_uids
+
+    def commit(self):
+        """
+        Writes the changes recorded during this run
+        """
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        """
+        Closes the store, dropping uncommitted changes
+        """
+        with self.lock:
+            self.db.close()
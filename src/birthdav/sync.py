@@ -17,128 +17,941 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
-from birthdav.dav import get_vobjects
+from birthdav.metrics import METRICS
+from birthdav.state import StateStore
+from birthdav.scan import scan_vcard, ScannedCard, Name
+from birthdav.throttle import get_retry_delay, ConcurrencyLimiter
+from birthdav.journal import OperationJournal, get_journal_path
+from birthdav.dav import \
+    iter_vobjects, \
+    list_resources, \
+    fetch_etag, \
+    refetch_vobject, \
+    upload_vobject, \
+    delete_vobject, \
+    is_precondition_failure, \
+    query_cards, \
+    query_events, \
+    list_events, \
+    multiget_cards, \
+    multiget_events, \
+    sync_collection, \
+    is_transient, \
+    ReportError, \
+    SyncTokenError
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple
 from datetime import datetime, timedelta
-from tempfile import NamedTemporaryFile
+from webdav3.exceptions import ResponseErrorCode
 from webdav3.client import Client
+import hashlib
 import vobject
+import json
 import uuid
+import time
+import re
 
 
-def get_born_contacts(card_client: Client):
+# Version of the events built by build_birthday_event, part of their
+# fingerprint: bumping it has every event rebuilt on the next run
+EVENT_TEMPLATE_VERSION = 1
+
+# Calendar-level property of single-feed calendars, read without parsing the
+# whole feed
+FEED_FINGERPRINT = re.compile(r"^X-BIRTHDAV-FINGERPRINT:(.*?)\r?$", re.M)
+
+# Status codes with which servers turn down the contents of a feed, as CalDAV
+# servers do with resources holding events of several UIDs
+FEED_REJECTED_CODES = (400, 403, 409, 415, 422)
+
+# The details of a birthday event triage needs, without its vobject tree:
+# the name and ETag it was fetched with, and its state store record
+EventRecord = namedtuple("EventRecord", ("name", "etag", "uid", "card_uid",
+                                         "card_url", "bday", "display_name",
+                                         "fingerprint"))
+
+
+class FeedError(Exception):
+    """
+    Raised when a server turns a birthday feed down
+
+    CalDAV servers only accept calendar resources whose components all share
+    the same UID (RFC 4791, section 4.1): feeds have to be written to plain
+    WebDAV collections.
+    """
+    def __init__(self, name: str, error: ResponseErrorCode):
+        self.error = error
+        super().__init__(
+            "%s was turned down with a %d status: feeds cannot be written to "
+            "CalDAV calendars, use a plain WebDAV collection instead" %
+            (name, error.code)
+        )
+
+
+class ApplyError(Exception):
+    """
+    Raised when one or more operations could not be applied to the calendar
+    """
+    def __init__(self, results: list):
+        self.results = results
+        failed = [r for r in results if r["status"] == "failed"]
+        details = "; ".join("%s %s: %s" % (r["operation"],
+                                           describe_item(r["operation"],
+                                                         r["item"]),
+                                           str(r["error"]))
+                            for r in failed)
+        super().__init__("failed to apply %d operation(s): %s" %
+                         (len(failed), details))
+
+
+def get_contact_name(contact):
+    """
+    Builds a contact's display name from its structured name
+    """
+    if not hasattr(contact, "n"):
+        return contact.fn.value if hasattr(contact, "fn") else ""
+
+    vobj_name = contact.n.value
+    vobj_names = [vobj_name.given, vobj_name.additional, vobj_name.family]
+    return ' '.join(n.strip() for n in vobj_names if len(n) > 0)
+
+
+def get_contact_fingerprint(contact):
+    """
+    Hashes the details of a contact its birthday event is built from
+
+    The fingerprint covers the normalized display name and birth date of the
+    contact, along with the version of the event template.
+    """
+    details = "\x1f".join((str(EVENT_TEMPLATE_VERSION),
+                           " ".join(get_contact_name(contact).split()),
+                           contact.bday.value.strip()))
+    return hashlib.sha256(details.encode("utf-8")).hexdigest()[:16]
+
+
+def get_event_uid(card_url: str, card_uid: str):
+    """
+    Derives the UID, and file name, of the birthday event of a contact
+
+    The UID only depends on the address book and the contact, so that events
+    may be addressed directly, without listing the calendar.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "%s#%s" % (card_url, card_uid)))
+
+
+def is_legacy_event(event):
+    """
+    Determines whether an event was given a random UID by an older version
+    """
+    return event.uid != get_event_uid(event.card_url, event.card_uid)
+
+
+def get_card_record(card):
+    """
+    Extracts the details kept in the state store from a vCard
+    """
+    if not hasattr(card, "bday") or not hasattr(card, "uid"):
+        return {}
+
+    return {
+        "uid": card.uid.value,
+        "bday": card.bday.value,
+        "display_name": get_contact_name(card),
+    }
+
+
+def get_event_record(event):
+    """
+    Extracts the details kept in the state store from a calendar
+    """
+    if not hasattr(event, "x-birthdav-card-uid") or \
+            not hasattr(event, "x-birthdav-card-url"):
+        return {}
+
+    summary = event.vevent.summary.value if \
+        hasattr(event.vevent, "summary") else ""
+    return {
+        "uid": event.uid.value,
+        "card_uid": event.x_birthdav_card_uid.value,
+        "card_url": event.x_birthdav_card_url.value,
+        "bday": event.vevent.dtstart.value.date().isoformat(),
+        "display_name": summary,
+        "fingerprint": event.x_birthdav_fingerprint.value if
+        hasattr(event, "x-birthdav-fingerprint") else None,
+    }
+
+
+def build_cached_contact(record: dict):
+    """
+    Rebuilds a minimal contact from its record in the state store
+    """
+    return ScannedCard({
+        "UID": record["uid"],
+        "BDAY": record["bday"],
+        "N": Name("", record["display_name"], "", "", ""),
+    })
+
+
+def build_event_record(name: str, etag: str, record: dict):
+    """
+    Builds the compact record of an event, from its state store record
+    """
+    return EventRecord(name, etag, *(record.get(field) for
+                                     field in EventRecord._fields[2:]))
+
+
+def list_changes(client: Client, state: StateStore, known: dict):
+    """
+    Lists a collection from the changes made since the last run's sync token
+
+    The resulting listing is made of the known resources, minus the deleted
+    ones, plus the changed ones. The UIDs concerned by these changes are added
+    to the state store's, or the latter are reset when the server no longer
+    accepts the sync token. Returns None if the server does not support
+    sync-collection reports.
+    """
+    collection = client.webdav.hostname
+    token = state.get_sync_token(collection)
+    try:
+        try:
+            new_token, changed, deleted = sync_collection(client, token)
+        except SyncTokenError:
+            token = None
+            new_token, changed, deleted = sync_collection(client)
+    except ReportError:
+        return None
+
+    state.save_sync_token(collection, new_token)
+    if token is None:
+        state.reset_changed_uids()
+        return changed
+
+    for name in deleted.union(changed):
+        record = known.get(name, {})
+        state.add_changed_uids((record.get("uid"), record.get("card_uid")))
+
+    listing = {name: record["etag"] for name, record in known.items() if
+               name not in deleted}
+    listing.update(changed)
+    return listing
+
+
+def iter_changed(client: Client, state: StateStore, workers: int,
+                 reports: bool, multiget, get_record, delta: bool = False,
+                 parse=None, list_collection=None):
+    """
+    Fetches the resources of a collection which changed since the last run
+
+    The collection is listed along with ETags, and only the resources whose
+    ETag differs from the one in the state store are fetched, using multiget
+    reports when possible. In delta mode, the listing is built from the
+    changes reported since the last sync token instead. Resources are yielded
+    as (name, record) pairs: those which did not change come first, then the
+    others are reduced to their records as soon as they are parsed, so that
+    their objects are dropped right away. The state store is updated once
+    every resource went through. Only the resources `list_collection` returns
+    are tracked, which defaults to the whole collection.
+    """
+    collection = client.webdav.hostname
+    known = state.get_resources(collection)
+    listing = list_changes(client, state, known) if delta else None
+    if listing is None:
+        state.reset_changed_uids()
+        listing = (list_collection or list_resources)(client)
+
+    changed = [name for name, etag in listing.items() if
+               etag is None or
+               name not in known or
+               known[name]["etag"] != etag]
+
+    records = {}
+    for name in listing.keys() - set(changed):
+        records[name] = known[name]
+    yield from records.items()
+
+    def reduce(data):
+        return get_record((parse or vobject.readOne)(data))
+
+    def keep(name, record):
+        records[name] = dict(record, etag=listing.get(name))
+        state.add_changed_uids((record.get("uid"), record.get("card_uid")))
+        return name, records[name]
+
+    if reports and changed:
+        try:
+            for name, record in multiget(client, changed, reduce):
+                yield keep(name, record)
+            changed = []
+        except ReportError:
+            changed = [name for name in changed if name not in records]
+
+    if changed:
+        for name, record in iter_vobjects(client, workers, changed, reduce):
+            yield keep(name, record)
+
+    state.save_resources(collection, records)
+
+
+def iter_born_contacts(card_client: Client, workers: int = 1,
+                       reports: bool = True, state: StateStore = None,
+                       delta: bool = False):
+    """
+    Fetches objects from a CardDAV client and yields contacts with birthdays
+
+    Contacts are yielded as (UID, contact) pairs, as soon as they are parsed,
+    and those without a BDAY property are dropped right away. vCards are only
+    scanned for the few properties birthdav needs. Unless reports
+    are disabled, servers supporting CardDAV reports only send over contacts
+    with a BDAY property. Other WebDAV servers have their files fetched one by
+    one. With a state store, only the contacts which changed since the last
+    run are fetched.
+    """
+    if state is not None:
+        records = iter_changed(card_client, state, workers, reports,
+                               multiget_cards, get_card_record, delta,
+                               scan_vcard)
+        for _, record in records:
+            if record.get("bday") is not None:
+                yield record["uid"], build_cached_contact(record)
+        return
+
+    vobjects = None
+    if reports:
+        try:
+            vobjects = query_cards(card_client, "BDAY", scan_vcard)
+        except ReportError:
+            pass
+
+    if vobjects is None:
+        vobjects = iter_vobjects(card_client, workers, parse=scan_vcard)
+    for _, contact in vobjects:
+        if hasattr(contact, "bday"):
+            yield contact.uid.value, contact
+
+
+def get_born_contacts(card_client: Client, workers: int = 1,
+                      reports: bool = True, state: StateStore = None,
+                      delta: bool = False):
     """
     Fetches objects from a CardDAV client and returns contacts with birthdays
     """
-    return {c.uid.value: c for
-            c in get_vobjects(card_client) if
-            hasattr(c, "bday")}
+    return dict(iter_born_contacts(card_client, workers, reports, state,
+                                   delta))
 
 
-def get_events(cal_client: Client, card_client: Client):
+def get_events(cal_client: Client, card_client: Client, workers: int = 1,
+               reports: bool = True, state: StateStore = None,
+               delta: bool = False):
     """
     Fetches birthdav birthdays from a CalDAV client
+
+    Unless reports are disabled, servers supporting CalDAV reports only send
+    over the events birthdav created for this address book. Other WebDAV
+    servers have the whole calendar fetched file by file, and unrelated events
+    are dropped as soon as they are parsed. With a state store, the calendar
+    is listed with the same query, asking for ETags alone, and only the events
+    which changed since the last run are fetched.
+
+    Events are returned as EventRecord tuples, by contact UID: their vobject
+    trees are dropped as soon as they are parsed, and the name and ETag they
+    were fetched with are kept so that they are written back where they are.
     """
-    return {e.x_birthdav_card_uid.value: e for e in get_vobjects(cal_client) if
-            hasattr(e, "x-birthdav-card-uid") and
-            hasattr(e, "x-birthdav-card-url") and
-            e.x_birthdav_card_url.value == card_client.webdav.hostname}
+    card_url = card_client.webdav.hostname
+    prop_filters = {
+        "X-BIRTHDAV-CARD-UID": None,
+        "X-BIRTHDAV-CARD-URL": card_url,
+    }
+    events = {}
+    if state is not None:
+        def list_calendar(client):
+            if reports:
+                try:
+                    return list_events(client, prop_filters)
+                except ReportError:
+                    pass
+            return list_resources(client)
+
+        records = iter_changed(cal_client, state, workers, reports,
+                               multiget_events, get_event_record, delta,
+                               list_collection=list_calendar)
+        for name, r in records:
+            if r.get("card_uid") is not None and r.get("card_url") == card_url:
+                events[r["card_uid"]] = build_event_record(name, r["etag"], r)
+        return events
+
+    listed = {}
+    vobjects = None
+    if reports:
+        try:
+            vobjects = query_events(cal_client, prop_filters, listed)
+        except ReportError:
+            pass
+
+    if vobjects is None:
+        listed = list_resources(cal_client)
+        vobjects = iter_vobjects(cal_client, workers, list(listed))
+    for name, e in vobjects:
+        record = get_event_record(e)
+        if record.get("card_url") == card_url:
+            events[record["card_uid"]] = build_event_record(
+                name, listed.get(name), record
+            )
+    return events
 
 
 def contact_matches_event(contact, event):
     """
     Determines whether or not an event still matches a contact's details
+
+    Events carry the fingerprint of the contact they were built from. Events
+    without one, or with a random UID, were built by older versions, and never
+    match.
     """
-    birth_date = datetime.strptime(contact.bday.value, "%Y-%m-%d").date()
-    event_date = event.vevent.dtstart.value.date()
-    return birth_date == event_date
+    if event.fingerprint is None or is_legacy_event(event):
+        return False
+    return event.fingerprint == get_contact_fingerprint(contact)
 
 
-def triage_events(contacts: dict, events: dict):
+def iter_triage(contacts, events: dict, relevant=None):
     """
     Compares contacts and events to determine what to add, edit or remove
+
+    Contacts are given as (UID, contact) pairs and compared as they come, so
+    that ("new", contact) and ("updated", {"contact", "event"}) operations
+    are yielded before the whole address book was fetched. ("lost", event)
+    operations come last, once every contact went through. Events are given
+    as EventRecord tuples, by contact UID. When given, `relevant` tells which
+    contact UIDs may have changed since the last run, the others are not
+    compared again, unless their events still have to be renamed.
     """
-    contacts_idset = set(contacts.keys())
-    events_idset = set(events.keys())
+    seen = set()
+    for uid, contact in contacts:
+        if uid in seen:
+            continue
+        seen.add(uid)
 
-    new_idset = contacts_idset - events_idset
-    lost_idset = events_idset - contacts_idset
-    updated_idset = {uid for uid in events_idset if
-                     uid in contacts_idset and
-                     not contact_matches_event(contacts[uid], events[uid])}
+        if relevant is not None and not relevant(uid) and \
+                (uid not in events or not is_legacy_event(events[uid])):
+            continue
+        with METRICS.timed("triage"):
+            if uid not in events:
+                operation = "new", contact
+            elif not contact_matches_event(contact, events[uid]):
+                operation = "updated", {"contact": contact,
+                                        "event": events[uid]}
+            else:
+                operation = None
+        if operation is not None:
+            yield operation
 
-    new_contacts = [contacts[uid] for uid in new_idset]
-    updated_contacts = [{
-        "contact": contacts[uid],
-        "event": events[uid]
-    } for uid in updated_idset]
-    lost_events = [events[uid].uid.value for uid in lost_idset]
+    for uid, event in events.items():
+        if uid not in seen:
+            yield "lost", event
 
-    return new_contacts, lost_events, updated_contacts
 
+def triage_events(contacts: dict, events: dict):
+    """
+    Compares contacts and events to determine what to add, edit or remove
+    """
+    diffs = {"new": [], "lost": [], "updated": []}
+    for operation, item in iter_triage(contacts.items(), events):
+        diffs[operation].append(item)
+    return diffs["new"], diffs["lost"], diffs["updated"]
 
-def create_birthday_event(cal_client: Client, card_client: Client,
-                          new_contact):
+
+def add_birthday_vevent(calendar, contact):
     """
-    Creates a CalDAV event for a new contact
+    Adds the yearly event of a contact's birthday, with its alarms, to a
+    calendar
     """
-    vobj_name = new_contact.n.value
-    vobj_names = [vobj_name.given, vobj_name.additional, vobj_name.family]
-    name = ' '.join(n.strip() for n in vobj_names if len(n) > 0)
-    birthdate = datetime.strptime(new_contact.bday.value, "%Y-%m-%d")
+    name = get_contact_name(contact)
+    birthdate = datetime.strptime(contact.bday.value, "%Y-%m-%d")
     event_time = birthdate.replace(hour=8, minute=0, microsecond=0)
-    uid = str(uuid.uuid4())
-
-    vobj = vobject.iCalendar()
-    vobj.add("uid").value = uid
-    vobj.add("x-birthdav-card-uid").value = new_contact.uid.value
-    vobj.add("x-birthdav-card-url").value = card_client.webdav.hostname
 
-    vobj.add("vevent")
-    vobj.vevent.add("summary").value = name
-    vobj.vevent.add("dtstart").value = event_time
-    vobj.vevent.add("rrule").value = "FREQ=YEARLY"
+    vevent = calendar.add("vevent")
+    vevent.add("summary").value = name
+    vevent.add("dtstart").value = event_time
+    vevent.add("rrule").value = "FREQ=YEARLY"
 
     for trigger in (0, 7):
-        alarm = vobj.vevent.add("valarm")
+        alarm = vevent.add("valarm")
         alarm.add("action").value = "DISPLAY"
         alarm.add("trigger").value = timedelta(days=-trigger)
         alarm.add("description").value = name
+    return vevent
 
-    with NamedTemporaryFile("w") as tmp_file:
-        tmp_file.write(vobj.serialize())
-        tmp_file.flush()
-        cal_client.upload("%s.ics" % uid, tmp_file.name)
 
+def build_birthday_event(card_url: str, contact):
+    """
+    Builds the birthday event of a contact
+    """
+    uid = get_event_uid(card_url, contact.uid.value)
+    with METRICS.timed("build"):
+        vobj = vobject.iCalendar()
+        vobj.add("uid").value = uid
+        vobj.add("x-birthdav-card-uid").value = contact.uid.value
+        vobj.add("x-birthdav-card-url").value = card_url
+        vobj.add("x-birthdav-fingerprint").value = \
+            get_contact_fingerprint(contact)
+        add_birthday_vevent(vobj, contact)
+        return vobj
+
+
+def get_feed_fingerprint(card_url: str, contacts: dict):
+    """
+    Hashes the details of all contacts a birthday feed is built from
+    """
+    digest = hashlib.sha256(card_url.encode("utf-8"))
+    for uid in sorted(contacts):
+        fingerprint = get_contact_fingerprint(contacts[uid])
+        digest.update(("\x1f%s\x1f%s" % (uid, fingerprint)).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def scan_feed(content: str):
+    """
+    Reads the fingerprint of a birthday feed, without parsing its events
+
+    Returns an empty string for calendars without one, so that they can be
+    told apart from missing ones.
+    """
+    match = FEED_FINGERPRINT.search(content)
+    return match.group(1).strip() if match else ""
+
+
+def build_birthday_feed(card_url: str, contacts: dict):
+    """
+    Builds a single calendar holding the birthday events of all contacts
+
+    Events are sorted by contact and carry the same UIDs as the events synced
+    one by one, while the calendar carries the fingerprint of the whole feed.
+    """
+    with METRICS.timed("build"):
+        vobj = vobject.iCalendar()
+        vobj.add("x-birthdav-card-url").value = card_url
+        vobj.add("x-birthdav-fingerprint").value = \
+            get_feed_fingerprint(card_url, contacts)
+        for uid in sorted(contacts):
+            vevent = add_birthday_vevent(vobj, contacts[uid])
+            vevent.add("uid").value = get_event_uid(card_url, uid)
+        return vobj
+
+
+def triage_feed(cal_client: Client, card_client: Client, name: str,
+                contacts: dict, state: StateStore = None):
+    """
+    Determines whether a birthday feed must be written again
+
+    Only the fingerprint of the feed currently at `name` is read and compared
+    to that of the contacts: a ("feed", {"name", "feed", "etag", "create"})
+    operation is returned when they differ, and none otherwise. With a state
+    store, the feed's fingerprint is recorded along with its ETag, and the
+    feed is not downloaded as long as both still match: a HEAD request tells
+    whether it changed. A feed is thus downloaded once more after it was
+    written.
+    """
+    card_url = card_client.webdav.hostname
+    collection = cal_client.webdav.hostname
+    expected = get_feed_fingerprint(card_url, contacts)
+    known = state.get_resources(collection).get(name) if \
+        state is not None else None
+    if known is not None and known["fingerprint"] == expected and \
+            known["etag"] is not None and \
+            fetch_etag(cal_client, name) == known["etag"]:
+        return []
+
+    fingerprint, etag = refetch_vobject(cal_client, name, scan_feed)
+    if state is not None and fingerprint is not None:
+        state.save_resources(collection, {
+            name: {"etag": etag, "fingerprint": fingerprint}
+        })
+    with METRICS.timed("triage"):
+        if fingerprint == expected:
+            return []
+    return [("feed", {"name": name,
+                      "feed": build_birthday_feed(card_url, contacts),
+                      "etag": etag, "create": fingerprint is None})]
+
+
+def get_write_conditions(etag: str = None, create: bool = False):
+    """
+    Determines the preconditions of an upload, as upload_vobject arguments
+
+    Creations only happen if the event does not exist yet, and replacements
+    if it still has the ETag it was fetched with, when known.
+    """
+    return {"if_none_match": "*"} if create else {"if_match": etag}
+
+
+def write_event(cal_client: Client, path: str, vobj, etag: str = None,
+                create: bool = False):
+    """
+    Uploads a birthday event, unless it changed since it was fetched
+
+    When the server turns the upload down because its precondition failed,
+    only this event is fetched again: if it already is the one being written
+    there is nothing left to do, otherwise the upload is attempted once more
+    against the event's current ETag.
+    """
+    try:
+        upload_vobject(cal_client, path, vobj,
+                       **get_write_conditions(etag, create))
+    except ResponseErrorCode as e:
+        if not is_precondition_failure(e):
+            raise
+        METRICS.add("conflicts_total")
+        current, etag = refetch_vobject(cal_client, path)
+        if current is not None and \
+                hasattr(current, "x-birthdav-fingerprint") and \
+                current.x_birthdav_fingerprint.value == \
+                vobj.x_birthdav_fingerprint.value:
+            return
+        upload_vobject(cal_client, path, vobj,
+                       **get_write_conditions(etag, current is None))
+
+
+def delete_event(cal_client: Client, path: str, etag: str = None):
+    """
+    Deletes a birthday event, unless it changed since it was fetched
+
+    When the server turns the deletion down because the event's ETag changed,
+    only this event is fetched again, and deleted with its current ETag if it
+    still exists.
+    """
+    try:
+        delete_vobject(cal_client, path, if_match=etag)
+    except ResponseErrorCode as e:
+        if not is_precondition_failure(e):
+            raise
+        METRICS.add("conflicts_total")
+        current, etag = refetch_vobject(cal_client, path)
+        if current is not None:
+            delete_vobject(cal_client, path, if_match=etag)
+
+
+def create_birthday_event(cal_client: Client, card_client: Client,
+                          new_contact):
+    """
+    Creates a CalDAV event for a new contact
+    """
+    vobj = build_birthday_event(card_client.webdav.hostname, new_contact)
+    write_event(cal_client, "%s.ics" % vobj.uid.value, vobj, create=True)
     return vobj
 
 
+def apply_operation(cal_client: Client, card_client: Client,
+                    operation: str, item):
+    """
+    Applies a single operation, as yielded by iter_triage
+
+    Existing events are replaced or deleted where they were fetched from,
+    whatever their name. Updated events with a random UID are renamed: the
+    old event is deleted before the new one is uploaded, so that a failed
+    upload leaves the contact without an event, which the next run creates,
+    rather than with two of them.
+    """
+    if operation == "new":
+        create_birthday_event(cal_client, card_client, item)
+    elif operation == "lost":
+        delete_event(cal_client, item.name, item.etag)
+    elif operation == "feed":
+        try:
+            write_event(cal_client, item["name"], item["feed"], item["etag"],
+                        item["create"])
+        except ResponseErrorCode as e:
+            if e.code not in FEED_REJECTED_CODES:
+                raise
+            raise FeedError(item["name"], e)
+    elif operation == "updated":
+        event = build_birthday_event(card_client.webdav.hostname,
+                                     item["contact"])
+        old = item["event"]
+        if old.uid == event.uid.value:
+            write_event(cal_client, old.name, event, old.etag)
+        else:
+            delete_event(cal_client, old.name, old.etag)
+            write_event(cal_client, "%s.ics" % event.uid.value, event,
+                        create=True)
+
+
+def describe_item(operation: str, item):
+    """
+    Identifies the contact or event an operation is about, for reporting
+    """
+    if operation == "lost":
+        return item.uid
+    if operation == "feed":
+        return item["name"]
+    contact = item["contact"] if operation == "updated" else item
+    return contact.uid.value
+
+
+def dump_operation(operation: str, item):
+    """
+    Serializes an operation, as yielded by iter_triage, for the journal
+
+    Contacts are reduced to their state store record, and events to their
+    compact record. Feed operations are not journaled.
+    """
+    if operation == "new":
+        return json.dumps({"contact": get_card_record(item)})
+    if operation == "lost":
+        return json.dumps({"event": item._asdict()})
+    return json.dumps({"contact": get_card_record(item["contact"]),
+                       "event": item["event"]._asdict()})
+
+
+def load_operation(operation: str, payload: str):
+    """
+    Rebuilds an operation recorded in the journal by dump_operation
+    """
+    details = json.loads(payload)
+    if operation == "new":
+        return operation, build_cached_contact(details["contact"])
+    if operation == "lost":
+        return operation, EventRecord(**details["event"])
+    return operation, {"contact": build_cached_contact(details["contact"]),
+                       "event": EventRecord(**details["event"])}
+
+
+def try_operation(cal_client: Client, card_client: Client, operation: str,
+                  item, limiter: ConcurrencyLimiter = None):
+    """
+    Applies an operation once, from a slot of `limiter` if any
+
+    Returns the error the operation failed with, if any, rather than raising
+    it.
+    """
+    try:
+        if limiter is None:
+            apply_operation(cal_client, card_client, operation, item)
+        else:
+            with limiter.slot():
+                apply_operation(cal_client, card_client, operation, item)
+    except Exception as e:
+        return e
+    return None
+
+
+def finish_operation(operation: str, item, attempts: int, error=None,
+                     journal: OperationJournal = None):
+    """
+    Records the outcome of an operation and builds its result dictionary
+
+    The operation is removed from `journal`, if any, unless it failed. The
+    result holds the operation, its item, a status ("ok", "retried" when it
+    only succeeded after a transient failure, or "failed"), the number of
+    attempts and the last error.
+    """
+    if error is not None:
+        status = "failed"
+    else:
+        status = "ok" if attempts == 1 else "retried"
+    if journal is not None and error is None:
+        journal.complete(operation, describe_item(operation, item))
+    METRICS.add("operations_total", operation=operation, status=status)
+    return {"operation": operation, "item": item, "status": status,
+            "attempts": attempts, "error": error}
+
+
+def attempt_operation(cal_client: Client, card_client: Client,
+                      operation: str, item, retries: int = 0,
+                      limiter: ConcurrencyLimiter = None,
+                      journal: OperationJournal = None):
+    """
+    Applies an operation, attempting it again on transient errors
+
+    Attempts are spaced out as told by get_retry_delay, and made from a slot
+    of `limiter`, if any. Never raises: the outcome is returned as a result
+    dictionary, see finish_operation.
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        error = try_operation(cal_client, card_client, operation, item,
+                              limiter)
+        if error is not None and attempts <= retries and is_transient(error):
+            time.sleep(get_retry_delay(error, attempts))
+            continue
+        return finish_operation(operation, item, attempts, error, journal)
+
+
+def apply_operations(cal_client: Client, card_client: Client, operations,
+                     workers: int = 1, retries: int = 0,
+                     journal: OperationJournal = None):
+    """
+    Applies operations, as yielded by iter_triage, with a pool of workers
+
+    At most `workers` operations are in flight at once: the next operation is
+    only pulled from the iterable when one completes, so that a stream of
+    operations is consumed as it comes. Fewer writes are sent at once while
+    the server asks to slow down, see ConcurrencyLimiter. With a `journal`,
+    the operations it holds are removed from it as they succeed. A failed
+    operation does not interrupt the others; the results are returned in the
+    order of the operations.
+    """
+    futures = []
+    pending = set()
+    limiter = ConcurrencyLimiter(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for operation, item in operations:
+            if len(pending) >= workers:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            future = executor.submit(attempt_operation, cal_client,
+                                     card_client, operation, item, retries,
+                                     limiter, journal)
+            futures.append(future)
+            pending.add(future)
+    return [future.result() for future in futures]
+
+
 def apply_diffs(cal_client: Client, card_client: Client,
-                new: dict, lost: dict, updated: dict):
+                new: dict, lost: dict, updated: dict,
+                workers: int = 1, retries: int = 0):
     """
     Applies contact changes to the associated CalDAV birthday events
     """
-    for new_contact in new:
-        create_birthday_event(cal_client, card_client, new_contact)
-    for lost_contact in lost:
-        cal_client.clean("%s.ics" % lost_contact)
-    for updated_entry in updated:
-        contact, event = updated_entry["contact"], updated_entry["event"]
-        birthdate = datetime.strptime(contact.bday.value, "%Y-%m-%d")
-        event_time = birthdate.replace(hour=8, minute=0, microsecond=0)
+    operations = [("new", item) for item in new] + \
+        [("lost", item) for item in lost] + \
+        [("updated", item) for item in updated]
+    return apply_operations(cal_client, card_client, operations,
+                            workers, retries)
+
+
+def plan_operations(journal: OperationJournal, operations):
+    """
+    Records the operations yielded by iter_triage in the journal, as a plan
+
+    The operations are all recorded at once, once the triage is over, so
+    that an interrupted triage leaves no partial plan behind.
+    """
+    journal.record_plan((operation, describe_item(operation, item),
+                         dump_operation(operation, item))
+                        for operation, item in operations)
+
+
+def get_leftover_uids(journal: OperationJournal):
+    """
+    Lists the contact UIDs concerned by the operations left in the journal
 
-        event.vevent.dtstart.value = event_time
-        with NamedTemporaryFile("w") as tmp_file:
-            tmp_file.write(event.serialize())
-            tmp_file.flush()
-            cal_client.upload("%s.ics" % event.uid.value, tmp_file.name)
+    These are the operations which failed during the last finished plan:
+    their contacts are triaged again against fresh data, rather than the
+    operations being replayed.
+    """
+    uids = set()
+    for operation, payload in journal.get_operations():
+        _, item = load_operation(operation, payload)
+        if operation in ("new", "updated"):
+            contact = item["contact"] if operation == "updated" else item
+            uids.add(contact.uid.value)
+        if operation in ("lost", "updated"):
+            event = item["event"] if operation == "updated" else item
+            uids.add(event.card_uid)
+    return uids
+
+
+def resume_operations(cal_client: Client, card_client: Client,
+                      journal: OperationJournal, workers: int = 1,
+                      retries: int = 0):
+    """
+    Applies the operations left in the journal, and finishes its plan
+
+    Nothing is fetched beforehand. Writes are conditional, so that an
+    operation applied just before an interruption is turned down by the
+    server and then checked on its own, see write_event and delete_event.
+    An operation made moot by a change since the plan was recorded may
+    still be applied: the next run's triage then reverts it.
+    """
+    operations = [load_operation(operation, payload) for
+                  operation, payload in journal.get_operations()]
+    results = apply_operations(cal_client, card_client, operations, workers,
+                               retries, journal)
+    journal.finish_plan()
+    return results
 
 
-def sync_birthdays(card_client: Client, cal_client: Client):  # pragma: no cover
+def sync_birthdays(card_client: Client, cal_client: Client,
+                   fetch_workers: int = 1, reports: bool = True,
+                   state_path: str = None, delta: bool = False,
+                   write_workers: int = 1, write_retries: int = 0,
+                   feed: str = None):  # pragma: no cover
     """
     Fetches contacts and events and syncs them
+
+    Events are fetched first, contacts are then streamed through the triage
+    and, without a state store, changes are applied as they come: events for
+    new contacts are created while the address book is still being fetched.
+    In delta mode, only the
+    contacts concerned by the changes made since the last run are compared
+    to their events, unless a collection had to be synced whole again.
+
+    Writes are spread over `write_workers` threads. Failed operations do not
+    stop the sync, but an ApplyError is raised once everything else has been
+    applied, so that they are attempted again on the next run. The
+    per-operation results are returned otherwise.
+
+    With a state store, the triage is rather completed first, and its plan
+    is recorded in a journal next to the store, which is committed right
+    away. Operations are then applied from the journal, and failed ones are
+    kept in it, so that the next run triages their contacts again. A run
+    finding an unfinished plan in the journal applies what is left of it,
+    without fetching anything.
+
+    With a `feed` name, all birthdays are rather written to that single
+    calendar resource, only when the contacts changed since it was written.
+    Delta mode requires a state store: a ValueError is raised otherwise.
     """
-    contacts = get_born_contacts(card_client)
-    events = get_events(cal_client, card_client)
-    new, lost, updated = triage_events(contacts, events)
-    apply_diffs(cal_client, card_client, new, lost, updated)
+    if delta and state_path is None:
+        raise ValueError("delta sync requires a state_path")
+
+    state = journal = None
+    if state_path is not None:
+        state = StateStore(state_path)
+        journal = OperationJournal(get_journal_path(state_path),
+                                   cal_client.webdav.hostname)
+
+    with METRICS.timed("sync"):
+        try:
+            if delta:
+                state.track_changed_uids()
+            if journal is not None and journal.is_planned():
+                results = resume_operations(cal_client, card_client, journal,
+                                            write_workers, write_retries)
+            elif feed is not None:
+                contacts = get_born_contacts(card_client, fetch_workers,
+                                             reports, state, delta)
+                operations = triage_feed(cal_client, card_client, feed,
+                                         contacts, state)
+                results = apply_operations(cal_client, card_client,
+                                           operations, write_workers,
+                                           write_retries)
+            else:
+                if journal is not None:
+                    state.add_changed_uids(get_leftover_uids(journal))
+                events = get_events(cal_client, card_client, fetch_workers,
+                                    reports, state, delta)
+                contacts = iter_born_contacts(card_client, fetch_workers,
+                                              reports, state, delta)
+                relevant = state.may_have_changed if delta else None
+                operations = iter_triage(contacts, events, relevant)
+                if journal is None:
+                    results = apply_operations(cal_client, card_client,
+                                               operations, write_workers,
+                                               write_retries)
+                else:
+                    plan_operations(journal, operations)
+                    state.commit()
+                    results = resume_operations(cal_client, card_client,
+                                                journal, write_workers,
+                                                write_retries)
+            if any(result["status"] == "failed" for result in results):
+                raise ApplyError(results)
+            if state is not None:
+                state.commit()
+            METRICS.set("last_success_timestamp_seconds", time.time())
+            return results
+        finally:
+            if state is not None:
+                state.close()
+                journal.close()
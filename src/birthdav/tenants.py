@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from birthdav.dav import get_client, get_session
+from birthdav.sync import sync_birthdays
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+
+def sync_tenant(tenant: dict):
+    """
+    Syncs the address book and calendar of a single tenant
+
+    Never raises: the outcome is returned as a result dictionary holding the
+    tenant's name, a status ("ok" or "failed"), the number of operations
+    applied, the duration of the sync in seconds and the error, if any.
+    """
+    start = time.monotonic()
+    result = {"name": tenant["name"], "status": "ok", "operations": 0,
+              "error": None}
+    try:
+        session = get_session(**tenant["http"])
+        card_client = get_client(tenant["card"], session)
+        cal_client = get_client(tenant["cal"], session)
+        operations = sync_birthdays(card_client, cal_client, **tenant["sync"])
+        result["operations"] = len(operations)
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = e
+    result["duration"] = time.monotonic() - start
+    return result
+
+
+def sync_tenants(tenants: list, workers: int = 1):
+    """
+    Syncs many tenants, at most `workers` of them at once
+
+    Each tenant is synced in its own thread with its own clients and HTTP
+    session, so that a slow or failing tenant does not hold the others back.
+    The results of sync_tenant are returned in the order of the tenants.
+    """
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return list(executor.map(sync_tenant, tenants))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from birthdav.metrics import METRICS
+
+from webdav3.exceptions import ResponseErrorCode
+from contextlib import contextmanager
+import threading
+import random
+
+
+# Initial and longest delays before a failed request is attempted again, in
+# seconds, when the server did not tell how long to wait
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+
+# Longest Retry-After delay honoured, in seconds
+RETRY_AFTER_MAX = 300
+
+
+class ThrottledError(ResponseErrorCode):
+    """
+    Raised when a server turns a request down until later, with a 429 or 503
+    status and possibly a Retry-After delay, in seconds
+    """
+    def __init__(self, url: str, code: int, message: str,
+                 retry_after: float = None):
+        super().__init__(url, code, message)
+        self.retry_after = retry_after
+
+
+def get_retry_delay(error: Exception, attempts: int):
+    """
+    Determines how long to wait before attempting a failed request again
+
+    The Retry-After delay of a ThrottledError is honoured, up to
+    RETRY_AFTER_MAX. Otherwise, the delay grows exponentially with the
+    number of `attempts` made so far, up to BACKOFF_MAX. Either way, a random
+    jitter keeps the workers turned down at once from coming back together.
+    """
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        return min(retry_after, RETRY_AFTER_MAX) + \
+            random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_BASE * 2 ** (attempts - 1),
+                                 BACKOFF_MAX))
+
+
+class ConcurrencyLimiter:
+    """
+    Adapts the number of requests in flight to a server's throttling
+
+    Requests are sent from slots, of which at most `limit` are taken at once.
+    The limit starts at `maximum`, is halved whenever the server asks to slow
+    down and grows back by one slot once `limit` requests in a row went
+    through (additive increase, multiplicative decrease). Requests which were
+    already in flight when the limit was halved do not halve it again. The
+    limit is exported as the `gauge` metric.
+    """
+    def __init__(self, maximum: int, gauge: str = "write_concurrency"):
+        self.gauge = gauge
+        self.maximum = max(maximum, 1)
+        self.limit = self.maximum
+        self.active = 0
+        self.successes = 0
+        self.epoch = 0
+        self.condition = threading.Condition()
+        METRICS.set(self.gauge, self.limit)
+
+    @contextmanager
+    def slot(self):
+        """
+        Waits for a free slot and holds it while the request is sent
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+            epoch = self.epoch
+
+        throttled = False
+        try:
+            yield
+        except ThrottledError:
+            throttled = True
+            raise
+        finally:
+            with self.condition:
+                self.active -= 1
+                if throttled:
+                    self.decrease(epoch)
+                else:
+                    self.increase()
+                self.condition.notify_all()
+
+    def decrease(self, epoch: int):
+        """
+        Halves the limit, unless it was already halved since `epoch`
+        """
+        if epoch != self.epoch:
+            return
+        self.epoch += 1
+        self.successes = 0
+        self.limit = max(self.limit // 2, 1)
+        METRICS.set(self.gauge, self.limit)
+
+    def increase(self):
+        """
+        Counts a request that went through, adding a slot after `limit` of
+        them
+        """
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.maximum:
+            self.successes = 0
+            self.limit += 1
+            METRICS.set(self.gauge, self.limit)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from birthdav.dav import get_collection_tag, FetchError
+from birthdav.sync import sync_birthdays, ApplyError
+
+from webdav3.exceptions import WebDavException
+from webdav3.client import Client
+import threading
+import requests
+import sys
+
+
+# Errors after which the watcher carries on, attempting the sync again at the
+# next poll
+RECOVERABLE_ERRORS = (WebDavException, FetchError, ApplyError,
+                      requests.RequestException)
+
+
+def watch_birthdays(card_client: Client, cal_client: Client, interval: int,
+                    stop: threading.Event = None, on_sync=None,
+                    **options):
+    """
+    Syncs birthdays whenever the address book changes, until stopped
+
+    The clients, and their connections, are kept from one sync to the next.
+    Every `interval` seconds, the address book's CTag or sync token is fetched
+    with a single request, and sync_birthdays, given the other `options`, only
+    runs when it changed since the last successful sync. Servers exposing
+    neither have the sync run at every poll. Failures are reported on stderr
+    and do not stop the watcher. When given, `on_sync` is called after each
+    sync, successful or not.
+    """
+    stop = stop or threading.Event()
+    synced_tag = None
+    while not stop.is_set():
+        try:
+            tag = get_collection_tag(card_client)
+            if tag is None or tag != synced_tag:
+                try:
+                    sync_birthdays(card_client, cal_client, **options)
+                finally:
+                    if on_sync is not None:
+                        on_sync()
+                synced_tag = tag
+        except RECOVERABLE_ERRORS as e:
+            print(str(e), file=sys.stderr)
+        stop.wait(interval)
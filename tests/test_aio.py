@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from webdav3.client import WebDAVSettings
+from webdav3.exceptions import ResponseErrorCode
+from tempfile import TemporaryDirectory
+from unittest.mock import Mock, patch
+import threading
+import unittest
+import asyncio
+import pathlib
+import os
+
+from birthdav.dav import FetchError, get_client
+from birthdav.aio import get_vobjects, apply_operations, apply_diffs, \
+    sync_birthdays
+from birthdav.sync import EventRecord, ApplyError
+
+
+CARD = "BEGIN:VCARD\r\nVERSION:3.0\r\nUID:%s\r\nN:Bar;Foo;;;\r\n" \
+    "BDAY:%s\r\nEND:VCARD\r\n"
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestAio(unittest.TestCase):
+    @staticmethod
+    def dummy_client(MockClient):
+        mock_client = MockClient()
+        mock_client.webdav = WebDAVSettings({"hostname": "http://foo"})
+        return mock_client
+
+    @staticmethod
+    def lost(uid):
+        return EventRecord("%s.ics" % uid, None, uid, uid, "http://foo",
+                           None, None, None)
+
+    @patch("birthdav.aio.fetch_vobject")
+    @patch("birthdav.aio.list_resources")
+    def test_get_vobjects(self, mock_list, mock_fetch):
+        names = ["%d.vcf" % i for i in range(10)]
+        mock_list.return_value = dict.fromkeys(names)
+        mock_fetch.side_effect = lambda client, name, *args: name.upper()
+
+        vobjs = run(get_vobjects(Mock(), workers=3))
+
+        self.assertEqual(vobjs, [n.upper() for n in names],
+                         msg="objects out of order")
+
+    @patch("birthdav.aio.get_retry_delay", return_value=0)
+    @patch("birthdav.aio.fetch_vobject")
+    @patch("birthdav.aio.list_resources")
+    def test_get_vobjects_listing(self, mock_list, mock_fetch, mock_delay):
+        mock_list.side_effect = [ResponseErrorCode("", 429, "slow down"),
+                                 {"a.vcf": None}]
+        mock_fetch.side_effect = lambda client, name, *args: name
+
+        self.assertEqual(run(get_vobjects(Mock())), ["a.vcf"],
+                         msg="throttled listing was not retried")
+        self.assertEqual(mock_list.call_args[0][1], 0,
+                         msg="listing was retried from a thread")
+
+    @patch("birthdav.aio.get_retry_delay", return_value=0)
+    @patch("birthdav.aio.fetch_vobject")
+    def test_get_vobjects_errors(self, mock_fetch, mock_delay):
+        def fetch(client, name, *args):
+            if name == "bad.vcf":
+                raise ResponseErrorCode("", 403, "denied")
+            if name == "busy.vcf" and mock_fetch.call_count < 4:
+                raise ResponseErrorCode("", 503, "busy")
+            return name
+        mock_fetch.side_effect = fetch
+
+        with self.assertRaises(FetchError) as context:
+            run(get_vobjects(Mock(), 1, ["a.vcf", "bad.vcf", "busy.vcf"]))
+        self.assertEqual(list(context.exception.errors), ["bad.vcf"],
+                         msg="transient failure was not retried")
+        self.assertEqual(mock_fetch.call_count, 4,
+                         msg="failure interrupted the other downloads")
+
+    @patch("birthdav.sync.delete_vobject")
+    @patch("webdav3.client.Client")
+    def test_apply_concurrency(self, MockClient, mock_delete):
+        mock_client = self.dummy_client(MockClient)
+        lock = threading.Lock()
+        running = {"now": 0, "max": 0}
+
+        def delete(client, path, if_match=None):
+            with lock:
+                running["now"] += 1
+                running["max"] = max(running["max"], running["now"])
+            threading.Event().wait(0.01)
+            with lock:
+                running["now"] -= 1
+        mock_delete.side_effect = delete
+
+        operations = [("lost", self.lost("event%d" % i)) for i in range(12)]
+        results = run(apply_operations(mock_client, mock_client, operations,
+                                       workers=3))
+
+        self.assertEqual([r["item"] for r in results],
+                         [item for _, item in operations],
+                         msg="results out of order")
+        self.assertTrue(all(r["status"] == "ok" for r in results))
+        self.assertLessEqual(running["max"], 3, msg="too many writers")
+        self.assertGreater(running["max"], 1, msg="writes were sequential")
+
+    @patch("birthdav.sync.delete_vobject")
+    @patch("webdav3.client.Client")
+    def test_apply_failures(self, MockClient, mock_delete):
+        mock_client = self.dummy_client(MockClient)
+
+        def delete(client, path, if_match=None):
+            if path == "b.ics":
+                raise ResponseErrorCode("", 403, "denied")
+        mock_delete.side_effect = delete
+
+        lost = [self.lost(uid) for uid in ("a", "b", "c")]
+        results = run(apply_diffs(mock_client, mock_client, [], lost, [],
+                                  workers=2))
+        self.assertEqual([r["status"] for r in results],
+                         ["ok", "failed", "ok"],
+                         msg="failure interrupted the other writes")
+
+    @patch("time.sleep")
+    @patch("birthdav.aio.get_retry_delay", return_value=0)
+    @patch("birthdav.sync.delete_vobject")
+    @patch("webdav3.client.Client")
+    def test_apply_retries(self, MockClient, mock_delete, mock_delay,
+                           mock_sleep):
+        mock_client = self.dummy_client(MockClient)
+        threads = set()
+
+        def delete(client, path, if_match=None):
+            threads.add(threading.current_thread().name)
+            if mock_delete.call_count == 1:
+                raise ResponseErrorCode("", 503, "unavailable")
+        mock_delete.side_effect = delete
+
+        results = run(apply_operations(mock_client, mock_client,
+                                       [("lost", self.lost("a"))],
+                                       retries=1))
+        self.assertEqual([r["status"] for r in results], ["retried"])
+        mock_delay.assert_called_once()
+        self.assertFalse(mock_sleep.called,
+                         msg="a thread was held between attempts")
+        self.assertTrue(all(name.startswith("birthdav") for name in threads),
+                        msg="writes ran in the default executor")
+
+    @patch("webdav3.client.Client")
+    def test_delta_without_state(self, MockClient):
+        mock_client = self.dummy_client(MockClient)
+        with self.assertRaises(ValueError):
+            run(sync_birthdays(mock_client, mock_client, delta=True))
+
+
+class TestAioLocal(unittest.TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        for name in ("card", "cal"):
+            os.mkdir(os.path.join(self.root, name))
+        self.card_client = self.get_client("card")
+        self.cal_client = self.get_client("cal")
+        self.state_path = os.path.join(self.root, "state.db")
+
+    def get_client(self, name: str):
+        url = pathlib.Path(self.root, name).as_uri()
+        return get_client({"url": url, "user": None, "pass": None})
+
+    def write_card(self, uid: str, bday: str):
+        path = os.path.join(self.root, "card", "%s.vcf" % uid)
+        with open(path, "w", newline="") as card_file:
+            card_file.write(CARD % (uid, bday))
+
+    def sync(self, **kwargs):
+        return run(sync_birthdays(self.card_client, self.cal_client,
+                                  **kwargs))
+
+    def events(self):
+        return sorted(os.listdir(os.path.join(self.root, "cal")))
+
+    def test_sync(self):
+        self.write_card("a", "1970-01-01")
+        self.write_card("b", "1980-01-01")
+
+        results = self.sync(state_path=self.state_path, write_workers=2)
+        self.assertEqual([r["operation"] for r in results], ["new", "new"])
+        self.assertEqual(len(self.events()), 2)
+        self.assertEqual(self.sync(state_path=self.state_path), [],
+                         msg="no-op sync was not a no-op")
+
+        os.remove(os.path.join(self.root, "card", "b.vcf"))
+        results = self.sync(state_path=self.state_path)
+        self.assertEqual([r["operation"] for r in results], ["lost"])
+        self.assertEqual(len(self.events()), 1)
+        self.assertEqual(self.sync(), [], msg="stateless sync was not a no-op")
+
+    def test_fetch_error(self):
+        self.write_card("a", "1970-01-01")
+        with patch("birthdav.sync.get_events", side_effect=IOError()):
+            with self.assertRaises(IOError):
+                self.sync(state_path=self.state_path)
+        self.assertEqual(self.events(), [])
+
+        results = self.sync(state_path=self.state_path)
+        self.assertEqual([r["operation"] for r in results], ["new"],
+                         msg="state was kept after a failed fetch")
+
+    def test_apply_error(self):
+        self.write_card("a", "1970-01-01")
+        error = ResponseErrorCode("", 403, "denied")
+        with patch("birthdav.sync.create_birthday_event", side_effect=error):
+            with self.assertRaises(ApplyError):
+                self.sync(state_path=self.state_path)
+
+        results = self.sync(state_path=self.state_path)
+        self.assertEqual([r["operation"] for r in results], ["new"],
+                         msg="failed operation was not attempted again")
+
+    def test_resume(self):
+        self.write_card("a", "1970-01-01")
+        self.write_card("b", "1980-01-01")
+        with patch("birthdav.aio.apply_operations", side_effect=IOError()):
+            with self.assertRaises(IOError):
+                self.sync(state_path=self.state_path)
+        self.assertEqual(self.events(), [])
+
+        with patch("birthdav.sync.get_events", side_effect=IOError()):
+            results = self.sync(state_path=self.state_path)
+        self.assertEqual([r["operation"] for r in results], ["new", "new"],
+                         msg="plan was not resumed without fetching")
+        self.assertEqual(self.sync(state_path=self.state_path), [])
+
+    def test_feed(self):
+        self.write_card("a", "1970-01-01")
+        results = self.sync(state_path=self.state_path, feed="birthdays.ics")
+        self.assertEqual([r["operation"] for r in results], ["feed"])
+        self.assertEqual(self.events(), ["birthdays.ics"])
+        self.assertEqual(self.sync(state_path=self.state_path,
+                                   feed="birthdays.ics"), [])
+
+        self.write_card("b", "1980-01-01")
+        results = self.sync(state_path=self.state_path, feed="birthdays.ics")
+        self.assertEqual([r["operation"] for r in results], ["feed"])
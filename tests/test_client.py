@@ -17,10 +17,116 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
+from webdav3.exceptions import \
+    MethodNotSupported, \
+    RemoteResourceNotFound, \
+    ResponseErrorCode
 from unittest.mock import Mock, patch
 import unittest
 
-from birthdav.dav import get_client, get_vobjects
+from birthdav.dav import \
+    get_client, \
+    get_session, \
+    get_collection_tag, \
+    get_vobjects, \
+    iter_vobjects, \
+    list_resources, \
+    multiget_cards, \
+    refetch_vobject, \
+    upload_vobject, \
+    delete_vobject, \
+    query_cards, \
+    query_events, \
+    list_events, \
+    sync_collection, \
+    FetchError, \
+    ReportError, \
+    ThrottledError, \
+    is_transient, \
+    parse_retry_after, \
+    raise_throttled, \
+    SyncTokenError, \
+    FETCH_RETRIES
+
+
+MULTISTATUS = b"""<?xml version="1.0" encoding="utf-8"?>
+<d:multistatus xmlns:d="DAV:" xmlns:card="urn:ietf:params:xml:ns:carddav">
+  <d:response>
+    <d:href>/dav/book/a%20b.vcf</d:href>
+    <d:propstat>
+      <d:prop>
+        <d:getetag>"1"</d:getetag>
+        <card:address-data>BEGIN:VCARD
+UID:a
+END:VCARD
+</card:address-data>
+      </d:prop>
+      <d:status>HTTP/1.1 200 OK</d:status>
+    </d:propstat>
+  </d:response>
+  <d:response>
+    <d:href>/dav/book/c.vcf</d:href>
+    <d:propstat>
+      <d:prop><card:address-data/></d:prop>
+      <d:status>HTTP/1.1 404 Not Found</d:status>
+    </d:propstat>
+  </d:response>
+</d:multistatus>
+"""
+
+SYNC_MULTISTATUS = b"""<?xml version="1.0" encoding="utf-8"?>
+<d:multistatus xmlns:d="DAV:">
+  <d:response>
+    <d:href>/dav/book/a.vcf</d:href>
+    <d:propstat>
+      <d:prop><d:getetag>"2"</d:getetag></d:prop>
+      <d:status>HTTP/1.1 200 OK</d:status>
+    </d:propstat>
+  </d:response>
+  <d:response>
+    <d:href>/dav/book/b.vcf</d:href>
+    <d:status>HTTP/1.1 404 Not Found</d:status>
+  </d:response>
+  <d:response>
+    <d:href>/dav/book/c.txt</d:href>
+    <d:status>HTTP/1.1 404 Not Found</d:status>
+  </d:response>
+  <d:sync-token>http://foo/sync/2</d:sync-token>
+</d:multistatus>
+"""
+
+TRUNCATED_SYNC_MULTISTATUS = b"""<?xml version="1.0" encoding="utf-8"?>
+<d:multistatus xmlns:d="DAV:">
+  <d:response>
+    <d:href>/dav/book/b.vcf</d:href>
+    <d:propstat>
+      <d:prop><d:getetag>"1"</d:getetag></d:prop>
+      <d:status>HTTP/1.1 200 OK</d:status>
+    </d:propstat>
+  </d:response>
+  <d:response>
+    <d:href>/dav/book/</d:href>
+    <d:status>HTTP/1.1 507 Insufficient Storage</d:status>
+  </d:response>
+  <d:sync-token>http://foo/sync/1</d:sync-token>
+</d:multistatus>
+"""
+
+COLLECTION_PROPS = b"""<?xml version="1.0" encoding="utf-8"?>
+<d:multistatus xmlns:d="DAV:" xmlns:cs="http://calendarserver.org/ns/">
+  <d:response>
+    <d:href>/dav/book/</d:href>
+    <d:propstat>
+      <d:prop><d:sync-token>http://foo/sync/3</d:sync-token></d:prop>
+      <d:status>HTTP/1.1 200 OK</d:status>
+    </d:propstat>
+    <d:propstat>
+      <d:prop><cs:getctag>%s</cs:getctag></d:prop>
+      <d:status>HTTP/1.1 %s</d:status>
+    </d:propstat>
+  </d:response>
+</d:multistatus>
+"""
 
 
 class TestClient(unittest.TestCase):
@@ -34,16 +140,31 @@ class TestClient(unittest.TestCase):
         self.assertEqual(client.webdav.hostname, "http://foo")
         self.assertEqual(client.webdav.login, "foo")
         self.assertEqual(client.webdav.password, "bar")
+        self.assertEqual(client.requests["report"], "REPORT")
+
+    def test_shared_session(self):
+        session = get_session(pool_size=16, compress=False)
+        card_client = get_client({"url": "http://foo/card/", "user": None,
+                                  "pass": None}, session)
+        cal_client = get_client({"url": "http://foo/cal/", "user": None,
+                                 "pass": None}, session)
+
+        self.assertIs(card_client.session, session)
+        self.assertIs(cal_client.session, session,
+                      msg="clients do not share their connections")
+        self.assertEqual(session.get_adapter("https://foo")._pool_maxsize,
+                         16, msg="connection pool was not sized")
+        self.assertEqual(session.headers["Accept-Encoding"], "identity")
+        self.assertIn("gzip", get_session().headers["Accept-Encoding"],
+                      msg="compressed responses are not accepted")
 
     @staticmethod
-    def mock_downloader(vobj, tmp):
-        with open(tmp, "w") as tmp_file:
-            tmp_file.write(vobj)
+    def mock_downloader(action, path):
+        return Mock(content=path.lstrip("/").encode("utf-8"))
 
     @staticmethod
-    def mock_parser(tmp):
-        with open(tmp.name) as tmp_file:
-            return "contents_" + next(tmp_file)
+    def mock_parser(data):
+        return "contents_" + data
 
     @patch("vobject.readOne")
     @patch("webdav3.client.Client")
@@ -52,10 +173,347 @@ class TestClient(unittest.TestCase):
         client.list = Mock(return_value=[
             "a.txt", "b.ics", "c.ics", "d.vcf", "e.vcf", "f"
         ])
-        client.download = Mock(side_effect=self.mock_downloader)
+        client.execute_request = Mock(side_effect=self.mock_downloader)
         mockReadOne.side_effect = self.mock_parser
 
         self.assertEqual(get_vobjects(client), [
             "contents_b.ics", "contents_c.ics",
             "contents_d.vcf", "contents_e.vcf"
         ])
+
+    @patch("webdav3.client.Client")
+    def test_get_vobjects_single_request(self, MockClient):
+        client = MockClient()
+        client.list = Mock(return_value=["a b.vcf"])
+        client.execute_request = Mock(return_value=Mock(
+            content="BEGIN:VCARD\r\nFN:Zoë\r\nEND:VCARD\r\n".encode("utf-8")
+        ))
+
+        vobjs = get_vobjects(client)
+
+        client.execute_request.assert_called_once_with("download",
+                                                       "/a%20b.vcf")
+        self.assertFalse(client.download.called or client.check.called,
+                         msg="went through the temporary file download path")
+        self.assertEqual(vobjs[0].fn.value, "Zoë")
+
+    @patch("time.sleep")
+    @patch("webdav3.client.Client")
+    def test_get_vobjects_retries(self, MockClient, mock_sleep):
+        client = MockClient()
+        client.execute_request = Mock(side_effect=[
+            ThrottledError("", 429, "slow down", retry_after=2),
+            Mock(content=b"BEGIN:VCARD\r\nFN:Foo\r\nEND:VCARD\r\n"),
+            RemoteResourceNotFound("b.vcf"),
+        ])
+
+        with self.assertRaises(FetchError) as context:
+            get_vobjects(client, names=["a.vcf", "b.vcf"])
+        self.assertEqual(list(context.exception.errors), ["b.vcf"],
+                         msg="transient failure was not retried")
+        self.assertEqual(client.execute_request.call_count, 3,
+                         msg="missing resource was fetched again")
+        self.assertGreaterEqual(mock_sleep.call_args[0][0], 2,
+                                msg="Retry-After delay was not honoured")
+
+    @patch("webdav3.client.Client")
+    def test_upload_vobject(self, MockClient):
+        client = MockClient()
+        vobj = Mock()
+        vobj.serialize = Mock(return_value="BEGIN:VCALENDAR\r\nZoë")
+
+        upload_vobject(client, "a b.ics", vobj)
+
+        client.execute_request.assert_called_once_with(
+            "upload", "/a%20b.ics", data="BEGIN:VCALENDAR\r\nZoë".encode(),
+            headers_ext=[]
+        )
+        self.assertFalse(client.upload.called,
+                         msg="went through the temporary file upload path")
+
+    @patch("webdav3.client.Client")
+    def test_conditional_writes(self, MockClient):
+        client = MockClient()
+        client.execute_request.return_value = Mock(headers={"ETag": "2"})
+        vobj = Mock()
+        vobj.serialize = Mock(return_value="BEGIN:VCALENDAR")
+
+        self.assertEqual(upload_vobject(client, "a.ics", vobj, if_match="1"),
+                         "2", msg="new ETag was not returned")
+        self.assertEqual(client.execute_request.call_args[1]["headers_ext"],
+                         ["If-Match: 1"])
+        upload_vobject(client, "a.ics", vobj, if_none_match="*")
+        self.assertEqual(client.execute_request.call_args[1]["headers_ext"],
+                         ["If-None-Match: *"])
+
+        delete_vobject(client, "a.ics", if_match="2")
+        client.execute_request.assert_called_with(
+            "clean", "/a.ics", headers_ext=["If-Match: 2"]
+        )
+        client.execute_request.side_effect = RemoteResourceNotFound("/a.ics")
+        delete_vobject(client, "a.ics", if_match="2")
+        self.assertEqual(refetch_vobject(client, "a.ics"), (None, None),
+                         msg="missing file was not reported as such")
+
+    @patch("vobject.readOne")
+    @patch("webdav3.client.Client")
+    def test_get_vobjects_parallel(self, MockClient, mockReadOne):
+        client = MockClient()
+        client.list = Mock(return_value=["%d.vcf" % i for i in range(32)])
+        client.execute_request = Mock(side_effect=self.mock_downloader)
+        mockReadOne.side_effect = self.mock_parser
+
+        self.assertEqual(get_vobjects(client, workers=8),
+                         ["contents_%d.vcf" % i for i in range(32)],
+                         msg="objects were not returned in listing order")
+
+    @patch("vobject.readOne")
+    @patch("webdav3.client.Client")
+    def test_iter_vobjects_window(self, MockClient, mockReadOne):
+        client = MockClient()
+        client.execute_request = Mock(side_effect=self.mock_downloader)
+        mockReadOne.side_effect = self.mock_parser
+
+        vobjs = iter_vobjects(client, 2, ["%d.vcf" % i for i in range(32)])
+        self.assertEqual(next(vobjs), ("0.vcf", "contents_0.vcf"))
+        self.assertLessEqual(client.execute_request.call_count, 5,
+                             msg="downloads went too far ahead")
+        self.assertEqual(len(list(vobjs)), 31)
+
+    @patch("vobject.readOne")
+    @patch("webdav3.client.Client")
+    def test_get_vobjects_errors(self, MockClient, mockReadOne):
+        def failing_downloader(action, path):
+            if path in ("/b.vcf", "/d.vcf"):
+                raise IOError("broken %s" % path)
+            return self.mock_downloader(action, path)
+
+        client = MockClient()
+        client.list = Mock(return_value=["a.vcf", "b.vcf", "c.vcf", "d.vcf"])
+        client.execute_request = Mock(side_effect=failing_downloader)
+        mockReadOne.side_effect = self.mock_parser
+
+        with self.assertRaises(FetchError) as ctx:
+            get_vobjects(client, workers=2)
+
+        self.assertEqual(sorted(ctx.exception.errors), ["b.vcf", "d.vcf"],
+                         msg="failures were not reported per resource")
+        self.assertEqual(client.execute_request.call_count, 4,
+                         msg="a failure interrupted the other downloads")
+
+    @patch("vobject.readOne")
+    @patch("webdav3.client.Client")
+    def test_query_cards(self, MockClient, mockReadOne):
+        client = MockClient()
+        client.execute_request = Mock(return_value=Mock(content=MULTISTATUS))
+        mockReadOne.side_effect = lambda data: "parsed_" + data.split()[1]
+
+        self.assertEqual(list(query_cards(client, "BDAY")),
+                         [("a b.vcf", "parsed_UID:a")],
+                         msg="invalid REPORT response parsing")
+
+        action, path = client.execute_request.call_args[0]
+        body = client.execute_request.call_args[1]["data"]
+        self.assertEqual(action, "report")
+        self.assertIn(b"addressbook-query", body)
+        self.assertIn(b'name="BDAY"', body)
+
+    @patch("webdav3.client.Client")
+    def test_query_cards_unsupported(self, MockClient):
+        client = MockClient()
+        for error in (MethodNotSupported("report", "http://foo"),
+                      ResponseErrorCode("http://foo", 501, "")):
+            client.execute_request = Mock(side_effect=error)
+            with self.assertRaises(ReportError, msg="missed %r" % error):
+                query_cards(client, "BDAY")
+
+        client.execute_request = Mock(return_value=Mock(content=b"nope"))
+        with self.assertRaises(ReportError, msg="accepted invalid XML"):
+            query_cards(client, "BDAY")
+
+        truncated = MULTISTATUS.replace(b"</d:multistatus>", b"""  <d:response>
+    <d:href>/dav/book/</d:href>
+    <d:status>HTTP/1.1 507 Insufficient Storage</d:status>
+  </d:response>
+</d:multistatus>""")
+        client.execute_request = Mock(return_value=Mock(content=truncated))
+        with self.assertRaises(ReportError,
+                               msg="truncated results taken as complete"):
+            list(query_cards(client, "BDAY"))
+
+    @patch("time.sleep")
+    @patch("webdav3.client.Client")
+    def test_query_cards_error(self, MockClient, mock_sleep):
+        client = MockClient()
+        error = ResponseErrorCode("http://foo", 500, "")
+        client.execute_request = Mock(side_effect=error)
+        with self.assertRaises(ResponseErrorCode,
+                               msg="server error mistaken for no support"):
+            query_cards(client, "BDAY")
+        self.assertEqual(client.execute_request.call_count,
+                         1 + FETCH_RETRIES, msg="REPORT was not retried")
+        self.assertEqual(mock_sleep.call_count, FETCH_RETRIES)
+
+    @patch("vobject.readOne")
+    @patch("webdav3.client.Client")
+    def test_query_events(self, MockClient, mockReadOne):
+        client = MockClient()
+        content = MULTISTATUS.replace(b"address-data", b"calendar-data")
+        content = content.replace(b"carddav", b"caldav")
+        client.execute_request = Mock(return_value=Mock(content=content))
+        mockReadOne.side_effect = lambda data: "parsed_" + data.split()[1]
+
+        self.assertEqual(list(query_events(client, {"X-FOO": None,
+                                                    "X-BAR": "b"})),
+                         [("a b.vcf", "parsed_UID:a")],
+                         msg="invalid REPORT parsing")
+
+        body = client.execute_request.call_args[1]["data"]
+        self.assertIn(b"calendar-query", body)
+        self.assertIn(b'name="VCALENDAR"', body)
+        self.assertIn(b'name="X-FOO" />', body)
+        self.assertIn(b'collation="i;octet">b<', body)
+
+    @patch("webdav3.client.Client")
+    def test_list_events(self, MockClient):
+        client = MockClient()
+        client.execute_request = Mock(return_value=Mock(content=MULTISTATUS))
+
+        self.assertEqual(list_events(client, {"X-FOO": None}),
+                         {"a b.vcf": '"1"'})
+
+        body = client.execute_request.call_args[1]["data"]
+        self.assertIn(b"calendar-query", body)
+        self.assertIn(b"getetag", body)
+        self.assertNotIn(b"calendar-data", body,
+                         msg="asked for calendar data to list events")
+        self.assertIn(b'name="X-FOO" />', body)
+
+    @patch("webdav3.client.Client")
+    def test_list_resources(self, MockClient):
+        client = MockClient()
+        client.list = Mock(return_value=[
+            {"path": "/dav/book/a b.vcf", "etag": '"1"', "isdir": False},
+            {"path": "/dav/book/c.txt", "etag": '"2"', "isdir": False},
+            {"path": "/dav/book/d.vcf/", "etag": None, "isdir": True},
+            {"path": "/dav/book/e.ics", "etag": None, "isdir": False},
+        ])
+
+        self.assertEqual(list_resources(client),
+                         {"a b.vcf": '"1"', "e.ics": None})
+        client.list.assert_called_once_with(get_info=True)
+
+    @patch("vobject.readOne")
+    def test_multiget_cards(self, mockReadOne):
+        client = get_client({
+            "url": "http://foo/dav/book",
+            "user": None,
+            "pass": None
+        })
+        client.execute_request = Mock(return_value=Mock(content=MULTISTATUS))
+        mockReadOne.side_effect = lambda data: "parsed_" + data.split()[1]
+
+        names = ["a b.vcf", "c.vcf", "d.vcf"]
+        vobjs = dict(multiget_cards(client, names))
+
+        self.assertEqual(vobjs, {"a b.vcf": "parsed_UID:a"},
+                         msg="invalid multiget response parsing")
+        body = client.execute_request.call_args[1]["data"]
+        self.assertIn(b"addressbook-multiget", body)
+        self.assertIn(b"/dav/book/a%20b.vcf</", body)
+        self.assertIn(b"/dav/book/d.vcf</", body)
+
+    @patch("webdav3.client.Client")
+    def test_sync_collection(self, MockClient):
+        client = MockClient()
+        client.execute_request = Mock(side_effect=[
+            Mock(content=TRUNCATED_SYNC_MULTISTATUS),
+            Mock(content=SYNC_MULTISTATUS),
+        ])
+
+        token, changed, deleted = sync_collection(client, "http://foo/sync/0")
+
+        self.assertEqual(token, "http://foo/sync/2")
+        self.assertEqual(changed, {"a.vcf": '"2"'})
+        self.assertEqual(deleted, {"b.vcf"})
+
+        bodies = [c[1]["data"] for c in client.execute_request.call_args_list]
+        self.assertIn(b">http://foo/sync/0</", bodies[0])
+        self.assertIn(b">http://foo/sync/1</", bodies[1],
+                      msg="truncated results were not continued")
+        self.assertIn("Depth: 0",
+                      client.execute_request.call_args[1]["headers_ext"])
+
+    @patch("webdav3.client.Client")
+    def test_sync_collection_invalid_token(self, MockClient):
+        client = MockClient()
+        error = ResponseErrorCode("http://foo", 403,
+                                  b"<d:error><d:valid-sync-token/></d:error>")
+        client.execute_request = Mock(side_effect=error)
+
+        with self.assertRaises(SyncTokenError):
+            sync_collection(client, "http://foo/sync/0")
+        with self.assertRaises(ReportError,
+                               msg="initial sync mistaken for a bad token"):
+            sync_collection(client)
+
+    @patch("webdav3.client.Client")
+    def test_get_collection_tag(self, MockClient):
+        client = MockClient()
+        client.execute_request = Mock(side_effect=[
+            Mock(content=COLLECTION_PROPS % (b"42", b"200 OK")),
+            Mock(content=COLLECTION_PROPS % (b"", b"404 Not Found")),
+            Mock(content=b"not xml"),
+        ])
+
+        self.assertEqual(get_collection_tag(client), "42",
+                         msg="CTag was not preferred")
+        self.assertEqual(get_collection_tag(client), "http://foo/sync/3",
+                         msg="missing CTag without a sync token fallback")
+        self.assertIsNone(get_collection_tag(client))
+        self.assertIn("Depth: 0",
+                      client.execute_request.call_args[1]["headers_ext"])
+
+    @patch("time.sleep")
+    @patch("webdav3.client.Client")
+    def test_listing_retries(self, MockClient, mock_sleep):
+        client = MockClient()
+        throttled = ThrottledError("", 503, "busy", retry_after=5)
+        client.list = Mock(side_effect=[
+            throttled, [{"path": "a.vcf", "etag": '"1"', "isdir": False}],
+            throttled, ["b.txt"],
+        ])
+        client.execute_request = Mock(side_effect=[
+            throttled, Mock(content=COLLECTION_PROPS % (b"42", b"200 OK")),
+        ])
+
+        self.assertEqual(list_resources(client), {"a.vcf": '"1"'})
+        self.assertEqual(list(iter_vobjects(client)), [])
+        self.assertEqual(get_collection_tag(client), "42")
+        self.assertEqual(mock_sleep.call_count, 3,
+                         msg="throttled listing was not retried")
+        self.assertTrue(all(delay[0][0] >= 5 for delay in
+                            mock_sleep.call_args_list),
+                        msg="Retry-After delay was not honoured")
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"),
+                         0, msg="past date was not turned into no delay")
+        self.assertGreater(parse_retry_after("Fri, 31 Dec 9999 23:59:59 GMT"),
+                           0, msg="future date was not read")
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertIsNone(parse_retry_after(None))
+
+    def test_raise_throttled(self):
+        response = Mock(status_code=429, url="http://foo/a.ics",
+                        content=b"slow down",
+                        headers={"Retry-After": "5"})
+        with self.assertRaises(ThrottledError) as context:
+            raise_throttled(response)
+        self.assertEqual(context.exception.retry_after, 5)
+        self.assertTrue(is_transient(context.exception),
+                        msg="throttled request would not be retried")
+
+        response.status_code = 403
+        raise_throttled(response)
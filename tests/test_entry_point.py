@@ -18,11 +18,65 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 from unittest.mock import patch
+import subprocess
+import tempfile
 import unittest
+import sys
 
 import os
 
-from birthdav.__main__ import get_config, ConfigurationError
+import birthdav
+from birthdav.__main__ import get_config, get_tenants_config, \
+    get_metrics_config, get_command, ConfigurationError
+
+
+TENANTS = b"""
+workers = 8
+
+[sync]
+write_workers = 2
+
+[[tenants]]
+name = "alice"
+state_path = "/tmp/alice.db"
+delta = true
+card = { url = "http://foo/alice/card/", user = "alice", pass = "secret" }
+cal = { url = "http://foo/alice/cal/" }
+
+[[tenants]]
+fetch_workers = 1
+card = { url = "http://foo/bob/card/" }
+cal = { url = "http://foo/bob/cal/" }
+"""
+
+# Modules the entry point must not load until it actually syncs
+HEAVY_MODULES = ("webdav3", "requests", "lxml", "vobject")
+
+# Cumulative import time allowed for birthdav.__main__, in microseconds
+IMPORT_BUDGET = 75000
+
+
+def run_python(*args, env: dict = None):
+    """
+    Runs a Python child process with import timing, returning its output and
+    the cumulative import time of each module, by name
+    """
+    src = os.path.dirname(os.path.dirname(birthdav.__file__))
+    child_env = dict(env or os.environ)
+    child_env["PYTHONPATH"] = os.pathsep.join(
+        p for p in (src, child_env.get("PYTHONPATH")) if p
+    )
+    process = subprocess.run([sys.executable, "-X", "importtime"] +
+                             list(args), env=child_env, timeout=60,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    imports = {}
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and line.count("|") == 2:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                imports[name.strip()] = int(cumulative)
+    return process, imports
 
 
 class TestEntryPoint(unittest.TestCase):
@@ -128,3 +182,224 @@ class TestEntryPoint(unittest.TestCase):
                     config[k1][k2], v,
                     msg="wrong value for %s %s: %s" % (k1, k2, v)
                 )
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+        "BIRTHDAV_FETCH_WORKERS": "16",
+    })
+    def test_fetch_workers(self):
+        self.assertEqual(get_config()["sync"]["fetch_workers"], 16,
+                         msg="ignored BIRTHDAV_FETCH_WORKERS")
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+        "BIRTHDAV_FETCH_WORKERS": "zero",
+    })
+    def test_invalid_fetch_workers(self):
+        msg = "did not fail on invalid BIRTHDAV_FETCH_WORKERS"
+        with self.assertRaisesRegex(ConfigurationError,
+                                    "invalid value for BIRTHDAV_FETCH_WORKERS",
+                                    msg=msg):
+            get_config()
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+        "BIRTHDAV_WRITE_WORKERS": "8",
+        "BIRTHDAV_WRITE_RETRIES": "0",
+    })
+    def test_write_options(self):
+        sync = get_config()["sync"]
+        self.assertEqual(sync["write_workers"], 8,
+                         msg="ignored BIRTHDAV_WRITE_WORKERS")
+        self.assertEqual(sync["write_retries"], 0,
+                         msg="ignored BIRTHDAV_WRITE_RETRIES")
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+        "BIRTHDAV_WRITE_RETRIES": "-1",
+    })
+    def test_invalid_write_retries(self):
+        msg = "did not fail on negative BIRTHDAV_WRITE_RETRIES"
+        with self.assertRaisesRegex(ConfigurationError,
+                                    "invalid value for BIRTHDAV_WRITE_RETRIES",
+                                    msg=msg):
+            get_config()
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+    })
+    def test_feed(self):
+        self.assertIsNone(get_config()["sync"]["feed"],
+                          msg="single feed without BIRTHDAV_FEED")
+        with patch.dict(os.environ, {"BIRTHDAV_FEED": "birthdays.ics"}):
+            self.assertEqual(get_config()["sync"]["feed"], "birthdays.ics",
+                             msg="ignored BIRTHDAV_FEED")
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+        "BIRTHDAV_FETCH_WORKERS": "16",
+    })
+    def test_http(self):
+        self.assertEqual(get_config()["http"],
+                         {"pool_size": 16, "compress": True},
+                         msg="connection pool not sized for the workers")
+        with patch.dict(os.environ, {"BIRTHDAV_HTTP_POOL_SIZE": "2",
+                                     "BIRTHDAV_COMPRESSION": "0"}):
+            self.assertEqual(get_config()["http"],
+                             {"pool_size": 2, "compress": False},
+                             msg="ignored the HTTP settings")
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+    })
+    def test_watch_interval(self):
+        self.assertIsNone(get_config()["watch"]["interval"],
+                          msg="watching without BIRTHDAV_WATCH_INTERVAL")
+        with patch.dict(os.environ, {"BIRTHDAV_WATCH_INTERVAL": "30"}):
+            self.assertEqual(get_config()["watch"]["interval"], 30,
+                             msg="ignored BIRTHDAV_WATCH_INTERVAL")
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+        "BIRTHDAV_REPORTS": "no",
+    })
+    def test_reports(self):
+        self.assertIs(get_config()["sync"]["reports"], False,
+                      msg="ignored BIRTHDAV_REPORTS")
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+        "BIRTHDAV_REPORTS": "maybe",
+    })
+    def test_invalid_reports(self):
+        msg = "did not fail on invalid BIRTHDAV_REPORTS"
+        with self.assertRaisesRegex(ConfigurationError,
+                                    "invalid value for BIRTHDAV_REPORTS",
+                                    msg=msg):
+            get_config()
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_CARD_URL": "http://foo",
+        "BIRTHDAV_CAL_URL": "http://foo",
+        "BIRTHDAV_DELTA_SYNC": "1",
+    })
+    def test_delta_without_state(self):
+        msg = "did not fail on BIRTHDAV_DELTA_SYNC without a state file"
+        with self.assertRaisesRegex(ConfigurationError,
+                                    "requires BIRTHDAV_STATE_PATH",
+                                    msg=msg):
+            get_config()
+
+    @patch.dict(os.environ, {
+        "BIRTHDAV_METRICS_JSON": "yes",
+        "BIRTHDAV_PROMETHEUS_PATH": "/tmp/birthdav.prom",
+    })
+    def test_metrics(self):
+        self.assertEqual(get_metrics_config(), {
+            "json_summary": True,
+            "prometheus_path": "/tmp/birthdav.prom",
+        })
+
+    def write_config(self, content: bytes):
+        config_file = tempfile.NamedTemporaryFile(suffix=".toml",
+                                                  delete=False)
+        self.addCleanup(os.unlink, config_file.name)
+        with config_file:
+            config_file.write(content)
+        return config_file.name
+
+    @patch.dict(os.environ, {"BIRTHDAV_WRITE_RETRIES": "3"})
+    def test_tenants(self):
+        config = get_tenants_config(self.write_config(TENANTS))
+
+        self.assertEqual(config["workers"], 8)
+        alice, bob = config["tenants"]
+        self.assertEqual(alice["name"], "alice")
+        self.assertEqual(bob["name"], "2", msg="unnamed tenant not numbered")
+        self.assertEqual(alice["card"], {"url": "http://foo/alice/card/",
+                                         "user": "alice", "pass": "secret"})
+        self.assertIsNone(bob["cal"]["user"])
+
+        self.assertTrue(alice["sync"]["delta"])
+        self.assertEqual(alice["sync"]["fetch_workers"], 4,
+                         msg="missing default option")
+        self.assertEqual(bob["sync"]["fetch_workers"], 1,
+                         msg="ignored tenant option")
+        self.assertEqual(bob["sync"]["write_workers"], 2,
+                         msg="ignored sync table option")
+        self.assertEqual(bob["sync"]["write_retries"], 3,
+                         msg="ignored environment option")
+        self.assertEqual(bob["http"]["pool_size"], 2,
+                         msg="connection pool not sized for the tenant")
+
+    def test_invalid_tenants(self):
+        server = b'card = { url = "http://a" }\ncal = { url = "http://b" }\n'
+        invalid = {
+            b"workers = 0\n": "invalid value for workers",
+            b"[[tenants]]\ncard = { url = 'http://a' }\n": "missing cal.url",
+            b"[[tenants]]\nfetch_workers = true\n" + server:
+                "invalid value for fetch_workers",
+            b"[[tenants]]\nfoo = 1\n" + server: "unknown option: foo",
+            b"[[tenants]]\ndelta = true\n" + server:
+                "delta requires state_path",
+            b"[[tenants]]\nstate_path = 'a'\n" + server +
+            b"[[tenants]]\nstate_path = 'a'\n" + server:
+                "state_path shared",
+            b"": "no tenants",
+            b"[[tenants]\n": "could not read",
+        }
+
+        for content, message in invalid.items():
+            with self.assertRaisesRegex(ConfigurationError, message):
+                get_tenants_config(self.write_config(content))
+
+    def test_command(self):
+        self.assertEqual(get_command([]), "sync")
+        self.assertEqual(get_command(["--version"]), "version")
+        self.assertEqual(get_command(["--check-config"]), "check-config")
+        with self.assertRaisesRegex(ConfigurationError, "usage"):
+            get_command(["--foo"])
+
+    def assert_lightweight(self, imports: dict):
+        heavy = [name for name in imports if
+                 name.split(".")[0] in HEAVY_MODULES]
+        self.assertEqual(heavy, [], msg="heavy modules were imported")
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime needs 3.7")
+    def test_import_budget(self):
+        process, imports = run_python("-c", "import birthdav.__main__")
+        self.assertEqual(process.returncode, 0, msg=process.stderr)
+        self.assert_lightweight(imports)
+        self.assertLess(imports["birthdav.__main__"], IMPORT_BUDGET,
+                        msg="birthdav.__main__ took too long to import")
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime needs 3.7")
+    def test_lightweight_commands(self):
+        env = {k: v for k, v in os.environ.items() if
+               not k.startswith("BIRTHDAV_")}
+        process, imports = run_python("-m", "birthdav", "--version", env=env)
+        self.assertEqual(process.stdout.strip(),
+                         "birthdav %s" % birthdav.__version__)
+        self.assert_lightweight(imports)
+
+        env.update(BIRTHDAV_CARD_URL="http://foo",
+                   BIRTHDAV_CAL_URL="http://foo")
+        process, imports = run_python("-m", "birthdav", "--check-config",
+                                      env=env)
+        self.assertEqual(process.returncode, 0, msg=process.stderr)
+        self.assert_lightweight(imports)
+
+        del env["BIRTHDAV_CAL_URL"]
+        process, imports = run_python("-m", "birthdav", env=env)
+        self.assertEqual(process.returncode, 1)
+        self.assertIn("BIRTHDAV_CAL_URL", process.stderr)
+        self.assert_lightweight(imports)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from tempfile import TemporaryDirectory
+import unittest
+import os
+
+from birthdav.journal import OperationJournal, get_journal_path
+
+
+class TestJournal(unittest.TestCase):
+    def test_operations(self):
+        journal = OperationJournal(":memory:", "http://foo")
+        self.assertFalse(journal.is_planned())
+        journal.record_plan([("new", "a", "{}"), ("lost", "b", "{}")])
+        self.assertTrue(journal.is_planned())
+        self.assertEqual(journal.get_operations(),
+                         [("new", "{}"), ("lost", "{}")],
+                         msg="operations recorded out of order")
+
+        journal.complete("new", "a")
+        self.assertEqual(journal.get_operations(), [("lost", "{}")],
+                         msg="completed operation was kept")
+        journal.finish_plan()
+        self.assertFalse(journal.is_planned())
+
+        journal.record_plan([("new", "c", "{}")])
+        self.assertEqual(journal.get_operations(), [("new", "{}")],
+                         msg="operation left over by an earlier plan was "
+                         "kept")
+        journal.close()
+
+    def test_persistence(self):
+        with TemporaryDirectory() as tmp_dir:
+            path = get_journal_path(os.path.join(tmp_dir, "state.sqlite"))
+            self.assertEqual(os.path.basename(path),
+                             "state.sqlite.operations")
+
+            journal = OperationJournal(path, "http://foo")
+            journal.record_plan([("new", "a", "{}")])
+            other = OperationJournal(path, "http://bar")
+            other.record_plan([("new", "a", "{}")])
+            other.finish_plan()
+
+            reopened = OperationJournal(path, "http://foo")
+            self.assertEqual(reopened.get_operations(), [("new", "{}")],
+                             msg="operations were not persisted right away, "
+                             "or calendars were mixed up")
+            self.assertTrue(reopened.is_planned(),
+                            msg="plans of calendars were mixed up")
+            for each in (journal, other, reopened):
+                each.close()
+
+        self.assertEqual(get_journal_path(":memory:"), ":memory:")
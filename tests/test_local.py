@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from webdav3.exceptions import MethodNotSupported, ResponseErrorCode, \
+    RemoteResourceNotFound
+from tempfile import TemporaryDirectory
+from unittest.mock import Mock, patch
+import pathlib
+import unittest
+import os
+
+from birthdav.local import LocalClient
+from birthdav.dav import \
+    get_client, \
+    get_collection_tag, \
+    list_resources, \
+    fetch_vobject, \
+    fetch_etag, \
+    upload_vobject, \
+    delete_vobject
+from birthdav.sync import sync_birthdays, dump_operation, ApplyError
+from birthdav.journal import OperationJournal, get_journal_path
+from birthdav.scan import scan_vcard
+
+
+CARD = "BEGIN:VCARD\r\nVERSION:3.0\r\nUID:%s\r\nN:Bar;Foo;;;\r\n" \
+    "BDAY:%s\r\nEND:VCARD\r\n"
+
+
+class TestLocal(unittest.TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        for name in ("card", "cal"):
+            os.mkdir(os.path.join(self.root, name))
+
+    def get_client(self, name: str):
+        url = pathlib.Path(self.root, name).as_uri()
+        return get_client({"url": url, "user": None, "pass": None})
+
+    def write_card(self, uid: str, bday: str):
+        path = os.path.join(self.root, "card", "%s.vcf" % uid)
+        with open(path, "w", newline="") as card_file:
+            card_file.write(CARD % (uid, bday))
+
+    def test_get_client(self):
+        client = self.get_client("card")
+        self.assertIsInstance(client, LocalClient)
+        self.assertEqual(client.root, os.path.join(self.root, "card"))
+
+    def test_fetch(self):
+        client = self.get_client("card")
+        self.write_card("a", "1970-01-01")
+        with open(os.path.join(self.root, "card", ".hidden"), "w"):
+            pass
+
+        listing = list_resources(client)
+        self.assertEqual(list(listing), ["a.vcf"], msg="invalid listing")
+
+        self.assertEqual(fetch_vobject(client, "a.vcf", scan_vcard)
+                         .uid.value, "a")
+        self.write_card("a", "1970-01-02")
+        os.utime(os.path.join(self.root, "card", "a.vcf"), ns=(1, 1))
+        self.assertEqual(fetch_vobject(client, "a.vcf", scan_vcard)
+                         .bday.value, "1970-01-02")
+        self.assertNotEqual(list_resources(client)["a.vcf"],
+                            listing["a.vcf"], msg="ETag did not change")
+        self.assertEqual(fetch_etag(client, "a.vcf"),
+                         list_resources(client)["a.vcf"])
+        self.assertIs(fetch_etag(client, "b.vcf"), None)
+
+        with self.assertRaises(RemoteResourceNotFound):
+            fetch_vobject(client, "b.vcf")
+        with self.assertRaises(MethodNotSupported):
+            client.execute_request("report", "/", data=b"")
+
+    def test_conditional_writes(self):
+        client = self.get_client("cal")
+        vobj = Mock(serialize=lambda: CARD % ("a", "1970-01-01"))
+
+        etag = upload_vobject(client, "a.ics", vobj, if_none_match="*")
+        self.assertEqual(list_resources(client), {"a.ics": etag})
+        with self.assertRaises(ResponseErrorCode) as context:
+            upload_vobject(client, "a.ics", vobj, if_none_match="*")
+        self.assertEqual(context.exception.code, 412)
+        with self.assertRaises(ResponseErrorCode):
+            delete_vobject(client, "a.ics", if_match='"other"')
+
+        delete_vobject(client, "a.ics", if_match=etag)
+        delete_vobject(client, "a.ics")
+        self.assertEqual(os.listdir(os.path.join(self.root, "cal")), [],
+                         msg="file or temporary file left behind")
+
+    def test_sync(self):
+        card_client = self.get_client("card")
+        cal_client = self.get_client("cal")
+        self.write_card("a", "1970-01-01")
+        self.write_card("b", "1980-01-01")
+        state_path = os.path.join(self.root, "state.db")
+        tag = get_collection_tag(card_client)
+
+        results = sync_birthdays(card_client, cal_client,
+                                 state_path=state_path)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sync_birthdays(card_client, cal_client,
+                                        state_path=state_path), [],
+                         msg="no-op sync was not a no-op")
+
+        os.remove(os.path.join(self.root, "card", "b.vcf"))
+        self.assertNotEqual(get_collection_tag(card_client), tag,
+                            msg="collection tag did not change")
+        results = sync_birthdays(card_client, cal_client,
+                                 state_path=state_path)
+        self.assertEqual([r["operation"] for r in results], ["lost"])
+        self.assertEqual(len(os.listdir(os.path.join(self.root, "cal"))), 1)
+
+    def test_resume(self):
+        card_client = self.get_client("card")
+        cal_client = self.get_client("cal")
+        self.write_card("a", "1970-01-01")
+        state_path = os.path.join(self.root, "state.db")
+        journal = OperationJournal(get_journal_path(state_path),
+                                   cal_client.webdav.hostname)
+        journal.record_plan([("new", "a", dump_operation(
+            "new", scan_vcard(CARD % ("a", "1970-01-01"))
+        ))])
+        journal.close()
+
+        with patch("birthdav.sync.get_events", side_effect=IOError()):
+            results = sync_birthdays(card_client, cal_client,
+                                     state_path=state_path)
+        self.assertEqual([r["operation"] for r in results], ["new"],
+                         msg="fetched again despite an unfinished plan")
+        self.assertEqual(len(os.listdir(os.path.join(self.root, "cal"))), 1)
+
+        results = sync_birthdays(card_client, cal_client,
+                                 state_path=state_path)
+        self.assertEqual(results, [], msg="resumed operation was not "
+                         "removed from the journal, or not applied")
+
+    def test_interrupted_sync(self):
+        card_client = self.get_client("card")
+        cal_client = self.get_client("cal")
+        self.write_card("a", "1970-01-01")
+        self.write_card("b", "1980-01-01")
+        state_path = os.path.join(self.root, "state.db")
+
+        with patch("birthdav.sync.apply_operations", side_effect=IOError()):
+            with self.assertRaises(IOError):
+                sync_birthdays(card_client, cal_client,
+                               state_path=state_path)
+        self.assertEqual(os.listdir(os.path.join(self.root, "cal")), [])
+
+        with patch("birthdav.sync.get_events", side_effect=IOError()):
+            results = sync_birthdays(card_client, cal_client,
+                                     state_path=state_path)
+        self.assertEqual([r["operation"] for r in results], ["new", "new"],
+                         msg="plan was not resumed without fetching")
+        self.assertEqual(sync_birthdays(card_client, cal_client,
+                                        state_path=state_path), [],
+                         msg="state was not committed with the plan")
+
+    def test_failed_create(self):
+        card_client = self.get_client("card")
+        cal_client = self.get_client("cal")
+        self.write_card("x", "1970-01-01")
+        state_path = os.path.join(self.root, "state.db")
+
+        error = ResponseErrorCode("", 403, "denied")
+        with patch("birthdav.sync.create_birthday_event", side_effect=error):
+            with self.assertRaises(ApplyError):
+                sync_birthdays(card_client, cal_client,
+                               state_path=state_path)
+
+        os.remove(os.path.join(self.root, "card", "x.vcf"))
+        self.assertEqual(sync_birthdays(card_client, cal_client,
+                                        state_path=state_path), [],
+                         msg="failed operation was replayed")
+        self.assertEqual(os.listdir(os.path.join(self.root, "cal")), [])
+
+    def test_failed_delete(self):
+        card_client = self.get_client("card")
+        cal_client = self.get_client("cal")
+        self.write_card("a", "1970-01-01")
+        state_path = os.path.join(self.root, "state.db")
+        sync_birthdays(card_client, cal_client, state_path=state_path)
+
+        os.remove(os.path.join(self.root, "card", "a.vcf"))
+        error = ResponseErrorCode("", 403, "denied")
+        with patch("birthdav.sync.delete_vobject", side_effect=error):
+            with self.assertRaises(ApplyError):
+                sync_birthdays(card_client, cal_client,
+                               state_path=state_path)
+
+        self.write_card("a", "1970-01-01")
+        self.assertEqual(sync_birthdays(card_client, cal_client,
+                                        state_path=state_path), [],
+                         msg="failed operation was replayed")
+        self.assertEqual(len(os.listdir(os.path.join(self.root, "cal"))), 1,
+                         msg="event of an existing contact was deleted")
+
+    def test_delta_without_state(self):
+        with self.assertRaises(ValueError):
+            sync_birthdays(self.get_client("card"), self.get_client("cal"),
+                           delta=True)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from unittest.mock import Mock, patch
+from datetime import timedelta
+import tempfile
+import unittest
+import json
+import os
+
+from birthdav.metrics import Metrics, METRICS, export
+from birthdav.dav import get_client, fetch_vobject
+from birthdav.sync import attempt_operation, EventRecord
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        METRICS.reset()
+
+    def test_counters(self):
+        metrics = Metrics()
+        metrics.add("operations_total", operation="new", status="ok")
+        metrics.add("operations_total", 2, operation="new", status="ok")
+        with metrics.timed("parse"):
+            pass
+
+        summary = metrics.to_dict()
+        self.assertEqual(summary["operations_total"], [{
+            "labels": {"operation": "new", "status": "ok"}, "value": 3
+        }])
+        self.assertEqual(summary["phase_calls_total"][0]["value"], 1)
+        self.assertGreaterEqual(summary["phase_seconds_total"][0]["value"], 0)
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.add("http_requests_total", method="GET", status="200")
+        metrics.add("phase_calls_total", phase='a"b\\c')
+        metrics.set("last_success_timestamp_seconds", 12)
+
+        lines = metrics.to_prometheus().splitlines()
+        self.assertIn("# TYPE birthdav_http_requests_total counter", lines)
+        self.assertIn('birthdav_http_requests_total{method="GET",'
+                      'status="200"} 1.0', lines)
+        self.assertIn('birthdav_phase_calls_total{phase="a\\"b\\\\c"} 1.0',
+                      lines, msg="label values were not escaped")
+        self.assertIn("# TYPE birthdav_last_success_timestamp_seconds gauge",
+                      lines)
+        self.assertIn("birthdav_last_success_timestamp_seconds 12.0", lines)
+
+    def test_record_response(self):
+        metrics = Metrics()
+        response = Mock(status_code=207, content=b"12345",
+                        elapsed=timedelta(seconds=0.5))
+        response.request.method = "REPORT"
+        response.request.body = b"123"
+        metrics.record_response(response)
+
+        summary = metrics.to_dict()
+        self.assertEqual(summary["http_requests_total"][0]["labels"],
+                         {"method": "REPORT", "status": "207"})
+        self.assertEqual(summary["http_request_seconds_total"][0]["value"],
+                         0.5)
+        self.assertEqual(summary["http_sent_bytes_total"][0]["value"], 3)
+        self.assertEqual(summary["http_received_bytes_total"][0]["value"], 5)
+
+        response.raw.tell.return_value = 2
+        metrics.record_response(response)
+        self.assertEqual(metrics.to_dict()["http_received_bytes_total"][0]
+                         ["value"], 7, msg="compressed body counted decoded")
+
+    def test_client_hook(self):
+        client = get_client({"url": "http://foo", "user": None,
+                             "pass": None})
+        self.assertIn(METRICS.record_response,
+                      client.session.hooks["response"],
+                      msg="requests are not counted")
+
+    @patch("webdav3.client.Client")
+    def test_instrumentation(self, MockClient):
+        client = MockClient()
+        client.execute_request = Mock(return_value=Mock(content=b"data"))
+        fetch_vobject(client, "a.vcf", parse=str)
+
+        attempt_operation(client, client, "lost", EventRecord(
+            "foo.ics", None, "foo", "foo", "http://foo", None, None, None
+        ))
+
+        summary = METRICS.to_dict()
+        phases = {s["labels"]["phase"] for s in summary["phase_calls_total"]}
+        self.assertTrue({"download", "parse", "delete"} <= phases,
+                        msg="missing phases: %s" % phases)
+        self.assertEqual(summary["operations_total"], [{
+            "labels": {"operation": "lost", "status": "ok"}, "value": 1
+        }])
+
+    def test_export(self):
+        METRICS.add("operations_total", operation="new", status="ok")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "birthdav.prom")
+            with patch("builtins.print") as mock_print:
+                export(json_summary=True, prometheus_path=path)
+
+            with open(path) as textfile:
+                self.assertIn("birthdav_operations_total", textfile.read())
+            self.assertEqual(os.listdir(directory), ["birthdav.prom"],
+                             msg="temporary file left behind")
+
+        summary = json.loads(mock_print.call_args[0][0])
+        self.assertIn("operations_total", summary)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+import vobject
+
+from birthdav.scan import scan_vcard, ScannedCard
+
+
+CARD = "\r\n".join((
+    "BEGIN:VCARD",
+    "VERSION:3.0",
+    "UID:ab\\,c",
+    "item1.FN:Jean\\, Luc",
+    "N:Pic\\;ard;Jean\\,Luc;;;",
+    "PHOTO;ENCODING=b;TYPE=JPEG:" + "QUJD" * 64,
+    " " + "REVG" * 64,
+    "NOTE:BDAY:1900-01-01",
+    "BDAY;VALUE=date:1970-01-0",
+    " 1",
+    "END:VCARD",
+    ""
+))
+
+
+class TestScan(unittest.TestCase):
+    def test_matches_vobject(self):
+        scanned = scan_vcard(CARD)
+        parsed = vobject.readOne(CARD)
+
+        self.assertIsInstance(scanned, ScannedCard)
+        for prop in ("uid", "fn", "bday"):
+            self.assertEqual(getattr(scanned, prop).value,
+                             getattr(parsed, prop).value,
+                             msg="mismatched %s" % prop)
+        for part in ("family", "given", "additional", "prefix", "suffix"):
+            self.assertEqual(getattr(scanned.n.value, part),
+                             getattr(parsed.n.value, part),
+                             msg="mismatched N %s" % part)
+
+    def test_skipped_properties(self):
+        scanned = scan_vcard(CARD)
+        self.assertFalse(hasattr(scanned, "photo"), msg="PHOTO was decoded")
+        self.assertFalse(hasattr(scanned, "note"))
+
+    def test_compact(self):
+        self.assertFalse(hasattr(scan_vcard(CARD), "__dict__"),
+                         msg="scanned cards carry an attribute dictionary")
+
+    def test_missing_properties(self):
+        scanned = scan_vcard("BEGIN:VCARD\nUID:a\nEND:VCARD\n")
+        self.assertEqual(scanned.uid.value, "a")
+        self.assertFalse(hasattr(scanned, "bday"),
+                         msg="missing BDAY was not missing")
+
+    def test_vobject_fallback(self):
+        card = "\r\n".join((
+            "BEGIN:VCARD",
+            "VERSION:2.1",
+            "UID:a",
+            "N;ENCODING=QUOTED-PRINTABLE:Fam=C3=A9;Given;;;",
+            "BDAY:1970-01-01",
+            "END:VCARD",
+            ""
+        ))
+
+        self.assertNotIsInstance(scan_vcard(card), ScannedCard,
+                                 msg="scanned an encoded property")
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            scan_vcard("BEGIN:VCALENDAR\nEND:VCALENDAR\n")
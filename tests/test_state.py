@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from tempfile import TemporaryDirectory
+import threading
+import unittest
+import sqlite3
+import os
+
+from birthdav.state import StateStore
+
+
+class TestState(unittest.TestCase):
+    def test_resources(self):
+        state = StateStore(":memory:")
+        state.save_resources("http://foo", {
+            "a.vcf": {"etag": "1", "uid": "a", "bday": "1970-01-01"},
+            "b.vcf": {"etag": "2"},
+        })
+        state.save_resources("http://bar", {"c.ics": {"etag": "3"}})
+
+        resources = state.get_resources("http://foo")
+        self.assertEqual(sorted(resources), ["a.vcf", "b.vcf"],
+                         msg="collections were mixed up")
+        self.assertEqual(resources["a.vcf"]["bday"], "1970-01-01")
+        self.assertIs(resources["b.vcf"]["uid"], None)
+
+        state.save_resources("http://foo", {"b.vcf": {"etag": "4"}})
+        resources = state.get_resources("http://foo")
+        self.assertEqual(list(resources), ["b.vcf"],
+                         msg="removed resource was kept")
+        self.assertEqual(resources["b.vcf"]["etag"], "4")
+        self.assertEqual(list(state.get_resources("http://bar")), ["c.ics"])
+
+    def test_persistence(self):
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "state.sqlite")
+            state = StateStore(path)
+            state.save_resources("http://foo", {"a.vcf": {"etag": "1"}})
+            state.save_sync_token("http://foo", "token-1")
+            state.commit()
+            state.save_resources("http://foo", {"a.vcf": {"etag": "2"}})
+            state.save_sync_token("http://foo", "token-2")
+            state.close()
+
+            state = StateStore(path)
+            resources = state.get_resources("http://foo")
+            self.assertEqual(resources["a.vcf"]["etag"], "1",
+                             msg="state was not persisted or not rolled back")
+            self.assertEqual(state.get_sync_token("http://foo"), "token-1")
+            self.assertIs(state.get_sync_token("http://bar"), None)
+            state.close()
+
+    def test_upgrade(self):
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "state.sqlite")
+            db = sqlite3.connect(path)
+            db.execute("CREATE TABLE resources ("
+                       "collection TEXT NOT NULL, name TEXT NOT NULL, "
+                       "etag TEXT, uid TEXT, card_url TEXT, card_uid TEXT, "
+                       "bday TEXT, display_name TEXT, "
+                       "PRIMARY KEY (collection, name))")
+            db.execute("CREATE TABLE sync_tokens ("
+                       "collection TEXT NOT NULL PRIMARY KEY, token TEXT)")
+            db.execute("INSERT INTO resources (collection, name, etag) "
+                       "VALUES ('http://foo', 'a.ics', '1')")
+            db.execute("INSERT INTO sync_tokens VALUES ('http://foo', 't')")
+            db.commit()
+            db.close()
+
+            state = StateStore(path)
+            self.assertEqual(state.get_resources("http://foo"), {},
+                             msg="outdated resources were kept")
+            self.assertIs(state.get_sync_token("http://foo"), None)
+
+            state.save_resources("http://foo", {
+                "a.ics": {"etag": "2", "fingerprint": "abc"}
+            })
+            state.commit()
+            state.close()
+
+            state = StateStore(path)
+            resources = state.get_resources("http://foo")
+            self.assertEqual(resources["a.ics"]["fingerprint"], "abc",
+                             msg="upgraded store dropped its resources")
+            state.close()
+
+    def test_changed_uids(self):
+        state = StateStore(":memory:")
+        state.add_changed_uids(("a",))
+        self.assertIs(state.changed_uids, None)
+        self.assertTrue(state.may_have_changed("a"))
+
+        state.track_changed_uids()
+        state.add_changed_uids(("a", None))
+        self.assertTrue(state.may_have_changed("a"))
+        self.assertFalse(state.may_have_changed("b"))
+
+        def add():
+            for i in range(1000):
+                state.add_changed_uids((str(i),))
+
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        state.reset_changed_uids()
+        for thread in threads:
+            thread.join()
+        self.assertIs(state.changed_uids, None,
+                      msg="changed UIDs were recorded after a reset")
+        self.assertTrue(state.may_have_changed("b"))
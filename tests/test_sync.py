@@ -18,19 +18,45 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 from webdav3.client import WebDAVSettings
-from unittest.mock import Mock, patch
+from webdav3.exceptions import ResponseErrorCode
+from unittest.mock import ANY, call, patch
 from datetime import datetime
+import threading
 import unittest
 import vobject
 import uuid
 
+from birthdav.state import StateStore
+from birthdav.scan import scan_vcard
+from birthdav.dav import FetchError, ReportError, SyncTokenError, \
+    ThrottledError
 from birthdav.sync import \
     get_born_contacts, \
+    iter_born_contacts, \
     get_events, \
     contact_matches_event, \
+    iter_triage, \
     triage_events, \
     create_birthday_event, \
-    apply_diffs
+    build_birthday_event, \
+    get_contact_fingerprint, \
+    get_event_uid, \
+    build_birthday_feed, \
+    get_feed_fingerprint, \
+    scan_feed, \
+    triage_feed, \
+    build_event_record, \
+    get_event_record, \
+    apply_operations, \
+    apply_diffs, \
+    dump_operation, \
+    load_operation, \
+    plan_operations, \
+    get_leftover_uids, \
+    resume_operations, \
+    ApplyError, \
+    FeedError
+from birthdav.journal import OperationJournal
 
 
 class TestSync(unittest.TestCase):
@@ -41,6 +67,11 @@ class TestSync(unittest.TestCase):
         mock_client.webdav = client_settings
         return mock_client
 
+    @staticmethod
+    def named(vobjs, names=None):
+        names = names or ["%d" % i for i in range(len(vobjs))]
+        return list(zip(names, vobjs))
+
     @staticmethod
     def dummy_contact(bday=None):
         vobj = vobject.vCard()
@@ -49,6 +80,12 @@ class TestSync(unittest.TestCase):
             vobj.add("bday").value = bday
         return vobj
 
+    @staticmethod
+    def named_contact(bday, given="Foo", family="Bar"):
+        vobj = TestSync.dummy_contact(bday)
+        vobj.add("n").value = vobject.vcard.Name(given=given, family=family)
+        return vobj
+
     @staticmethod
     def dummy_event(contact_uid, when=None):
         vobj = vobject.iCalendar()
@@ -60,48 +97,346 @@ class TestSync(unittest.TestCase):
             vobj.add("x-birthdav-card-url").value = "http://foo"
         return vobj
 
-    @patch("birthdav.sync.get_vobjects")
+    @staticmethod
+    def birthday_event(contact):
+        return build_birthday_event("http://foo", contact)
+
+    @staticmethod
+    def event_record(vobj, name=None, etag=None):
+        return build_event_record(name or "%s.ics" % vobj.uid.value, etag,
+                                  get_event_record(vobj))
+
+    @patch("birthdav.sync.query_cards")
+    @patch("birthdav.sync.iter_vobjects")
     @patch("webdav3.client.Client")
-    def test_get_born_contacts(self, MockClient, mock_get_vobjects):
+    def test_get_born_contacts(self, MockClient, mock_iter_vobjects,
+                               mock_query_cards):
         mock_client = self.dummy_client(MockClient)
-        mock_get_vobjects.return_value = [
+        mock_query_cards.side_effect = ReportError("unsupported")
+        mock_iter_vobjects.return_value = self.named([
             self.dummy_contact(datetime.now()),
             self.dummy_contact(datetime.now()),
             self.dummy_contact(None),
-        ]
+        ])
 
         contacts = get_born_contacts(mock_client)
 
-        self.assertTrue(mock_get_vobjects.called)
+        self.assertTrue(mock_iter_vobjects.called)
         self.assertEqual(len(contacts), 2)
 
-    @patch("birthdav.sync.get_vobjects")
+    @patch("birthdav.sync.query_cards")
+    @patch("birthdav.sync.iter_vobjects")
     @patch("webdav3.client.Client")
-    def test_get_events(self, MockClient, mock_get_vobjects):
+    def test_get_born_contacts_report(self, MockClient, mock_iter_vobjects,
+                                      mock_query_cards):
         mock_client = self.dummy_client(MockClient)
-        mock_get_vobjects.return_value = [
+        mock_query_cards.return_value = self.named([
+            self.dummy_contact(datetime.now()),
+            self.dummy_contact(datetime.now()),
+        ])
+
+        contacts = get_born_contacts(mock_client)
+
+        mock_query_cards.assert_called_once_with(mock_client, "BDAY",
+                                                 scan_vcard)
+        self.assertFalse(mock_iter_vobjects.called,
+                         msg="fell back on listing despite REPORT support")
+        self.assertEqual(len(contacts), 2)
+
+    @patch("birthdav.sync.query_cards")
+    @patch("birthdav.sync.iter_vobjects")
+    @patch("webdav3.client.Client")
+    def test_get_born_contacts_no_reports(self, MockClient,
+                                          mock_iter_vobjects,
+                                          mock_query_cards):
+        mock_client = self.dummy_client(MockClient)
+        mock_iter_vobjects.return_value = self.named([
+            self.dummy_contact(datetime.now())
+        ])
+
+        contacts = get_born_contacts(mock_client, reports=False)
+
+        self.assertFalse(mock_query_cards.called,
+                         msg="sent a REPORT despite reports being disabled")
+        self.assertEqual(len(contacts), 1)
+
+    @patch("birthdav.sync.query_events")
+    @patch("birthdav.sync.list_resources")
+    @patch("birthdav.sync.iter_vobjects")
+    @patch("webdav3.client.Client")
+    def test_get_events(self, MockClient, mock_iter_vobjects, mock_list,
+                        mock_query_events):
+        mock_client = self.dummy_client(MockClient)
+        mock_query_events.side_effect = ReportError("unsupported")
+        vobjs = [
             self.dummy_event(str(uuid.uuid4())),
             self.dummy_event(str(uuid.uuid4())),
             self.dummy_event(None),
         ]
+        mock_list.return_value = {"0": "e0", "1": "e1", "2": "e2"}
+        mock_iter_vobjects.return_value = self.named(vobjs)
 
         events = get_events(mock_client, mock_client)
 
-        self.assertTrue(mock_get_vobjects.called)
-        self.assertEqual(len(events), 2)
+        self.assertEqual(mock_iter_vobjects.call_args[0][2], ["0", "1", "2"],
+                         msg="listed events were not fetched")
+        self.assertEqual(sorted(events.values()), sorted([
+            self.event_record(vobjs[0], "0", "e0"),
+            self.event_record(vobjs[1], "1", "e1"),
+        ]), msg="listed names and ETags were not recorded")
+
+    @patch("birthdav.sync.query_events")
+    @patch("birthdav.sync.iter_vobjects")
+    @patch("webdav3.client.Client")
+    def test_get_events_report(self, MockClient, mock_iter_vobjects,
+                               mock_query_events):
+        mock_client = self.dummy_client(MockClient)
+        other_book_event = self.dummy_event(str(uuid.uuid4()))
+        other_book_event.x_birthdav_card_url.value = "http://bar"
+        mock_query_events.return_value = self.named([
+            self.dummy_event(str(uuid.uuid4())),
+            other_book_event,
+        ])
+
+        events = get_events(mock_client, mock_client)
+
+        self.assertFalse(mock_iter_vobjects.called,
+                         msg="fell back on listing despite REPORT support")
+        filters = mock_query_events.call_args[0][1]
+        self.assertEqual(filters["X-BIRTHDAV-CARD-URL"], "http://foo",
+                         msg="events were not filtered by address book")
+        self.assertEqual(len(events), 1)
+
+    @patch("birthdav.sync.multiget_cards")
+    @patch("birthdav.sync.list_resources")
+    @patch("webdav3.client.Client")
+    def test_get_born_contacts_state(self, MockClient, mock_list,
+                                     mock_multiget):
+        mock_client = self.dummy_client(MockClient)
+        state = StateStore(":memory:")
+        cards = {
+            "a.vcf": self.named_contact("1970-01-01"),
+            "b.vcf": self.named_contact("1980-01-01"),
+            "c.vcf": self.dummy_contact(None),
+        }
+        mock_list.return_value = {"a.vcf": "1", "b.vcf": "1", "c.vcf": "1"}
+        mock_multiget.side_effect = lambda client, names, parse: (
+            (name, parse(cards[name].serialize(validate=False)))
+            for name in names
+        )
+
+        contacts = get_born_contacts(mock_client, state=state)
+        self.assertEqual(set(mock_multiget.call_args[0][1]), set(cards))
+        self.assertEqual(len(contacts), 2)
+
+        mock_multiget.reset_mock()
+        contacts = get_born_contacts(mock_client, state=state)
+        self.assertFalse(mock_multiget.called,
+                         msg="fetched contacts despite unchanged ETags")
+        self.assertEqual(len(contacts), 2)
+        cached = contacts[cards["a.vcf"].uid.value]
+        self.assertEqual(cached.bday.value, "1970-01-01")
+        self.assertEqual(cached.n.value.given, "Foo Bar")
+
+        cards["b.vcf"] = self.named_contact("1990-01-01")
+        mock_list.return_value = {"b.vcf": "2", "c.vcf": "1"}
+        contacts = get_born_contacts(mock_client, state=state)
+        mock_multiget.assert_called_once_with(mock_client, ["b.vcf"], ANY)
+        self.assertEqual(list(contacts), [cards["b.vcf"].uid.value],
+                         msg="removed contact was kept")
+
+    @patch("birthdav.sync.iter_vobjects")
+    @patch("birthdav.sync.multiget_cards")
+    @patch("birthdav.sync.list_resources")
+    @patch("webdav3.client.Client")
+    def test_iter_born_contacts_state(self, MockClient, mock_list,
+                                      mock_multiget, mock_iter_vobjects):
+        mock_client = self.dummy_client(MockClient)
+        state = StateStore(":memory:")
+        cards = {
+            "a.vcf": self.named_contact("1970-01-01"),
+            "b.vcf": self.named_contact("1980-01-01"),
+        }
+        mock_list.return_value = {"a.vcf": "1", "b.vcf": "1"}
+
+        def multiget(client, names, parse):
+            yield "a.vcf", parse(cards["a.vcf"].serialize(validate=False))
+            raise ReportError("truncated REPORT response")
+
+        mock_multiget.side_effect = multiget
+        mock_iter_vobjects.side_effect = lambda client, workers, names, \
+            parse: ((name, parse(cards[name].serialize(validate=False)))
+                    for name in names)
+
+        contacts = iter_born_contacts(mock_client, state=state)
+        uid, contact = next(contacts)
+        self.assertEqual(uid, cards["a.vcf"].uid.value)
+        self.assertEqual(contact.bday.value, "1970-01-01")
+        self.assertFalse(mock_iter_vobjects.called,
+                         msg="contacts were not streamed")
+        self.assertEqual(state.get_resources("http://foo"), {},
+                         msg="state saved before every contact went through")
+
+        self.assertEqual(dict(contacts), {
+            cards["b.vcf"].uid.value: ANY,
+        })
+        mock_iter_vobjects.assert_called_once_with(mock_client, 1, ["b.vcf"],
+                                                   ANY)
+        self.assertEqual(set(state.get_resources("http://foo")), set(cards))
+
+    @patch("birthdav.sync.multiget_events")
+    @patch("birthdav.sync.list_resources")
+    @patch("birthdav.sync.list_events")
+    @patch("webdav3.client.Client")
+    def test_get_events_query_state(self, MockClient, mock_query, mock_list,
+                                    mock_multiget):
+        mock_client = self.dummy_client(MockClient)
+        state = StateStore(":memory:")
+        contact = self.dummy_contact("1970-01-01")
+        contact.uid.value = "a"
+        event = self.birthday_event(contact)
+        mock_query.return_value = {"a.ics": "1"}
+        mock_multiget.side_effect = lambda client, names, parse: (
+            (name, parse(event.serialize())) for name in names
+        )
+
+        events = get_events(mock_client, mock_client, state=state)
+        mock_query.assert_called_once_with(mock_client, {
+            "X-BIRTHDAV-CARD-UID": None,
+            "X-BIRTHDAV-CARD-URL": "http://foo",
+        })
+        self.assertFalse(mock_list.called,
+                         msg="listed the whole calendar")
+        mock_multiget.assert_called_once_with(mock_client, ["a.ics"], ANY)
+        self.assertEqual(list(events), ["a"])
+        self.assertEqual(set(state.get_resources("http://foo")), {"a.ics"},
+                         msg="tracked events birthdav does not own")
+
+    @patch("birthdav.sync.iter_vobjects")
+    @patch("birthdav.sync.multiget_events")
+    @patch("birthdav.sync.list_resources")
+    @patch("birthdav.sync.list_events")
+    @patch("webdav3.client.Client")
+    def test_get_events_state(self, MockClient, mock_query, mock_list,
+                              mock_multiget, mock_iter_vobjects):
+        mock_client = self.dummy_client(MockClient)
+        state = StateStore(":memory:")
+        contact = self.dummy_contact("1970-01-01")
+        contact.uid.value = "a"
+        event = self.birthday_event(contact)
+        mock_query.side_effect = ReportError("unsupported")
+        mock_list.return_value = {"a.ics": "1", "b.ics": "1"}
+        mock_multiget.side_effect = ReportError("unsupported")
+        vobjs = {"a.ics": event, "b.ics": self.dummy_event(None)}
+        mock_iter_vobjects.side_effect = lambda client, workers, names, \
+            parse: ((name, parse(vobjs[name].serialize())) for name in names)
+
+        events = get_events(mock_client, mock_client, state=state)
+        mock_iter_vobjects.assert_called_once_with(mock_client, 1,
+                                                   ["a.ics", "b.ics"], ANY)
+        self.assertEqual(list(events), ["a"])
+
+        mock_iter_vobjects.reset_mock()
+        events = get_events(mock_client, mock_client, state=state)
+        self.assertFalse(mock_iter_vobjects.called,
+                         msg="fetched events despite unchanged ETags")
+        self.assertEqual(events["a"], self.event_record(event, "a.ics", "1"),
+                         msg="stored event was not recorded")
+        self.assertTrue(contact_matches_event(contact, events["a"]),
+                        msg="cached event lost its fingerprint")
+
+    @patch("birthdav.sync.multiget_cards")
+    @patch("birthdav.sync.sync_collection")
+    @patch("birthdav.sync.list_resources")
+    @patch("webdav3.client.Client")
+    def test_get_born_contacts_delta(self, MockClient, mock_list, mock_sync,
+                                     mock_multiget):
+        mock_client = self.dummy_client(MockClient)
+        state = StateStore(":memory:")
+        cards = {
+            "a.vcf": self.named_contact("1970-01-01"),
+            "b.vcf": self.named_contact("1980-01-01"),
+            "c.vcf": self.named_contact("1990-01-01"),
+        }
+        mock_multiget.side_effect = lambda client, names, parse: (
+            (name, parse(cards[name].serialize(validate=False)))
+            for name in names
+        )
+
+        mock_sync.return_value = ("1", {n: "1" for n in cards}, set())
+        state.track_changed_uids()
+        contacts = get_born_contacts(mock_client, state=state, delta=True)
+        mock_sync.assert_called_once_with(mock_client, None)
+        self.assertIs(state.changed_uids, None,
+                      msg="initial sync was not marked as complete")
+        self.assertEqual(len(contacts), 3)
+
+        cards["a.vcf"] = self.named_contact("1971-01-01")
+        mock_sync.reset_mock()
+        mock_sync.return_value = ("2", {"a.vcf": "2"}, {"b.vcf"})
+        state.track_changed_uids()
+        contacts = get_born_contacts(mock_client, state=state, delta=True)
+        mock_sync.assert_called_once_with(mock_client, "1")
+        mock_multiget.assert_called_with(mock_client, ["a.vcf"], ANY)
+        self.assertEqual(len(contacts), 2, msg="deleted contact was kept")
+        self.assertIn(cards["a.vcf"].uid.value, state.changed_uids)
+        self.assertIn(cards["b.vcf"].uid.value, state.changed_uids)
+        self.assertNotIn(cards["c.vcf"].uid.value, state.changed_uids)
+        self.assertEqual(state.get_sync_token("http://foo"), "2")
+
+        mock_sync.reset_mock()
+        mock_sync.side_effect = [SyncTokenError("expired"),
+                                 ("3", {"c.vcf": "1"}, set())]
+        state.track_changed_uids()
+        contacts = get_born_contacts(mock_client, state=state, delta=True)
+        self.assertEqual(mock_sync.call_args[0], (mock_client,),
+                         msg="did not resync after an invalid token")
+        self.assertIs(state.changed_uids, None)
+        self.assertEqual(list(contacts), [cards["c.vcf"].uid.value])
+
+        mock_sync.side_effect = ReportError("unsupported")
+        mock_list.return_value = {"c.vcf": "1"}
+        state.track_changed_uids()
+        get_born_contacts(mock_client, state=state, delta=True)
+        self.assertTrue(mock_list.called,
+                        msg="did not fall back on listing the collection")
+        self.assertIs(state.changed_uids, None)
 
     def test_contact_matches_event(self):
-        self.assertTrue(contact_matches_event(
-            self.dummy_contact("1970-01-01"),
-            self.dummy_event("uid", datetime(1970, 1, 1))
-        ))
+        contact = self.named_contact("1970-01-01")
+        event = self.event_record(self.birthday_event(contact))
+        self.assertTrue(contact_matches_event(contact, event))
+
+        contact.n.value = vobject.vcard.Name(given="Foo", family="Baz")
+        self.assertFalse(contact_matches_event(contact, event),
+                         msg="renamed contact still matches")
+        self.assertFalse(contact_matches_event(
+            contact, self.event_record(
+                self.dummy_event(contact.uid.value, datetime(1970, 1, 1))
+            )
+        ), msg="event without a fingerprint matches")
+
+    def test_contact_fingerprint(self):
+        contact = self.named_contact("1970-01-01")
+        fingerprint = get_contact_fingerprint(contact)
+        self.assertEqual(len(fingerprint), 16)
+
+        contact.n.value = vobject.vcard.Name(given=" Foo ", family="Bar")
+        self.assertEqual(get_contact_fingerprint(contact), fingerprint,
+                         msg="name was not normalized")
+        contact.bday.value = "1970-01-02"
+        self.assertNotEqual(get_contact_fingerprint(contact), fingerprint)
+        with patch("birthdav.sync.EVENT_TEMPLATE_VERSION", 0):
+            self.assertNotEqual(get_contact_fingerprint(contact),
+                                fingerprint)
 
     def test_triage_events(self):
         new_contact = self.dummy_contact(datetime.now())
         updated_contact = self.dummy_contact("1970-01-01")
-        updated_event = self.dummy_event(updated_contact.uid.value,
-                                         datetime(1980, 1, 1))
-        deleted_event = self.dummy_event("foo")
+        updated_event = self.event_record(self.dummy_event(
+            updated_contact.uid.value, datetime(1980, 1, 1)
+        ))
+        deleted_event = self.event_record(self.dummy_event("foo"))
 
         new, lost, updated = triage_events({
             new_contact.uid.value: new_contact,
@@ -120,13 +455,66 @@ class TestSync(unittest.TestCase):
             updated[0]["contact"].uid.value == updated_contact.uid.value,
             msg="missing updated contact"
         )
-        self.assertTrue(
-            len(lost) == 1 and deleted_event.uid.value in lost,
-            msg="missing lost contact"
+        self.assertEqual(lost, [deleted_event], msg="missing lost contact")
+
+    def test_iter_triage_streaming(self):
+        new_contact = self.dummy_contact("1970-01-01")
+        kept_contact = self.dummy_contact("1970-01-01")
+        kept_event = self.event_record(self.birthday_event(kept_contact))
+        lost_event = self.event_record(self.dummy_event("foo"))
+        consumed = []
+
+        def contacts():
+            for contact in (new_contact, kept_contact):
+                consumed.append(contact)
+                yield contact.uid.value, contact
+            raise FetchError({"broken.vcf": IOError()})
+
+        operations = iter_triage(contacts(), {
+            kept_contact.uid.value: kept_event,
+            "foo": lost_event,
+        })
+
+        self.assertEqual(next(operations), ("new", new_contact))
+        self.assertEqual(consumed, [new_contact],
+                         msg="new contact was not yielded right away")
+        with self.assertRaises(FetchError,
+                               msg="lost events were triaged despite errors"):
+            next(operations)
+
+    def test_iter_triage_relevant(self):
+        new_contact = self.dummy_contact("1970-01-01")
+        skipped_contact = self.dummy_contact("1980-01-01")
+        skipped_event = self.event_record(
+            self.birthday_event(skipped_contact)
+        )
+        skipped_contact.bday.value = "1970-01-01"
+        legacy_contact = self.dummy_contact("1970-01-01")
+        legacy_event = self.event_record(
+            self.dummy_event(legacy_contact.uid.value), "legacy.ics", "1"
         )
+        lost_event = self.event_record(self.dummy_event("foo"))
+        irrelevant = (skipped_contact.uid.value, legacy_contact.uid.value)
 
+        operations = list(iter_triage([
+            (new_contact.uid.value, new_contact),
+            (skipped_contact.uid.value, skipped_contact),
+            (legacy_contact.uid.value, legacy_contact),
+        ], {
+            skipped_contact.uid.value: skipped_event,
+            legacy_contact.uid.value: legacy_event,
+            "foo": lost_event,
+        }, lambda uid: uid not in irrelevant))
+
+        self.assertEqual(operations, [
+            ("new", new_contact),
+            ("updated", {"contact": legacy_contact, "event": legacy_event}),
+            ("lost", lost_event),
+        ], msg="irrelevant contact was compared, or legacy event kept")
+
+    @patch("birthdav.sync.upload_vobject")
     @patch("webdav3.client.Client")
-    def test_create_birthday_events(self, MockClient):
+    def test_create_birthday_events(self, MockClient, mock_upload):
         mock_client = self.dummy_client(MockClient)
         new_contact = self.dummy_contact("1970-01-01")
         new_contact.add("n")
@@ -135,6 +523,10 @@ class TestSync(unittest.TestCase):
         new_contact.n.value.family = "Baz"
         vobj = create_birthday_event(mock_client, mock_client, new_contact)
 
+        mock_upload.assert_called_once_with(mock_client,
+                                            "%s.ics" % vobj.uid.value, vobj,
+                                            if_none_match="*")
+
         expected_name = "Foo Bar Baz"
         self.assertEqual(vobj.x_birthdav_card_uid.value, new_contact.uid.value,
                          msg="invalid contact reference in event")
@@ -161,12 +553,13 @@ class TestSync(unittest.TestCase):
                            for a in alarms])
         self.assertEqual(triggers, [-604800, 0], msg="invalid alarm triggers")
 
+    @patch("birthdav.sync.delete_vobject")
+    @patch("birthdav.sync.upload_vobject")
     @patch("birthdav.sync.create_birthday_event")
     @patch("webdav3.client.Client")
-    def test_apply_diffs(self, MockClient, mock_create_event):
+    def test_apply_diffs(self, MockClient, mock_create_event, mock_upload,
+                         mock_delete):
         mock_client = self.dummy_client(MockClient)
-        mock_client.upload = Mock()
-        mock_client.clean = Mock()
 
         new_contact = self.dummy_contact("1970-01-01")
         updated_contact = self.dummy_contact("1970-01-01")
@@ -176,19 +569,356 @@ class TestSync(unittest.TestCase):
 
         apply_diffs(
             mock_client, mock_client,
-            [new_contact], [lost_event.uid.value],
+            [new_contact],
+            [self.event_record(lost_event, "lost.ics", "1")],
             [{
                 "contact": updated_contact,
-                "event": updated_event
+                "event": self.event_record(updated_event, "legacy.ics", "2"),
             }]
         )
 
         mock_create_event.assert_called_once_with(mock_client, mock_client,
                                                   new_contact)
-        mock_client.upload.assert_called_once()
-        self.assertEqual(mock_client.upload.call_args[0][0],
-                         "%s.ics" % updated_event.uid.value,
+        mock_upload.assert_called_once()
+        uid = get_event_uid("http://foo", updated_contact.uid.value)
+        self.assertEqual(mock_upload.call_args[0][1], "%s.ics" % uid,
                          msg="missing updating call")
-        mock_client.clean.assert_called_once_with(
-            "%s.ics" % lost_event.uid.value
+        self.assertEqual(mock_upload.call_args[0][2].uid.value, uid,
+                         msg="updated event was not renamed")
+        self.assertEqual(mock_upload.call_args[1], {"if_none_match": "*"},
+                         msg="renamed event could overwrite another")
+        self.assertEqual(mock_delete.call_args_list, [
+            call(mock_client, "lost.ics", if_match="1"),
+            call(mock_client, "legacy.ics", if_match="2"),
+        ], msg="lost or legacy event was not deleted where it was")
+
+    @patch("birthdav.sync.delete_vobject")
+    @patch("birthdav.sync.upload_vobject")
+    @patch("webdav3.client.Client")
+    def test_update_in_place(self, MockClient, mock_upload, mock_delete):
+        mock_client = self.dummy_client(MockClient)
+        contact = self.dummy_contact("1970-01-01")
+        event = self.birthday_event(contact)
+        contact.bday.value = "1970-01-02"
+
+        results = apply_diffs(mock_client, mock_client, [], [], [{
+            "contact": contact,
+            "event": self.event_record(event, "renamed.ics", "1"),
+        }])
+
+        self.assertEqual(results[0]["status"], "ok")
+        self.assertFalse(mock_delete.called,
+                         msg="deleted an event with a deterministic UID")
+        mock_upload.assert_called_once_with(
+            mock_client, "renamed.ics", ANY, if_match="1"
         )
+
+    @patch("birthdav.sync.refetch_vobject")
+    @patch("birthdav.sync.upload_vobject")
+    @patch("webdav3.client.Client")
+    def test_update_conflict(self, MockClient, mock_upload, mock_refetch):
+        mock_client = self.dummy_client(MockClient)
+        contact = self.dummy_contact("1970-01-01")
+        event = self.birthday_event(contact)
+        contact.bday.value = "1970-01-02"
+        item = {"contact": contact,
+                "event": self.event_record(event, "a.ics", "1")}
+        mock_upload.side_effect = [ResponseErrorCode("", 412, "changed"), None]
+
+        mock_refetch.return_value = self.birthday_event(contact), "2"
+        results = apply_diffs(mock_client, mock_client, [], [], [item])
+        self.assertEqual(results[0]["status"], "ok")
+        self.assertEqual(mock_upload.call_count, 1,
+                         msg="rewrote an event already up to date")
+
+        mock_upload.reset_mock()
+        mock_upload.side_effect = [ResponseErrorCode("", 412, "changed"), None]
+        mock_refetch.return_value = event, "3"
+        results = apply_diffs(mock_client, mock_client, [], [], [item])
+        self.assertEqual(results[0]["status"], "ok")
+        self.assertEqual(mock_upload.call_args[1], {"if_match": "3"},
+                         msg="conflict was not retried on the current ETag")
+
+        mock_upload.reset_mock()
+        mock_upload.side_effect = ResponseErrorCode("", 412, "changed")
+        results = apply_diffs(mock_client, mock_client, [], [], [item])
+        self.assertEqual(results[0]["status"], "failed")
+        self.assertEqual(mock_upload.call_count, 2,
+                         msg="conflict was retried more than once")
+
+    @patch("birthdav.sync.refetch_vobject")
+    @patch("birthdav.sync.delete_vobject")
+    @patch("webdav3.client.Client")
+    def test_delete_conflict(self, MockClient, mock_delete, mock_refetch):
+        mock_client = self.dummy_client(MockClient)
+        lost = [self.event_record(self.dummy_event("foo"), "a.ics", "1")]
+        mock_delete.side_effect = ResponseErrorCode("", 412, "changed")
+        mock_refetch.return_value = None, None
+
+        results = apply_diffs(mock_client, mock_client, [], lost, [])
+
+        self.assertEqual(results[0]["status"], "ok",
+                         msg="event deleted meanwhile was a failure")
+        self.assertEqual(mock_delete.call_count, 1)
+
+    def test_birthday_feed(self):
+        contacts = {c.uid.value: c for c in (
+            self.named_contact("1970-01-01", "Foo"),
+            self.named_contact("1980-01-01", "Baz"),
+        )}
+        fingerprint = get_feed_fingerprint("http://foo", contacts)
+
+        feed = build_birthday_feed("http://foo", contacts).serialize()
+
+        events = vobject.readOne(feed).vevent_list
+        self.assertEqual(sorted(e.uid.value for e in events),
+                         sorted(get_event_uid("http://foo", uid)
+                                for uid in contacts),
+                         msg="feed events were not named after contacts")
+        self.assertEqual(scan_feed(feed), fingerprint)
+        self.assertEqual(scan_feed("BEGIN:VCALENDAR\r\nEND:VCALENDAR"), "")
+        self.assertEqual(get_feed_fingerprint(
+            "http://foo", dict(reversed(list(contacts.items())))
+        ), fingerprint, msg="fingerprint depends on the contacts' order")
+        next(iter(contacts.values())).bday.value = "1970-01-02"
+        self.assertNotEqual(get_feed_fingerprint("http://foo", contacts),
+                            fingerprint)
+
+    @patch("birthdav.sync.upload_vobject")
+    @patch("birthdav.sync.refetch_vobject")
+    @patch("webdav3.client.Client")
+    def test_triage_feed(self, MockClient, mock_refetch, mock_upload):
+        mock_client = self.dummy_client(MockClient)
+        contact = self.named_contact("1970-01-01")
+        contacts = {contact.uid.value: contact}
+
+        mock_refetch.return_value = \
+            get_feed_fingerprint("http://foo", contacts), "1"
+        self.assertEqual(triage_feed(mock_client, mock_client,
+                                     "birthdays.ics", contacts), [],
+                         msg="unchanged feed was written again")
+
+        mock_refetch.return_value = "outdated", "1"
+        (operation, item), = triage_feed(mock_client, mock_client,
+                                         "birthdays.ics", contacts)
+        self.assertEqual((operation, item["etag"], item["create"]),
+                         ("feed", "1", False))
+
+        mock_refetch.return_value = None, None
+        operations = triage_feed(mock_client, mock_client, "birthdays.ics",
+                                 contacts)
+        results = apply_operations(mock_client, mock_client, operations)
+        self.assertEqual(results[0]["status"], "ok")
+        mock_upload.assert_called_once_with(mock_client, "birthdays.ics",
+                                            ANY, if_none_match="*")
+
+    @patch("birthdav.sync.fetch_etag")
+    @patch("birthdav.sync.refetch_vobject")
+    @patch("webdav3.client.Client")
+    def test_triage_feed_state(self, MockClient, mock_refetch,
+                               mock_fetch_etag):
+        mock_client = self.dummy_client(MockClient)
+        state = StateStore(":memory:")
+        contact = self.named_contact("1970-01-01")
+        contacts = {contact.uid.value: contact}
+        mock_refetch.return_value = \
+            get_feed_fingerprint("http://foo", contacts), "1"
+        mock_fetch_etag.return_value = "1"
+
+        for _ in range(2):
+            self.assertEqual(triage_feed(mock_client, mock_client,
+                                         "birthdays.ics", contacts, state),
+                             [])
+        mock_refetch.assert_called_once()
+        mock_fetch_etag.assert_called_once_with(mock_client, "birthdays.ics")
+
+        mock_fetch_etag.return_value = "2"
+        triage_feed(mock_client, mock_client, "birthdays.ics", contacts,
+                    state)
+        self.assertEqual(mock_refetch.call_count, 2,
+                         msg="changed feed was not downloaded")
+
+        contact.bday.value = "1970-01-02"
+        mock_fetch_etag.reset_mock()
+        (operation, _), = triage_feed(mock_client, mock_client,
+                                      "birthdays.ics", contacts, state)
+        self.assertEqual(operation, "feed")
+        self.assertFalse(mock_fetch_etag.called)
+
+    @patch("birthdav.sync.upload_vobject")
+    @patch("webdav3.client.Client")
+    def test_feed_rejected(self, MockClient, mock_upload):
+        mock_client = self.dummy_client(MockClient)
+        contact = self.named_contact("1970-01-01")
+        feed = build_birthday_feed("http://foo", {contact.uid.value: contact})
+        mock_upload.side_effect = ResponseErrorCode("", 403, "no-uid-conflict")
+
+        results = apply_operations(mock_client, mock_client, [
+            ("feed", {"name": "birthdays.ics", "feed": feed, "etag": None,
+                      "create": True})
+        ])
+        self.assertIsInstance(results[0]["error"], FeedError)
+        self.assertIn("WebDAV", str(ApplyError(results)),
+                      msg="rejected feed was not reported clearly")
+
+    def test_event_uid(self):
+        uid = get_event_uid("http://foo", "a")
+        self.assertEqual(uid, get_event_uid("http://foo", "a"))
+        self.assertNotEqual(uid, get_event_uid("http://bar", "a"))
+        self.assertNotEqual(uid, get_event_uid("http://foo", "b"))
+        self.assertEqual(uuid.UUID(uid).version, 5)
+
+    @patch("time.sleep")
+    @patch("birthdav.sync.create_birthday_event")
+    @patch("webdav3.client.Client")
+    def test_apply_results(self, MockClient, mock_create_event, mock_sleep):
+        mock_client = self.dummy_client(MockClient)
+        contacts = [self.dummy_contact("1970-01-01") for _ in range(4)]
+        failures = {
+            contacts[1].uid.value: [ResponseErrorCode("", 503, "busy")],
+            contacts[2].uid.value: [ResponseErrorCode("", 403, "denied")],
+            contacts[3].uid.value: [ResponseErrorCode("", 503, "busy")] * 3,
+        }
+
+        def create(cal_client, card_client, contact):
+            errors = failures.get(contact.uid.value)
+            if errors:
+                raise errors.pop()
+        mock_create_event.side_effect = create
+
+        results = apply_diffs(mock_client, mock_client, contacts, [], [],
+                              workers=2, retries=1)
+
+        self.assertEqual([r["item"] for r in results], contacts,
+                         msg="results out of order")
+        self.assertEqual([r["status"] for r in results],
+                         ["ok", "retried", "failed", "failed"],
+                         msg="invalid statuses")
+        self.assertEqual([r["attempts"] for r in results], [1, 2, 1, 2],
+                         msg="invalid attempt counts")
+        self.assertEqual(results[2]["error"].code, 403)
+        self.assertEqual(mock_sleep.call_count, 2,
+                         msg="retries were not spaced out")
+
+        error = ApplyError(results)
+        self.assertIn(contacts[2].uid.value, str(error))
+        self.assertNotIn(contacts[1].uid.value, str(error))
+
+    def test_journaled_operations(self):
+        contact = self.named_contact("1970-01-01")
+        event = self.event_record(self.birthday_event(contact), "a.ics", "1")
+        contact.bday.value = "1970-01-02"
+
+        for operation, item in (("new", contact), ("lost", event),
+                                ("updated", {"contact": contact,
+                                             "event": event})):
+            _, loaded = load_operation(
+                operation, dump_operation(operation, item)
+            )
+            if operation == "lost":
+                self.assertEqual(loaded, event)
+                continue
+            if operation == "updated":
+                self.assertEqual(loaded["event"], event)
+                loaded = loaded["contact"]
+            self.assertEqual(
+                get_contact_fingerprint(loaded),
+                get_contact_fingerprint(contact),
+                msg="%s contact did not survive the journal" % operation
+            )
+
+    @patch("birthdav.sync.create_birthday_event")
+    @patch("webdav3.client.Client")
+    def test_resume_operations(self, MockClient, mock_create_event):
+        mock_client = self.dummy_client(MockClient)
+        journal = OperationJournal(":memory:", "http://foo")
+        contacts = [self.named_contact("1970-01-01") for _ in range(3)]
+
+        def create(cal_client, card_client, contact):
+            if contact.uid.value == contacts[1].uid.value:
+                raise ResponseErrorCode("", 403, "denied")
+        mock_create_event.side_effect = create
+
+        apply_diffs(mock_client, mock_client, contacts, [], [])
+        self.assertEqual(journal.get_operations(), [],
+                         msg="journaled without a journal")
+
+        plan_operations(journal, [("new", c) for c in contacts])
+        self.assertEqual(len(journal.get_operations()), 3)
+        results = resume_operations(mock_client, mock_client, journal)
+
+        self.assertEqual([r["status"] for r in results],
+                         ["ok", "failed", "ok"])
+        resumed = mock_create_event.call_args[0][2]
+        self.assertEqual(resumed.uid.value, contacts[2].uid.value)
+        self.assertEqual(journal.get_operations(), [
+            ("new", dump_operation("new", contacts[1]))
+        ], msg="succeeded operations were kept, or failed ones dropped")
+        self.assertFalse(journal.is_planned(), msg="plan was not finished")
+
+    def test_leftover_uids(self):
+        journal = OperationJournal(":memory:", "http://foo")
+        contact = self.named_contact("1970-01-01")
+        other = self.named_contact("1980-01-01")
+        event = self.event_record(self.birthday_event(other), "b.ics", "1")
+        plan_operations(journal, [("new", contact), ("lost", event)])
+
+        self.assertEqual(get_leftover_uids(journal),
+                         {contact.uid.value, other.uid.value},
+                         msg="leftover operations would not be triaged "
+                         "again")
+        plan_operations(journal, [])
+        self.assertEqual(get_leftover_uids(journal), set())
+
+    @patch("time.sleep")
+    @patch("birthdav.sync.create_birthday_event")
+    @patch("webdav3.client.Client")
+    def test_apply_throttled(self, MockClient, mock_create_event,
+                             mock_sleep):
+        mock_client = self.dummy_client(MockClient)
+        mock_create_event.side_effect = [
+            ThrottledError("", 429, "slow down", retry_after=30), None
+        ]
+
+        results = apply_diffs(mock_client, mock_client,
+                              [self.dummy_contact("1970-01-01")], [], [],
+                              workers=4, retries=1)
+
+        self.assertEqual(results[0]["status"], "retried")
+        self.assertGreaterEqual(mock_sleep.call_args[0][0], 30,
+                                msg="Retry-After was not honoured")
+
+    @patch("birthdav.sync.delete_vobject")
+    @patch("webdav3.client.Client")
+    def test_apply_concurrency(self, MockClient, mock_delete):
+        mock_client = self.dummy_client(MockClient)
+        lock = threading.Lock()
+        running = {"now": 0, "max": 0, "done": 0}
+        pulled = []
+
+        def delete(client, path, if_match=None):
+            with lock:
+                running["now"] += 1
+                running["max"] = max(running["max"], running["now"])
+            threading.Event().wait(0.01)
+            with lock:
+                running["now"] -= 1
+                running["done"] += 1
+        mock_delete.side_effect = delete
+
+        def operations():
+            for i in range(12):
+                pulled.append(i)
+                self.assertLessEqual(len(pulled) - running["done"], 4,
+                                     msg="operations pulled too early")
+                yield "lost", self.event_record(
+                    self.dummy_event("event%d" % i), "event%d.ics" % i
+                )
+
+        results = apply_operations(mock_client, mock_client, operations(),
+                                   workers=3)
+
+        self.assertEqual(len(results), 12)
+        self.assertTrue(all(r["status"] == "ok" for r in results))
+        self.assertLessEqual(running["max"], 3, msg="too many writers")
+        self.assertGreater(running["max"], 1, msg="writes were sequential")
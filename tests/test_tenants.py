@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from webdav3.exceptions import ResponseErrorCode
+from unittest.mock import patch
+import threading
+import unittest
+
+from birthdav.tenants import sync_tenants
+
+
+class TestTenants(unittest.TestCase):
+    @staticmethod
+    def tenant(name):
+        return {"name": name, "sync": {"fetch_workers": 2},
+                "http": {"pool_size": 2, "compress": True},
+                "card": {"url": "http://foo/%s/card/" % name},
+                "cal": {"url": "http://foo/%s/cal/" % name}}
+
+    @patch("birthdav.tenants.sync_birthdays")
+    @patch("birthdav.tenants.get_client")
+    def test_summary(self, mock_get_client, mock_sync):
+        mock_get_client.side_effect = lambda config, session: \
+            config["url"]
+
+        def sync(card_client, cal_client, fetch_workers):
+            if "bob" in card_client:
+                raise ResponseErrorCode(card_client, 500, "oops")
+            return [{"status": "ok"}] * 3
+        mock_sync.side_effect = sync
+
+        summary = sync_tenants([self.tenant(n) for n in
+                                ("alice", "bob", "carol")], workers=2)
+
+        self.assertEqual([r["name"] for r in summary],
+                         ["alice", "bob", "carol"])
+        self.assertEqual([r["status"] for r in summary],
+                         ["ok", "failed", "ok"],
+                         msg="failing tenant affected the others")
+        self.assertEqual(summary[0]["operations"], 3)
+        self.assertEqual(summary[1]["error"].code, 500)
+        mock_sync.assert_any_call("http://foo/alice/card/",
+                                  "http://foo/alice/cal/", fetch_workers=2)
+
+    @patch("birthdav.tenants.sync_birthdays")
+    @patch("birthdav.tenants.get_client")
+    def test_slow_tenant(self, mock_get_client, mock_sync):
+        mock_get_client.side_effect = lambda config, session: \
+            config["url"]
+        released = threading.Event()
+        synced = []
+
+        def sync(card_client, cal_client, fetch_workers):
+            if "slow" in card_client:
+                self.assertTrue(released.wait(5),
+                                msg="slow tenant held the others back")
+            else:
+                synced.append(card_client)
+                if len(synced) == 3:
+                    released.set()
+            return []
+        mock_sync.side_effect = sync
+
+        summary = sync_tenants([self.tenant(n) for n in
+                                ("slow", "a", "b", "c")], workers=2)
+        self.assertTrue(all(r["status"] == "ok" for r in summary))
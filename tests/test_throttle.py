@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from unittest.mock import patch
+import threading
+import unittest
+
+from birthdav.dav import ThrottledError
+from birthdav.throttle import get_retry_delay, ConcurrencyLimiter
+
+
+class TestThrottle(unittest.TestCase):
+    @patch("birthdav.throttle.random.uniform")
+    def test_retry_delay(self, mock_uniform):
+        mock_uniform.side_effect = lambda low, high: high
+        error = ValueError()
+        self.assertEqual([get_retry_delay(error, n) for n in (1, 2, 3, 20)],
+                         [0.5, 1, 2, 60], msg="invalid exponential backoff")
+
+        error = ThrottledError("", 429, "slow down", retry_after=10)
+        self.assertEqual(get_retry_delay(error, 1), 10.5,
+                         msg="Retry-After was not honoured")
+        error.retry_after = 3600
+        self.assertEqual(get_retry_delay(error, 1), 300.5)
+
+    def test_aimd(self):
+        limiter = ConcurrencyLimiter(8)
+        with self.assertRaises(ThrottledError):
+            with limiter.slot():
+                raise ThrottledError("", 429, "slow down")
+        self.assertEqual(limiter.limit, 4, msg="limit was not halved")
+
+        limiter.decrease(0)
+        self.assertEqual(limiter.limit, 4,
+                         msg="halved again by a request already in flight")
+
+        for _ in range(4):
+            with limiter.slot():
+                pass
+        self.assertEqual(limiter.limit, 5, msg="limit did not grow back")
+
+        with self.assertRaises(ValueError):
+            with limiter.slot():
+                raise ValueError()
+        self.assertEqual(limiter.limit, 5,
+                         msg="other errors were taken for throttling")
+
+    def test_slots(self):
+        limiter = ConcurrencyLimiter(1)
+        lock = threading.Lock()
+        running = {"now": 0, "max": 0}
+
+        def request():
+            with limiter.slot():
+                with lock:
+                    running["now"] += 1
+                    running["max"] = max(running["max"], running["now"])
+                threading.Event().wait(0.01)
+                with lock:
+                    running["now"] -= 1
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(running["max"], 1, msg="limit was not enforced")
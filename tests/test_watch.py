@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# birthdav - A tool to synchronise CardDAV birth dates to a CalDAV calendar
+# Copyright (C) 2022 Julien JPK <mail@jjpk.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from webdav3.exceptions import ResponseErrorCode
+from unittest.mock import patch
+import threading
+import unittest
+
+from birthdav.watch import watch_birthdays
+
+
+class TestWatch(unittest.TestCase):
+    @staticmethod
+    def polls(stop, tags):
+        tags = iter(tags)
+
+        def poll(client):
+            tag = next(tags)
+            if isinstance(tag, Exception):
+                raise tag
+            try:
+                return tag
+            finally:
+                if tag == "end":
+                    stop.set()
+        return poll
+
+    @patch("birthdav.watch.sync_birthdays")
+    @patch("birthdav.watch.get_collection_tag")
+    def test_sync_on_change(self, mock_tag, mock_sync):
+        stop = threading.Event()
+        mock_tag.side_effect = self.polls(stop, ["1", "1", "2", "2", "end"])
+
+        watch_birthdays("card", "cal", 0, stop, fetch_workers=2)
+
+        self.assertEqual(mock_sync.call_count, 3,
+                         msg="did not sync on changes only")
+        mock_sync.assert_called_with("card", "cal", fetch_workers=2)
+
+    @patch("birthdav.watch.sync_birthdays")
+    @patch("birthdav.watch.get_collection_tag")
+    def test_sync_without_tag(self, mock_tag, mock_sync):
+        stop = threading.Event()
+        mock_tag.side_effect = self.polls(stop, [None, None, "end"])
+
+        watch_birthdays("card", "cal", 0, stop)
+
+        self.assertEqual(mock_sync.call_count, 3,
+                         msg="did not sync at every poll without a tag")
+
+    @patch("birthdav.watch.sync_birthdays")
+    @patch("birthdav.watch.get_collection_tag")
+    def test_failures(self, mock_tag, mock_sync):
+        stop = threading.Event()
+        mock_tag.side_effect = self.polls(stop, [
+            ResponseErrorCode("http://foo", 503, "busy"), "1", "1", "end"
+        ])
+        mock_sync.side_effect = [ResponseErrorCode("http://foo", 500, ""),
+                                 None, None]
+
+        with patch("sys.stderr"):
+            watch_birthdays("card", "cal", 0, stop)
+
+        self.assertEqual(mock_sync.call_count, 3,
+                         msg="failed sync was not attempted again")